@@ -1,51 +1,86 @@
-import numpy as np
 import logging
 from io import BytesIO
 from pydub import AudioSegment
 import torch
 from transformers import AutoProcessor, MusicgenForConditionalGeneration
+from transformers.generation.streamers import BaseStreamer
 from functools import lru_cache
 import hashlib
 import os
-import unicodedata
+from typing import Callable, List, Optional, Tuple
+import numpy as np
+from audio_processing import postprocess, read_wav, to_mono, write_wav
+from audio_index import ClipIndex
+from cache_backends import create_cache
+from content_store import ContentStore
+from instruments import normalize_text, lookup_instrument
+from metrics import AUDIO_CACHE_REQUESTS, DEMO_STAGE_SECONDS, time_stage, update_audio_cache_size
+from tracing import span
+from waveform import store_for_wav
 
 logger = logging.getLogger(__name__)
 
+# MusicGen sinh ~50 frame/giây, dùng 40 token/giây audio như cấu hình ban đầu
+TOKENS_PER_SECOND = 40
 
-def normalize_text(text: str) -> str:
-    """
-    Chuẩn hóa text: bỏ dấu, chuyển thành chữ thường
-    """
-    if not text:
-        return ""
-    
-    text = unicodedata.normalize('NFD', text)
-    text = ''.join(char for char in text if unicodedata.category(char) != 'Mn')
-    text = text.replace('đ', 'd').replace('Đ', 'd')
-    text = text.lower().strip()
-    text = ' '.join(text.split())
-    
-    return text
+
+def estimate_tokens(duration: float) -> int:
+    """Số token (max_new_tokens) cần để sinh `duration` giây audio"""
+    return int(duration * TOKENS_PER_SECOND)
+
+
+class _ProgressStreamer(BaseStreamer):
+    """Đếm số token MusicGen đã sinh để báo tiến độ (lần put đầu tiên là token khởi đầu, không tính)"""
+
+    def __init__(self, total_tokens: int, callback: Callable[[int, int], None]):
+        self.total_tokens = total_tokens
+        self.callback = callback
+        self.tokens = -1
+
+    def put(self, value):
+        self.tokens += 1
+        if self.tokens > 0:
+            self.callback(min(self.tokens, self.total_tokens), self.total_tokens)
+
+    def end(self):
+        self.callback(self.total_tokens, self.total_tokens)
 
 
 class AIMusicGenerator:
-    def __init__(self, device: str = None, use_cache: bool = True):
+    def __init__(self, device: str = None, use_cache: bool = True, cache_dir: str = "audio_cache",
+                 index: Optional[ClipIndex] = None):
         """
         AI Music Generator dùng MusicGen với tối ưu
         :param device: 'cpu', 'cuda', hoặc None (auto-detect)
         :param use_cache: Bật cache cho audio đã generate
+        :param cache_dir: Thư mục lưu audio đã generate
+        :param index: Index clip cho fallback, mặc định index riêng trên cache_dir
         """
         if device is None:
             device = self._detect_best_device()
         
         self.device = device
         self.use_cache = use_cache
-        self.cache_dir = "audio_cache"
+        self.cache_dir = cache_dir
+        # Index fallback quét đúng thư mục cache của generator này
+        self.index = index if index is not None else ClipIndex(cache_dir)
         self.use_fp16 = (device == "cuda")
         
+        # Backend cache chọn theo AUDIO_CACHE_BACKEND (local / shared / redis), xem cache_backends.py
+        self.cache = create_cache(self.cache_dir) if self.use_cache else None
+        # Tên theo nội dung (by-hash/<sha256>.wav) cho URL GET cache được vĩnh viễn
+        self.content = ContentStore(os.path.join(self.cache_dir, "by-hash")) if self.use_cache else None
         if self.use_cache:
-            os.makedirs(self.cache_dir, exist_ok=True)
+            update_audio_cache_size(self.cache_dir)
         
+        self._load_model()
+
+    def _load_model(self):
+        """
+        Load processor + model MusicGen vào self.processor / self.model
+        (benchmark ghi đè hàm này để dùng model giả)
+        """
+        device = self.device
         try:
             logger.info(f"📄 Loading MusicGen on {device}...")
             self.processor = AutoProcessor.from_pretrained("facebook/musicgen-small")
@@ -114,59 +149,8 @@ class AIMusicGenerator:
         Xây dựng prompt cho MusicGen.
         instrument: đã được chuẩn hóa (không dấu, chữ thường)
         """
-        # Mapping không dấu
-        instrument_map = {
-           "sao truc": "Vietnamese bamboo transverse flute Sáo Trúc, airy, soft timbre, capable of bending notes for expressive melodies",
-  "sao tieu": "Vietnamese vertical bamboo flute Sáo Tiêu, mellow meditative low tone, ideal for soulful and introspective music",
-  "ken bau": "Vietnamese conical oboe Kèn Bầu, reedy, buzzing, and powerful sound, used in traditional ceremonies",
-  "dan tranh": "Vietnamese 16-string zither Đàn Tranh, bright, metallic cascading tones with glissando, versatile for classical and folk music",
-  "dan bau": "Vietnamese monochord Đàn Bầu, expressive bending pitch, soulful vocal-like timbre, iconic in Vietnamese music",
-  "dan nguyet": "Vietnamese moon lute Đàn Nguyệt, clear metallic tone, traditional opera instrument with a bright, resonant sound",
-  "dan tinh": "Vietnamese lute Đàn Tính, gentle storytelling tone used in spiritual folk songs of ethnic minorities",
-  "dan ty ba": "Vietnamese pear-shaped lute Đàn Tỳ Bà, delicate articulate plucking tone, rooted in classical traditions",
-  "dan nhi": "Vietnamese two-string fiddle Đàn Nhị, nasal, emotional, expressive sound, often used in emotional ballads",
-  "dan gao": "Vietnamese coconut-shell fiddle Đàn Gáo, rustic, folk tone with a warm, earthy quality",
-  "dan co": "Vietnamese spike fiddle Đàn Cò, high-pitched crying timbre, evoking deep emotional resonance",
-  "trong com": "Vietnamese barrel drum Trống Cơm, resonant deep bass sound, essential for rhythmic accompaniment",
-  "phach": "Vietnamese wooden clappers Phách, dry sharp percussive click, used for rhythmic precision in ensembles",
-  "song lang": "Vietnamese bamboo clapper Song Lang, sharp timing click, provides crisp rhythmic accents",
-  "chieng": "Vietnamese gong Chiêng, metallic reverberant tone, central to ethnic rituals and ensembles",
-  "t rung": "Vietnamese bamboo xylophone T'rưng, bright cascading mountain echo tones, popular in highland music",
-  "k longput": "Vietnamese bamboo percussion K'longput, resonant airy tones from clapped air, unique to ethnic traditions",
-  "dan kni": "Vietnamese mouth fiddle Đàn K'ni, haunting vocal-like resonance, played with mouth for expressive melodies",
-  "sao": "Vietnamese bamboo flute Sáo, airy, soft timbre, capable of bending notes, versatile for various genres",
-  "ken be": "Vietnamese small oboe Kèn Bè, reedy, buzzing, and powerful sound, compact yet impactful",
-  "danh tranh": "Vietnamese 16-string zither Đàn Tranh, bright, metallic cascading tones with glissando, alternate name for Đàn Tranh",
-  "dan da": "Vietnamese stone xylophone Đàn Đá, bright, resonant stone tones, unique to ancient traditions",
-  "dan day": "Vietnamese long-necked lute Đàn Đáy, deep, resonant folk instrument, used in traditional ca trù music",
-  "dan sen": "Vietnamese lotus lute Đàn Sen, delicate, floating tones, rare and poetic in sound",
-  "dan tam thap luc": "Vietnamese 36-string zither Đàn Tam Thập Lục, extended range with versatile, cascading tones, ideal for complex melodies",
-  "dan tam": "Vietnamese three-string lute Đàn Tam, bright, rhythmic plucking tones, used in traditional ensembles",
-  "dan senh": "Vietnamese lute Đàn Sến, delicate, articulate plucking tones, popular in southern folk music",
-  "senh tien": "Vietnamese coin clapper Sênh Tiền, metallic jingling percussion sound, adds rhythmic sparkle",
-  "mo": "Vietnamese wooden fish Mõ, hollow resonant knocking tone for ceremonial and Buddhist rituals",
-  "trong cai": "Vietnamese large drum Trống Cái, deep booming bass rhythm, leads traditional music ensembles",
-  "trong chau": "Vietnamese temple drum Trống Châu, deep ceremonial tone with resonant beats, used in sacred settings",
-  "cong chieng": "Vietnamese gong set Cồng Chiêng, varied metallic resonances, essential for ethnic rituals and festivals",
-  "khen": "Vietnamese free reed mouth organ Khèn, polyphonic buzzing reed tones, expressive melodies for ethnic music",
-  "dan goong": "Vietnamese bamboo tube zither Đàn Goong, earthy percussive tones from ethnic traditions",
-  "litranh": "Vietnamese horn Litranh, natural horn sound with deep, calling timbre, used in ethnic ceremonies",
-  "trong paranung": "Vietnamese ethnic drum Trống Paranưng, rhythmic patterns with vibrant beats, unique to minority groups",
-  "chuong": "Vietnamese bell Chuông, clear ringing tone for signaling and ceremonies, adds melodic accents",
-  "guitar": "Acoustic or electric stringed instrument Guitar, versatile warm or bright tones, used in folk, pop, rock, and classical music",
-  "piano": "Keyboard instrument Piano, rich, dynamic range with resonant tones, ideal for classical, jazz, and contemporary music",
-  "violin": "Stringed instrument Violin, expressive, singing tone, used in classical, folk, and modern genres",
-  "drum set": "Percussion ensemble Drum Set, powerful rhythmic foundation with varied tones, essential for rock, jazz, and pop music",
-  "flute": "Western transverse flute Flute, clear, bright, and airy tone, used in classical, jazz, and world music",
-  "trumpet": "Brass instrument Trumpet, bold, piercing tone, versatile for jazz, classical, and marching bands",
-  "saxophone": "Reed instrument Saxophone, smooth, soulful tone, prominent in jazz, pop, and classical music",
-  "ukulele": "Small stringed instrument Ukulele, bright, cheerful plucking tones, popular in Hawaiian and folk music",
-  "harmonica": "Free reed instrument Harmonica, compact, expressive sound, used in blues, folk, and country music",
-        }
-
-        # Chuẩn hóa instrument key
-        normalized_key = normalize_text(instrument)
-        desc = instrument_map.get(normalized_key, f"Vietnamese folk instrument {instrument}")
+        inst = lookup_instrument(instrument)
+        desc = inst.description if inst else f"Vietnamese folk instrument {instrument}"
 
         return (
             f"A high-quality {style} solo performance played only with the {desc}. "
@@ -178,61 +162,138 @@ class AIMusicGenerator:
 
     def _get_cache_key(self, instrument: str, style: str, duration: float) -> str:
         """Tạo unique key cho cache"""
-        # Chuẩn hóa trước khi tạo key để "đàn tranh" và "dan tranh" có cùng cache
-        normalized_instrument = normalize_text(instrument)
+        # Chuẩn hóa trước khi tạo key để "đàn tranh", "Dan Tranh", "dan tranhh" có cùng cache
+        inst = lookup_instrument(instrument)
+        normalized_instrument = inst.key if inst else normalize_text(instrument)
+        # 5 và 5.0 (vd duration đọc lại từ DB job) phải ra cùng key
+        if float(duration).is_integer():
+            duration = int(duration)
         key_string = f"{normalized_instrument}_{style}_{duration}"
         return hashlib.md5(key_string.encode()).hexdigest()
 
+    def cache_path(self, cache_key: str) -> str:
+        """Đường dẫn file cache local ứng với cache_key"""
+        return self.cache.path(cache_key)
+
+    def cached_file(self, cache_key: str) -> Optional[str]:
+        """File cache local của cache_key (tải từ cache dùng chung nếu cần), None nếu chưa có"""
+        return self.cache.ensure_local(cache_key)
+
     def _load_from_cache(self, cache_key: str) -> BytesIO:
-        """Load audio từ cache nếu có"""
-        cache_path = os.path.join(self.cache_dir, f"{cache_key}.wav")
-        if os.path.exists(cache_path):
-            with open(cache_path, 'rb') as f:
-                audio_io = BytesIO(f.read())
-                audio_io.seek(0)
-                logger.info(f"💾 Loaded from cache: {cache_key}")
-                return audio_io
+        """Load audio từ cache nếu có (local trước, rồi cache dùng chung)"""
+        data = self.cache.get(cache_key)
+        if data is not None:
+            audio_io = BytesIO(data)
+            audio_io.seek(0)
+            logger.info(f"💾 Loaded from cache: {cache_key}")
+            return audio_io
         return None
 
-    def _save_to_cache(self, cache_key: str, audio_io: BytesIO):
-        """Lưu audio vào cache"""
-        cache_path = os.path.join(self.cache_dir, f"{cache_key}.wav")
-        with open(cache_path, 'wb') as f:
-            f.write(audio_io.getvalue())
+    def _save_to_cache(self, cache_key: str, audio_io: BytesIO, instrument: Optional[str] = None,
+                       style: Optional[str] = None):
+        """
+        Lưu audio vào cache (local ngay, cache dùng chung ở nền) kèm peaks vẽ waveform
+        và embedding cho index fallback (gắn nhạc cụ/style nếu biết)
+        """
+        data = audio_io.getvalue()
+        self.cache.put(cache_key, data)
         logger.info(f"💾 Saved to cache: {cache_key}")
+        update_audio_cache_size(self.cache_dir)
+        try:
+            with time_stage(DEMO_STAGE_SECONDS, stage="waveform"):
+                store_for_wav(self.cache.path(cache_key), data)
+        except Exception as e:
+            # Thiếu peaks thì endpoint waveform tự tính lại, không làm hỏng request
+            logger.warning(f"⚠️ Không lưu được waveform cho {cache_key}: {str(e)}")
+        try:
+            self.content.publish(self.cache.path(cache_key), data)
+        except Exception as e:
+            logger.warning(f"⚠️ Không tạo được địa chỉ nội dung cho {cache_key}: {str(e)}")
+        try:
+            with time_stage(DEMO_STAGE_SECONDS, stage="embed"):
+                self.index.index_clip(self.cache.path(cache_key), data, instrument, style)
+        except Exception as e:
+            logger.warning(f"⚠️ Không index được {cache_key} cho fallback: {str(e)}")
 
-    def generate(self, instrument: str, style: str, duration: float) -> BytesIO:
+    def publish_clip(self, cache_key: str) -> Optional[str]:
         """
-        Generate audio cho nhạc cụ
-        instrument: có thể có dấu hoặc không dấu
+        Digest (địa chỉ nội dung) của clip trong cache local, None nếu clip không có ở local
+        Clip chép về từ cache dùng chung chưa có tên by-hash thì tạo luôn
+        """
+        if not self.use_cache:
+            return None
+        path = self.cache.path(cache_key)
+        try:
+            return self.content.publish(path)
+        except FileNotFoundError:
+            return None
+
+    def lookup_cached(self, instrument: str, style: str, duration: float) -> Tuple[Optional[BytesIO], Optional[str]]:
+        """
+        Trả về (audio, cache_key) có sẵn không cần chạy model, (None, None) nếu phải generate
+        cache_key là key của clip trong cache đã đọc; file mẫu đàn bầu cắt sẵn không nằm trong cache -> None
         """
         # Xử lý đặc biệt cho đàn bầu - trả về file mẫu 5s
-        normalized_instrument = normalize_text(instrument)
-        if normalized_instrument == "dan bau":
-            sample_path = os.path.join("samples", "dan_bau.mp3")
-            if os.path.exists(sample_path):
-                # Đọc file MP3 và cắt 5 giây
-                audio = AudioSegment.from_mp3(sample_path)
-                audio = audio[:5000]  # Cắt 5000ms = 5s
-                
-                audio_io = BytesIO()
-                audio.export(audio_io, format="wav")
-                audio_io.seek(0)
+        inst = lookup_instrument(instrument)
+        if inst is not None and inst.key == "dan bau":
+            sample_path = inst.sample_path
+            if sample_path:
+                with time_stage(DEMO_STAGE_SECONDS, stage="sample"), span("musicgen.sample", instrument=inst.key):
+                    # Đọc file MP3 và cắt 5 giây
+                    audio = AudioSegment.from_mp3(sample_path)
+                    audio = audio[:5000]  # Cắt 5000ms = 5s
+                    
+                    audio_io = BytesIO()
+                    audio.export(audio_io, format="wav")
+                    audio_io.seek(0)
                 logger.info("🎵 Trả về file mẫu đàn bầu (5s)")
-                return audio_io
+                return audio_io, None
 
-        # Kiểm tra cache trước
-        if self.use_cache:
+        if not self.use_cache:
+            return None, None
+
+        with time_stage(DEMO_STAGE_SECONDS, stage="cache_lookup"), span("musicgen.cache_lookup") as trace_span:
             cache_key = self._get_cache_key(instrument, style, duration)
             cached_audio = self._load_from_cache(cache_key)
+            if trace_span is not None:
+                trace_span.set_attribute("cache.hit", cached_audio is not None)
+        AUDIO_CACHE_REQUESTS.labels(result="hit" if cached_audio else "miss").inc()
+        return cached_audio, cache_key if cached_audio else None
+
+    def generate(self, instrument: str, style: str, duration: float,
+                 progress_callback: Optional[Callable[[int, int], None]] = None,
+                 check_cache: bool = True) -> BytesIO:
+        """
+        Generate audio cho nhạc cụ
+        instrument: có thể có dấu hoặc không dấu
+        progress_callback: gọi (số token đã sinh, max_new_tokens) sau mỗi bước generate
+        check_cache: False khi nơi gọi vừa tra lookup_cached() và bị miss
+        """
+        if check_cache:
+            cached_audio, _ = self.lookup_cached(instrument, style, duration)
             if cached_audio:
                 return cached_audio
 
-        prompt = self._build_prompt(instrument, style)
-        
         try:
+            return self._generate_clips([instrument], style, duration, progress_callback)[0]
+        except Exception as e:
+            logger.error(f"❌ Error generating audio for {instrument}: {str(e)}")
+            raise
+
+    @property
+    def sampling_rate(self) -> int:
+        return self.model.config.audio_encoder.sampling_rate
+
+    def _generate_clips(self, instruments: List[str], style: str, duration: float,
+                        progress_callback: Optional[Callable[[int, int], None]] = None) -> List[BytesIO]:
+        """
+        Chạy MusicGen 1 lần cho cả batch prompt (mỗi nhạc cụ 1 prompt), lưu từng clip vào cache
+        Trả về WAV của từng nhạc cụ theo đúng thứ tự
+        """
+        with time_stage(DEMO_STAGE_SECONDS, stage="prompt_encode"), span("musicgen.tokenize", batch=len(instruments)):
+            prompts = [self._build_prompt(instrument, style) for instrument in instruments]
             inputs = self.processor(
-                text=[prompt],
+                text=prompts,
                 padding=True,
                 return_tensors="pt"
             ).to(self.device)
@@ -241,8 +302,11 @@ class AIMusicGenerator:
                 inputs = {k: v.half() if v.dtype == torch.float32 else v 
                          for k, v in inputs.items()}
 
-            max_new_tokens = int(duration * 40)
-            
+        max_new_tokens = estimate_tokens(duration)
+        
+        with time_stage(DEMO_STAGE_SECONDS, stage="generate"), \
+                span("musicgen.generate", max_new_tokens=max_new_tokens, batch=len(instruments)):
+            streamer = _ProgressStreamer(max_new_tokens, progress_callback) if progress_callback else None
             with torch.no_grad():
                 audio_values = self.model.generate(
                     **inputs,
@@ -250,39 +314,73 @@ class AIMusicGenerator:
                     do_sample=True,
                     temperature=1.0,
                     top_k=250,
+                    streamer=streamer,
                 )
 
-            sampling_rate = self.model.config.audio_encoder.sampling_rate
-            audio_np = audio_values[0].cpu().numpy()
+        sampling_rate = self.sampling_rate
+        clips = []
+        for i, instrument in enumerate(instruments):
+            with time_stage(DEMO_STAGE_SECONDS, stage="postprocess"), span("audio.postprocess"):
+                # (batch, 1, samples) mono; fp16 trên GPU được đổi sang float32 ngay trong postprocess
+                audio_np = postprocess(audio_values[i, 0].cpu().numpy(), sampling_rate)
 
-            audio_np = np.nan_to_num(audio_np)
-            audio_np = (audio_np * 32767).astype(np.int16)
-
-            audio_segment = AudioSegment(
-                audio_np.tobytes(),
-                frame_rate=sampling_rate,
-                sample_width=2,
-                channels=1
-            )
-            
-            audio_io = BytesIO()
-            audio_segment.export(audio_io, format="wav")
-            audio_io.seek(0)
+            with time_stage(DEMO_STAGE_SECONDS, stage="encode"), span("audio.encode"):
+                audio_io = write_wav(audio_np, sampling_rate)
             
             if self.use_cache:
-                self._save_to_cache(cache_key, audio_io)
-                audio_io.seek(0)
-            
-            return audio_io
-            
+                with time_stage(DEMO_STAGE_SECONDS, stage="cache_save"), span("musicgen.cache_save"):
+                    self._save_to_cache(self._get_cache_key(instrument, style, duration), audio_io, instrument, style)
+                    audio_io.seek(0)
+            clips.append(audio_io)
+
+        return clips
+
+    def warmup(self, max_new_tokens: int = 8):
+        """Chạy thử model vài token (không lưu cache) để nạp kernel/bộ nhớ trước request đầu tiên"""
+        with time_stage(DEMO_STAGE_SECONDS, stage="warmup"), span("musicgen.warmup"):
+            inputs = self.processor(
+                text=[self._build_prompt("sao", "warm-up")],
+                padding=True,
+                return_tensors="pt"
+            ).to(self.device)
+            with torch.no_grad():
+                self.model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=True)
+        logger.info(f"🔥 MusicGen warm-up xong trên {self.device}")
+
+    def load_stem(self, instrument: str, style: str, duration: float) -> Optional[np.ndarray]:
+        """Clip AI đã có trong cache dưới dạng mono float32 ở sample rate của model, None nếu chưa có"""
+        if not self.use_cache:
+            return None
+        data = self.cache.get(self._get_cache_key(instrument, style, duration))
+        AUDIO_CACHE_REQUESTS.labels(result="hit" if data is not None else "miss").inc()
+        if data is None:
+            return None
+        audio, _ = read_wav(data)
+        return to_mono(audio)
+
+    def generate_batch(self, instruments: List[str], style: str, duration: float) -> List[np.ndarray]:
+        """
+        Generate nhiều nhạc cụ trong 1 lần gọi model (dùng cho ensemble), không tra cache
+        Mỗi clip vẫn được lưu cache riêng như khi gọi generate() lẻ
+        Trả về mono float32 ở sample rate của model, đúng thứ tự instruments
+        """
+        try:
+            clips = self._generate_clips(instruments, style, duration)
         except Exception as e:
-            logger.error(f"❌ Error generating audio for {instrument}: {str(e)}")
+            logger.error(f"❌ Error generating batch {instruments}: {str(e)}")
             raise
+        return [to_mono(read_wav(clip.getvalue())[0]) for clip in clips]
 
     def clear_cache(self):
-        """Xóa toàn bộ cache"""
-        if os.path.exists(self.cache_dir):
-            import shutil
-            shutil.rmtree(self.cache_dir)
-            os.makedirs(self.cache_dir)
+        """
+        Xóa toàn bộ clip trong cache local (cache dùng chung giữa các node giữ nguyên)
+        Tên by-hash/ của các clip này cũng bị xóa: URL /audio/<sha> cũ trả 404
+        """
+        if self.cache is not None:
+            self.cache.clear()
+            removed = self.content.prune()
+            logger.info(f"🗑️ Removed {removed} by-hash links")
+            update_audio_cache_size(self.cache_dir)
+            # Bỏ các clip vừa xóa khỏi index fallback
+            self.index.refresh()
             logger.info("🗑️ Cache cleared")
\ No newline at end of file
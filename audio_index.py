@@ -0,0 +1,280 @@
+# File: audio_index.py
+# Index embedding phổ (NumPy) của mọi clip đã có: file mẫu samples/ + clip trong audio_cache/
+# Khi không generate được (hàng đợi đầy, model chưa nạp, lỗi) /demo/ lấy clip gần nhất trong index trả ngay
+# Embedding lưu thành file <audio>.embed.json cạnh file audio (như peaks waveform), mỗi clip chỉ tính 1 lần
+import json
+import logging
+import os
+import tempfile
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from audio_processing import decode_file, read_wav, resample, to_mono
+from instruments import instrument_samples, lookup_instrument, normalize_text
+
+logger = logging.getLogger(__name__)
+
+EMBED_SAMPLE_RATE = 16000
+FRAME_SIZE = 1024
+HOP_SIZE = 512
+N_BANDS = 32
+# Frame nhỏ hơn frame to nhất quá chừng này (log10 năng lượng, 5 = 50 dB) coi là im lặng, bỏ qua
+SILENCE_RANGE = 5.0
+SIDECAR_SUFFIX = ".embed.json"
+CACHE_SUFFIX = ".wav"
+# Worker khác lưu clip mới: thread nền quét lại thư mục cache mỗi khoảng này (giây)
+REFRESH_SECONDS = float(os.getenv("DEMO_FALLBACK_REFRESH_SECONDS", "30"))
+
+MATCH_EXACT = "exact"            # Đúng nhạc cụ + style (khác thời lượng)
+MATCH_INSTRUMENT = "instrument"  # Đúng nhạc cụ, khác style (hoặc file mẫu)
+MATCH_FAMILY = "family"          # Cùng loại nhạc cụ (hơi/dây/gõ)
+MATCH_ANY = "any"                # Clip nghe giống nhất trong toàn bộ index
+
+
+def _band_edges() -> np.ndarray:
+    """Biên các dải tần chia theo thang log 60 Hz - 7.6 kHz, theo chỉ số bin FFT (dải trùng nhau ở tần thấp được gộp)"""
+    hz = np.geomspace(60.0, 7600.0, N_BANDS + 1)
+    return np.unique(np.round(hz * FRAME_SIZE / EMBED_SAMPLE_RATE).astype(np.int64))
+
+
+_BAND_EDGES = _band_edges()
+_WINDOW = np.hanning(FRAME_SIZE).astype(np.float32)
+
+
+def embed(audio: np.ndarray, sample_rate: int) -> np.ndarray:
+    """
+    Embedding âm sắc của 1 clip: trung bình + độ lệch chuẩn năng lượng log theo dải tần (bỏ frame im lặng)
+    Không phụ thuộc độ to (trừ trung bình), chuẩn hóa L2 để so bằng tích vô hướng (cosine)
+    """
+    mono = resample(to_mono(audio), sample_rate, EMBED_SAMPLE_RATE).astype(np.float32)
+    if mono.size < FRAME_SIZE:
+        mono = np.pad(mono, (0, FRAME_SIZE - mono.size))
+    frames = np.lib.stride_tricks.sliding_window_view(mono, FRAME_SIZE)[::HOP_SIZE] * _WINDOW
+    power = np.square(np.abs(np.fft.rfft(frames, axis=1)))[:, :_BAND_EDGES[-1]]
+    bands = np.log10(np.add.reduceat(power, _BAND_EDGES[:-1], axis=1) + 1e-10)
+
+    energy = np.log10(power.sum(axis=1) + 1e-10)
+    voiced = energy >= energy.max() - SILENCE_RANGE
+    bands = bands[voiced]
+
+    mean = bands.mean(axis=0)
+    vector = np.concatenate([mean - mean.mean(), bands.std(axis=0)]).astype(np.float32)
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm > 0 else vector
+
+
+@dataclass(frozen=True)
+class IndexEntry:
+    path: str
+    instrument: Optional[str]  # Khóa nhạc cụ chuẩn hóa, None = không rõ (bản hòa tấu, clip cũ)
+    style: Optional[str]       # Style chuẩn hóa, None = file mẫu ghi âm thật
+    duration: float
+    family: Optional[str] = None
+
+
+def _write_json(path: str, data: dict):
+    # Ghi file tạm rồi rename: worker khác không đọc phải JSON ghi dở
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".embed.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _read_json(path: str) -> Optional[dict]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _family(instrument: Optional[str]) -> Optional[str]:
+    inst = lookup_instrument(instrument, fuzzy=False) if instrument else None
+    return inst.family if inst else None
+
+
+class ClipIndex:
+    def __init__(self, cache_dir: str = "audio_cache", refresh_seconds: float = REFRESH_SECONDS):
+        """
+        Index clip gần nhất cho fallback
+        :param cache_dir: Thư mục cache audio AI (AIMusicGenerator truyền cache_dir của nó)
+        :param refresh_seconds: khoảng giữa 2 lần thread nền quét lại cache_dir (xem maintain())
+        """
+        self.cache_dir = cache_dir
+        self.refresh_seconds = refresh_seconds
+        self._entries: Dict[str, Tuple[IndexEntry, np.ndarray]] = {}  # path -> (entry, embedding)
+        self._snapshot: Optional[Tuple[List[IndexEntry], np.ndarray]] = None  # Ma trận dựng lại khi index đổi
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, entry: IndexEntry, vector: np.ndarray):
+        with self._lock:
+            self._entries[entry.path] = (entry, vector)
+            self._snapshot = None
+
+    def remove(self, path: str):
+        with self._lock:
+            if self._entries.pop(path, None) is not None:
+                self._snapshot = None
+
+    def _add_from_sidecar(self, path: str, meta: dict):
+        instrument = meta.get("instrument")
+        self.add(
+            IndexEntry(path, instrument, meta.get("style"), float(meta["duration_s"]), _family(instrument)),
+            np.asarray(meta["embedding"], dtype=np.float32),
+        )
+
+    def index_clip(self, path: str, data: bytes, instrument: Optional[str] = None,
+                   style: Optional[str] = None) -> IndexEntry:
+        """Thêm clip WAV vừa lưu vào cache (đã có sẵn bytes, không đọc lại file) và ghi embedding cạnh file"""
+        audio, sample_rate = read_wav(data)
+        meta = {
+            "instrument": instrument,
+            "style": normalize_text(style) if style else None,
+            "duration_s": round(audio.shape[-1] / sample_rate, 3),
+            "embedding": np.round(embed(audio, sample_rate).astype(np.float64), 5).tolist(),
+        }
+        _write_json(path + SIDECAR_SUFFIX, meta)
+        self._add_from_sidecar(path, meta)
+        return self._entries[path][0]
+
+    def _index_sample(self, instrument: str, family: str, path: str):
+        # Giải mã mp3 chậm: embedding được lưu lại, chỉ tính lại khi file mẫu bị thay
+        sidecar = path + SIDECAR_SUFFIX
+        meta = _read_json(sidecar)
+        if meta is None or os.path.getmtime(sidecar) < os.path.getmtime(path):
+            audio, sample_rate = decode_file(path)
+            meta = {
+                "duration_s": round(audio.shape[-1] / sample_rate, 3),
+                "embedding": np.round(embed(audio, sample_rate).astype(np.float64), 5).tolist(),
+            }
+            _write_json(sidecar, meta)
+        self.add(IndexEntry(path, instrument, None, float(meta["duration_s"]), family),
+                 np.asarray(meta["embedding"], dtype=np.float32))
+
+    def refresh(self, embed_missing: bool = False):
+        """
+        Đồng bộ với audio_cache/: thêm clip có embedding (do worker khác lưu), bỏ clip đã bị xóa
+        embed_missing = True: tính luôn embedding cho clip chưa có (clip cũ, chỉ dùng khi khởi động)
+        """
+        clips = set()
+        if os.path.isdir(self.cache_dir):
+            with os.scandir(self.cache_dir) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.name.endswith(CACHE_SUFFIX) and not entry.name.startswith("."):
+                        clips.add(entry.path)
+
+        with self._lock:
+            known = set(self._entries)
+        for path in clips - known:
+            meta = _read_json(path + SIDECAR_SUFFIX)
+            try:
+                if meta is not None:
+                    self._add_from_sidecar(path, meta)
+                elif embed_missing:
+                    with open(path, "rb") as f:
+                        self.index_clip(path, f.read())
+            except Exception as e:
+                logger.warning(f"⚠️ Không index được {path}: {str(e)}")
+
+        cache_root = os.path.abspath(self.cache_dir)
+        for path in known - clips:
+            if os.path.dirname(os.path.abspath(path)) == cache_root and path not in clips:
+                self.remove(path)
+
+    def build(self) -> int:
+        """Index file mẫu + toàn bộ cache (gọi ở thread nền khi khởi động), trả về số clip trong index"""
+        for inst, path in instrument_samples():
+            try:
+                self._index_sample(inst.key, inst.family, path)
+            except Exception as e:
+                logger.warning(f"⚠️ Không index được file mẫu {path}: {str(e)}")
+        self.refresh(embed_missing=True)
+        logger.info(f"🗂️ Clip index ready: {len(self)} clips")
+        return len(self)
+
+    def maintain(self, stop: Optional[threading.Event] = None):
+        """
+        Chạy ở thread nền: build() rồi quét lại cache_dir mỗi refresh_seconds đến khi stop được set
+        Request tìm clip (nearest) không bao giờ phải quét thư mục
+        """
+        stop = stop or threading.Event()
+        self.build()
+        while not stop.wait(self.refresh_seconds):
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warning(f"⚠️ Không quét lại được {self.cache_dir}: {str(e)}")
+
+    def _matrix(self) -> Tuple[List[IndexEntry], np.ndarray]:
+        with self._lock:
+            if self._snapshot is None:
+                entries = [entry for entry, _ in self._entries.values()]
+                vectors = [vector for _, vector in self._entries.values()]
+                self._snapshot = (entries, np.stack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32))
+            return self._snapshot
+
+    def nearest(self, instrument: str, style: str,
+                duration: Optional[float] = None) -> Optional[Tuple[IndexEntry, str]]:
+        """
+        Clip gần nhất cho (nhạc cụ, style): ưu tiên đúng nhạc cụ + style, rồi đúng nhạc cụ, cùng loại, bất kỳ
+        Trong cùng mức, xếp theo độ giống (cosine) với trung bình embedding của nhạc cụ và của style được yêu cầu
+        Trả về (clip, mức khớp), None nếu index rỗng
+        """
+        entries, matrix = self._matrix()
+        if not entries:
+            return None
+
+        style = normalize_text(style)
+        family = _family(instrument)
+        is_instrument = np.array([e.instrument == instrument for e in entries])
+        is_style = np.array([e.style == style for e in entries])
+        is_family = np.array([family is not None and e.family == family for e in entries])
+
+        centroids = [matrix[mask].mean(axis=0) for mask in (is_instrument, is_style) if mask.any()]
+        query = sum(c / (np.linalg.norm(c) or 1.0) for c in centroids) if centroids else None
+        similarity = matrix @ query if query is not None else np.zeros(len(entries), dtype=np.float32)
+        gaps = np.array([abs(e.duration - duration) if duration else 0.0 for e in entries])
+
+        tiers = (
+            (MATCH_EXACT, is_instrument & is_style),
+            (MATCH_INSTRUMENT, is_instrument),
+            (MATCH_FAMILY, is_family),
+            (MATCH_ANY, np.ones(len(entries), dtype=bool)),
+        )
+        for match, mask in tiers:
+            candidates = np.flatnonzero(mask)
+            if candidates.size == 0:
+                continue
+            if match == MATCH_EXACT:
+                # Cùng nhạc cụ + style: thời lượng gần nhất trước
+                order = candidates[np.lexsort((-similarity[candidates], gaps[candidates]))]
+            else:
+                order = candidates[np.lexsort((gaps[candidates], -similarity[candidates]))]
+            for i in order:
+                if os.path.exists(entries[i].path):
+                    return entries[i], match
+                # Clip đã bị xóa khỏi cache (clear-cache, dọn dung lượng)
+                self.remove(entries[i].path)
+        return None
+
+    def stats(self) -> dict:
+        entries, _ = self._matrix()
+        return {
+            "clips": len(entries),
+            "samples": sum(1 for e in entries if e.style is None and e.instrument is not None),
+            "tagged": sum(1 for e in entries if e.instrument is not None),
+            "instruments": len({e.instrument for e in entries if e.instrument}),
+        }
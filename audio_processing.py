@@ -0,0 +1,188 @@
+# File: audio_processing.py
+# Hậu xử lý audio bằng NumPy (vectorized, in-place) và ghi WAV PCM 16-bit không cần pydub/ffmpeg
+import os
+import struct
+import wave
+from io import BytesIO
+from typing import Sequence, Tuple
+
+import numpy as np
+
+# "peak": đưa đỉnh về PEAK_TARGET_DB; "loudness": đưa RMS về LOUDNESS_TARGET_DB (đỉnh vượt thì soft clip)
+NORMALIZE_MODE = os.getenv("AUDIO_NORMALIZE_MODE", "peak")
+PEAK_TARGET_DB = -1.0
+LOUDNESS_TARGET_DB = -20.0
+# Ngưỡng bắt đầu nén mềm (biên độ tuyệt đối), phần trên ngưỡng được ép về dưới 1.0 bằng tanh
+# Chỉ có tác dụng ở chế độ "loudness": chế độ "peak" đưa đỉnh về -1 dBFS (~0.891) < knee nên không bao giờ cần nén
+SOFT_CLIP_KNEE = 0.9
+FADE_MS = 15.0
+
+WAV_HEADER_SIZE = 44
+
+
+def _db_to_gain(db: float) -> float:
+    return float(10.0 ** (db / 20.0))
+
+
+def sanitize(audio: np.ndarray) -> np.ndarray:
+    """Thay NaN/Inf bằng 0 và bỏ DC offset (in-place)"""
+    np.nan_to_num(audio, copy=False, nan=0.0, posinf=0.0, neginf=0.0)
+    audio -= audio.mean(axis=-1, keepdims=True)
+    return audio
+
+
+def normalize(audio: np.ndarray, mode: str = NORMALIZE_MODE) -> np.ndarray:
+    """Chuẩn hóa theo đỉnh hoặc theo độ to (RMS), in-place"""
+    if mode == "loudness":
+        rms = float(np.sqrt(np.mean(np.square(audio, dtype=np.float64))))
+        if rms > 1e-6:
+            audio *= _db_to_gain(LOUDNESS_TARGET_DB) / rms
+    else:
+        peak = float(np.max(np.abs(audio))) if audio.size else 0.0
+        if peak > 1e-6:
+            audio *= _db_to_gain(PEAK_TARGET_DB) / peak
+    return audio
+
+
+def soft_clip(audio: np.ndarray, knee: float = SOFT_CLIP_KNEE) -> np.ndarray:
+    """
+    Nén mềm phần biên độ vượt knee bằng tanh, kết quả luôn nằm trong (-1, 1)
+    Thay cho việc ép kiểu int16 trực tiếp (đỉnh > 1.0 bị tràn số, đảo dấu)
+    """
+    magnitude = np.abs(audio)
+    over = magnitude > knee
+    if np.any(over):
+        headroom = 1.0 - knee
+        compressed = knee + headroom * np.tanh((magnitude[over] - knee) / headroom)
+        audio[over] = np.copysign(compressed, audio[over]).astype(audio.dtype, copy=False)
+    return audio
+
+
+def apply_fades(audio: np.ndarray, sample_rate: int, fade_ms: float = FADE_MS) -> np.ndarray:
+    """Fade-in/fade-out tuyến tính ngắn ở 2 đầu để tránh tiếng click, in-place"""
+    n = min(int(sample_rate * fade_ms / 1000), audio.shape[-1] // 2)
+    if n > 1:
+        ramp = np.linspace(0.0, 1.0, n, dtype=audio.dtype)
+        audio[..., :n] *= ramp
+        audio[..., -n:] *= ramp[::-1]
+    return audio
+
+
+def postprocess(audio: np.ndarray, sample_rate: int, mode: str = NORMALIZE_MODE) -> np.ndarray:
+    """
+    Toàn bộ hậu xử lý cho output model: sanitize -> normalize -> soft clip (chỉ chế độ loudness) -> fade
+    audio: shape (samples,) hoặc (channels, samples); chỉ copy nếu chưa phải float32
+    """
+    audio = np.asarray(audio, dtype=np.float32)
+    if not audio.flags.writeable:
+        audio = audio.copy()
+    sanitize(audio)
+    normalize(audio, mode)
+    if mode == "loudness":
+        # Chuẩn hóa theo RMS có thể đẩy đỉnh vượt 1.0; theo đỉnh thì đỉnh đã nằm dưới knee, bỏ qua 1 lượt quét
+        soft_clip(audio)
+    apply_fades(audio, sample_rate)
+    return audio
+
+
+def read_wav(data: bytes) -> Tuple[np.ndarray, int]:
+    """
+    Đọc WAV PCM 16-bit (vd file trong cache) -> (audio float32 shape (channels, samples), sample_rate)
+    """
+    with wave.open(BytesIO(data), "rb") as wav:
+        channels = wav.getnchannels()
+        sample_width = wav.getsampwidth()
+        sample_rate = wav.getframerate()
+        frames = wav.readframes(wav.getnframes())
+    if sample_width != 2:
+        raise ValueError(f"Chỉ hỗ trợ WAV 16-bit, file có {sample_width * 8}-bit")
+    pcm = np.frombuffer(frames, dtype="<i2").reshape(-1, channels).T
+    return pcm.astype(np.float32) / 32768.0, sample_rate
+
+
+def decode_file(path: str) -> Tuple[np.ndarray, int]:
+    """
+    Đọc file audio -> (float32 shape (channels, samples), sample_rate)
+    WAV đọc thẳng bằng NumPy; định dạng nén (mp3 trong samples/) cần pydub + ffmpeg
+    """
+    if path.lower().endswith(".wav"):
+        with open(path, "rb") as f:
+            return read_wav(f.read())
+
+    from pydub import AudioSegment
+
+    segment = AudioSegment.from_file(path)
+    pcm = np.array(segment.get_array_of_samples(), dtype=np.float32)
+    pcm = pcm.reshape(-1, segment.channels).T / float(1 << (8 * segment.sample_width - 1))
+    return pcm, segment.frame_rate
+
+
+def to_mono(audio: np.ndarray) -> np.ndarray:
+    """(channels, samples) -> (samples,) bằng trung bình các kênh"""
+    if audio.ndim == 1:
+        return audio
+    return audio.mean(axis=0, dtype=np.float32)
+
+
+def resample(audio: np.ndarray, sr_from: int, sr_to: int) -> np.ndarray:
+    """Đổi sample rate bằng nội suy tuyến tính (đủ cho demo nghe thử), audio mono"""
+    if sr_from == sr_to or audio.size == 0:
+        return audio
+    n_out = int(round(audio.shape[-1] * sr_to / sr_from))
+    positions = np.arange(n_out, dtype=np.float64) * (sr_from / sr_to)
+    return np.interp(positions, np.arange(audio.shape[-1]), audio).astype(np.float32)
+
+
+def fit_length(audio: np.ndarray, n_samples: int) -> np.ndarray:
+    """Cắt hoặc thêm im lặng ở cuối cho đủ n_samples"""
+    if audio.shape[-1] >= n_samples:
+        return audio[..., :n_samples]
+    pad = [(0, 0)] * (audio.ndim - 1) + [(0, n_samples - audio.shape[-1])]
+    return np.pad(audio, pad)
+
+
+def mix_stems(stems: np.ndarray, gains_db: Sequence[float], pans: Sequence[float]) -> np.ndarray:
+    """
+    Trộn k stem mono (shape (k, samples)) thành stereo (2, samples) bằng 1 phép nhân ma trận
+    pan trong [-1, 1] (trái -> phải), constant-power: L = cos(θ), R = sin(θ), θ = (pan + 1)·π/4
+    """
+    gains = np.power(10.0, np.asarray(gains_db, dtype=np.float64) / 20.0)
+    theta = (np.clip(np.asarray(pans, dtype=np.float64), -1.0, 1.0) + 1.0) * (np.pi / 4)
+    weights = np.stack([gains * np.cos(theta), gains * np.sin(theta)]).astype(np.float32)
+    return weights @ stems
+
+
+def write_wav(audio: np.ndarray, sample_rate: int) -> BytesIO:
+    """
+    Ghi WAV PCM 16-bit thẳng vào buffer của BytesIO đã cấp phát đủ kích thước (không copy thêm)
+    audio: float trong [-1, 1], shape (samples,) hoặc (channels, samples)
+    """
+    if audio.ndim == 1:
+        audio = audio[np.newaxis, :]
+    channels, n_samples = audio.shape
+    data_size = n_samples * channels * 2
+
+    audio_io = BytesIO()
+    audio_io.seek(WAV_HEADER_SIZE + data_size - 1)
+    audio_io.write(b"\0")
+
+    buffer = audio_io.getbuffer()
+    try:
+        struct.pack_into(
+            "<4sI4s4sIHHIIHH4sI", buffer, 0,
+            b"RIFF", WAV_HEADER_SIZE - 8 + data_size, b"WAVE",
+            b"fmt ", 16, 1, channels, sample_rate, sample_rate * channels * 2, channels * 2, 16,
+            b"data", data_size,
+        )
+        # View int16 (little-endian) lên vùng data, interleave kênh: (samples, channels)
+        pcm = np.frombuffer(buffer, dtype="<i2", count=n_samples * channels, offset=WAV_HEADER_SIZE)
+        pcm = pcm.reshape(n_samples, channels)
+        scaled = audio.T * 32767.0
+        np.rint(scaled, out=scaled)
+        np.clip(scaled, -32768, 32767, out=pcm, casting="unsafe")
+        del pcm
+    finally:
+        buffer.release()
+
+    audio_io.seek(0)
+    return audio_io
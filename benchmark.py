@@ -0,0 +1,300 @@
+# File: benchmark.py
+# Benchmark offline cho API: chạy app FastAPI trong process với Gemini giả + MusicGen giả
+# Đo latency p50/p95/p99 và requests/giây cho từng route, xuất JSON để so sánh giữa các bản build
+#
+# Ví dụ:
+#   python benchmark.py --concurrency 16 --requests 200 --output bench.json
+#   python benchmark.py --scenarios demo_sample,demo_cache_hit --compare bench.json
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+# Không load MusicGen thật khi import routes.demo_audio, job lưu ở DB tạm
+os.environ["AI_MUSIC_ENABLED"] = "0"
+os.environ.setdefault("JOBS_DB", os.path.join(tempfile.mkdtemp(prefix="bench_jobs_"), "jobs.db"))
+
+import httpx
+import torch
+
+import utils
+import routes.consultation as consultation_routes
+import routes.demo_audio as demo_routes
+from ai_music import AIMusicGenerator
+from main import app
+
+
+class FakeGeminiResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeGeminiModel:
+    """Gemini giả: trả lời cố định sau một khoảng trễ cấu hình được"""
+
+    def __init__(self, latency_ms: float):
+        self.latency_ms = latency_ms
+        self.calls = 0
+
+    async def generate_content_async(self, prompt: str) -> FakeGeminiResponse:
+        self.calls += 1
+        await asyncio.sleep(self.latency_ms / 1000)
+        return FakeGeminiResponse(
+            "Bạn mới học sáo trúc? Nên chọn sáo tone D, tre già giá 350k, dễ thổi, âm ấm, kèm giáo trình cơ bản."
+        )
+
+
+class FakeMusicgenConfig:
+    class audio_encoder:
+        sampling_rate = 32000
+
+
+class FakeInputs(dict):
+    def to(self, device):
+        return self
+
+
+class FakeMusicgenProcessor:
+    def __call__(self, text, padding=True, return_tensors="pt"):
+        return FakeInputs(input_ids=torch.zeros((len(text), 8), dtype=torch.long))
+
+
+class FakeMusicgenModel:
+    """MusicGen giả: tốn token_latency_ms mỗi token, trả về nhiễu nhỏ đúng độ dài"""
+
+    config = FakeMusicgenConfig
+
+    def __init__(self, token_latency_ms: float):
+        self.token_latency_ms = token_latency_ms
+
+    def generate(self, input_ids=None, max_new_tokens: int = 256, streamer=None, **kwargs):
+        if streamer is None:
+            time.sleep(max_new_tokens * self.token_latency_ms / 1000)
+        else:
+            streamer.put(input_ids)
+            for _ in range(max_new_tokens):
+                time.sleep(self.token_latency_ms / 1000)
+                streamer.put(None)
+            streamer.end()
+        # MusicGen: 50 frame/giây ở 32kHz -> 640 sample/token
+        n_samples = max_new_tokens * 640
+        return torch.rand((input_ids.shape[0], 1, n_samples)) * 0.5 - 0.25
+
+
+class FakeAIMusicGenerator(AIMusicGenerator):
+    """AIMusicGenerator dùng model giả, cache ở thư mục tạm"""
+
+    def __init__(self, cache_dir: str, token_latency_ms: float):
+        self.token_latency_ms = token_latency_ms
+        super().__init__(device="cpu", use_cache=True, cache_dir=cache_dir)
+
+    def _load_model(self):
+        self.processor = FakeMusicgenProcessor()
+        self.model = FakeMusicgenModel(self.token_latency_ms)
+
+
+async def fake_fetch_courses():
+    return [
+        {"courseId": 1, "title": "Sáo trúc cho người mới bắt đầu", "price": 299000, "stock": 10,
+         "category": {"name": "Nhạc cụ hơi"}, "level": {"name": "Cơ bản"}},
+        {"courseId": 2, "title": "Piano điện Donner DDP-200", "price": 8990000, "stock": 3,
+         "category": {"name": "Phím"}, "level": {"name": "Trung cấp"}},
+        {"courseId": 3, "title": "Trống Cajon Meinl MCAJ100", "price": 2490000, "stock": 5,
+         "category": {"name": "Gõ"}, "level": {"name": "Cơ bản"}},
+        {"courseId": 4, "title": "Đàn guitar acoustic", "price": 1590000, "stock": 0,
+         "category": {"name": "Dây"}, "level": {"name": "Cơ bản"}},
+    ]
+
+
+def _chat(query: str) -> Callable[[int], dict]:
+    return lambda i: {"query": query, "history": [{"user": "Tôi mới học, ngân sách dưới 500k", "ai": "OK"}]}
+
+
+# Mỗi kịch bản: (method, path, body_factory(i) hoặc None, cần warm-up hay không)
+SCENARIOS: Dict[str, tuple] = {
+    "root": ("GET", "/", None, False),
+    "company_info": ("GET", "/company-info/", None, False),
+    "consultation": ("POST", "/consultation/", _chat("Tôi muốn học sáo trúc"), False),
+    "consultation_quick": ("POST", "/consultation/quick", lambda i: {
+        "level": "mới học", "budget": "dưới 500k", "purpose": "học", "instrument_type": "hơi"}, False),
+    "guide": ("POST", "/guide/", _chat("Cách thổi sáo trúc"), False),
+    "story": ("POST", "/story/", _chat("Kể về nguồn gốc đàn bầu"), False),
+    "support": ("POST", "/support/", _chat("Giao hàng mất bao lâu?"), False),
+    "batch_chat_10": ("POST", "/batch/chat", lambda i: {
+        "items": [{"intent": "story", "query": f"Kể về đàn tranh {j}"} for j in range(10)],
+        "concurrency": 10}, False),
+    "demo_sample": ("POST", "/demo/", lambda i: {"product": "sáo", "use_ai": False}, False),
+    "demo_cache_hit": ("POST", "/demo/", lambda i: {
+        "product": "đàn tranh", "use_ai": True, "style": "benchmark cache", "duration": 5}, True),
+    # Style khác nhau mỗi request -> luôn cache miss
+    "demo_cold": ("POST", "/demo/", lambda i: {
+        "product": "đàn nguyệt", "use_ai": True, "style": f"benchmark cold {time.time_ns()} {i}", "duration": 3}, False),
+    # 1/4 request là clip dài 30s: p50 của clip ngắn không được tăng theo
+    "demo_cold_mixed": ("POST", "/demo/", lambda i: {
+        "product": "đàn nguyệt", "use_ai": True, "style": f"benchmark mixed {time.time_ns()} {i}",
+        "duration": 30 if i % 4 == 0 else 3}, False),
+    # 3 nhạc cụ chưa có trong cache -> 1 lần generate batch + trộn
+    "demo_ensemble_cold": ("POST", "/demo/ensemble", lambda i: {
+        "stems": [{"product": p, "pan": pan} for p, pan in (("đàn tranh", -0.6), ("sáo", 0.6), ("đàn bầu", 0))],
+        "use_samples": False, "style": f"benchmark ensemble {time.time_ns()} {i}", "duration": 3}, False),
+    "demo_job_submit": ("POST", "/demo/jobs/", lambda i: {
+        "product": "đàn nhị", "use_ai": True, "style": f"benchmark job {time.time_ns()} {i}", "duration": 3}, False),
+}
+
+COLD_SCENARIOS = {"demo_cold", "demo_cold_mixed", "demo_ensemble_cold"}
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Percentile kiểu nearest-rank trên list đã sort"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def _client_for(worker_id: int) -> httpx.AsyncClient:
+    """Mỗi worker là 1 client riêng: giới hạn số việc chờ tính theo địa chỉ peer nên mỗi worker 1 IP giả"""
+    transport = httpx.ASGITransport(app=app, client=(f"10.0.{worker_id // 256}.{worker_id % 256 + 1}", 50000))
+    return httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None)
+
+
+async def run_scenario(name: str, total: int, concurrency: int) -> dict:
+    method, path, body_factory, needs_warmup = SCENARIOS[name]
+
+    if needs_warmup:
+        async with _client_for(0) as client:
+            await client.request(method, path, json=body_factory(0) if body_factory else None)
+
+    latencies: List[float] = []
+    errors = 0
+    counter = iter(range(total))
+
+    async def worker(worker_id: int):
+        nonlocal errors
+        async with _client_for(worker_id) as client:
+            for i in counter:
+                body = body_factory(i) if body_factory else None
+                start = time.perf_counter()
+                try:
+                    response = await client.request(method, path, json=body)
+                    await response.aread()
+                    if response.status_code >= 400:
+                        errors += 1
+                except Exception:
+                    errors += 1
+                latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(w) for w in range(concurrency)))
+    wall_s = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": total,
+        "concurrency": concurrency,
+        "errors": errors,
+        "wall_s": round(wall_s, 4),
+        "rps": round(total / wall_s, 2) if wall_s > 0 else None,
+        "latency_ms": {
+            "min": round(latencies[0], 3),
+            "mean": round(sum(latencies) / len(latencies), 3),
+            "p50": round(percentile(latencies, 50), 3),
+            "p95": round(percentile(latencies, 95), 3),
+            "p99": round(percentile(latencies, 99), 3),
+            "max": round(latencies[-1], 3),
+        },
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return None
+
+
+def compare(current: dict, baseline: dict, threshold_pct: float) -> List[str]:
+    """So sánh p95 với bản baseline, trả về danh sách kịch bản chậm đi quá threshold_pct"""
+    regressions = []
+    for name, result in current["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            continue
+        old_p95 = base["latency_ms"]["p95"]
+        new_p95 = result["latency_ms"]["p95"]
+        if old_p95 > 0 and (new_p95 - old_p95) / old_p95 * 100 > threshold_pct:
+            regressions.append(f"{name}: p95 {old_p95}ms -> {new_p95}ms")
+    return regressions
+
+
+async def main(args) -> dict:
+    cache_dir = tempfile.mkdtemp(prefix="bench_audio_cache_")
+
+    utils.gemini_model = FakeGeminiModel(args.gemini_latency_ms)
+    consultation_routes.fetch_courses = fake_fetch_courses
+    demo_routes.ai_generator = FakeAIMusicGenerator(cache_dir, args.token_latency_ms)
+
+    names = args.scenarios.split(",") if args.scenarios else list(SCENARIOS)
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        raise SystemExit(f"Kịch bản không tồn tại: {', '.join(unknown)}")
+
+    results = {}
+    async with app.router.lifespan_context(app):
+        for name in names:
+            # Kịch bản generate thật chậm -> giảm số request
+            total = args.cold_requests if name in COLD_SCENARIOS else args.requests
+            results[name] = await run_scenario(name, total, args.concurrency)
+            print(f"{name:20s} p50={results[name]['latency_ms']['p50']:>9.2f}ms "
+                  f"p95={results[name]['latency_ms']['p95']:>9.2f}ms rps={results[name]['rps']}",
+                  file=sys.stderr)
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "concurrency": args.concurrency,
+            "gemini_latency_ms": args.gemini_latency_ms,
+            "token_latency_ms": args.token_latency_ms,
+        },
+        "scenarios": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark offline cho Music Instrument Sales AI API")
+    parser.add_argument("--concurrency", type=int, default=8, help="Số request đồng thời")
+    parser.add_argument("--requests", type=int, default=200, help="Số request mỗi kịch bản")
+    parser.add_argument("--cold-requests", type=int, default=20, help="Số request cho các kịch bản generate thật (demo_cold...)")
+    parser.add_argument("--gemini-latency-ms", type=float, default=50.0, help="Độ trễ Gemini giả")
+    parser.add_argument("--token-latency-ms", type=float, default=0.5, help="Thời gian sinh 1 token của MusicGen giả")
+    parser.add_argument("--scenarios", default="", help=f"Danh sách kịch bản, cách nhau dấu phẩy: {','.join(SCENARIOS)}")
+    parser.add_argument("--output", default="", help="Ghi kết quả JSON ra file (mặc định: stdout)")
+    parser.add_argument("--compare", default="", help="File JSON baseline để phát hiện regression")
+    parser.add_argument("--threshold", type=float, default=20.0, help="Ngưỡng % p95 chậm đi để báo regression")
+    args = parser.parse_args()
+
+    report = asyncio.run(main(args))
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print("❌ Regression:\n" + "\n".join(regressions), file=sys.stderr)
+            sys.exit(1)
+        print("✅ Không có regression", file=sys.stderr)
@@ -0,0 +1,365 @@
+# File: cache_backends.py
+# Backend cho cache audio: thư mục local, thư mục mạng dùng chung, key-value server (Redis)
+# TieredCache ghép local + backend dùng chung: đọc xuyên (read-through), ghi sau (write-behind)
+import logging
+import os
+import queue
+import socket
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Iterator, Optional, Tuple
+
+from metrics import AUDIO_CACHE_REMOTE_REQUESTS, AUDIO_CACHE_WRITE_BEHIND_PENDING
+
+logger = logging.getLogger(__name__)
+
+CACHE_SUFFIX = ".wav"
+
+
+class CacheBackend(ABC):
+    """Interface chung: lưu bytes audio theo cache key"""
+
+    name = "base"
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        ...
+
+    @abstractmethod
+    def put(self, key: str, data: bytes):
+        ...
+
+    def exists(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+
+    @abstractmethod
+    def clear(self):
+        ...
+
+    @abstractmethod
+    def keys(self) -> Iterator[str]:
+        ...
+
+
+class LocalFSBackend(CacheBackend):
+    """Mỗi key là 1 file <key>.wav trong thư mục (mặc định audio_cache/)"""
+
+    name = "local"
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}{CACHE_SUFFIX}")
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self.path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.path(key))
+
+    def put(self, key: str, data: bytes):
+        # Ghi file tạm rồi rename: người đọc không bao giờ thấy file ghi dở
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=f".{key}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self.path(key))
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def delete(self, key: str):
+        """Xóa clip và các file đi kèm của nó (<key>.wav.peaks.json, .embed.json, .prefetched...)"""
+        path = self.path(key)
+        sidecar_prefix = os.path.basename(path) + "."
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.startswith(sidecar_prefix):
+                    try:
+                        os.unlink(entry.path)
+                    except FileNotFoundError:
+                        pass
+
+    def clear(self):
+        """
+        Xóa mọi clip (kèm file đi kèm), không đụng thư mục con
+        Tên by-hash/ của clip đã xóa do ContentStore.prune() dọn (AIMusicGenerator.clear_cache)
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.name.startswith("."):
+                    continue
+                # Clip <key>.wav và file đi kèm <key>.wav.*
+                if entry.name.endswith(CACHE_SUFFIX) or CACHE_SUFFIX + "." in entry.name:
+                    try:
+                        os.unlink(entry.path)
+                    except FileNotFoundError:
+                        pass
+
+    def keys(self) -> Iterator[str]:
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith(CACHE_SUFFIX) and not entry.name.startswith("."):
+                    yield entry.name[:-len(CACHE_SUFFIX)]
+
+    def stats(self) -> Tuple[int, int]:
+        """(số file, tổng dung lượng bytes)"""
+        files = 0
+        size = 0
+        for key in self.keys():
+            try:
+                size += os.path.getsize(self.path(key))
+                files += 1
+            except FileNotFoundError:
+                pass
+        return files, size
+
+
+class SharedDirBackend(LocalFSBackend):
+    """
+    Thư mục mạng dùng chung giữa các node (NFS/SMB...)
+    Nhiều node cùng ghi 1 key: node lấy được file khóa <key>.lock ghi, các node khác bỏ qua
+    """
+
+    name = "shared"
+
+    # Khóa cũ hơn thời gian này coi như node ghi đã chết
+    LOCK_STALE_SECONDS = 300
+
+    def _lock_path(self, key: str) -> str:
+        return os.path.join(self.directory, f".{key}.lock")
+
+    def _acquire(self, key: str) -> bool:
+        lock_path = self._lock_path(key)
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) < self.LOCK_STALE_SECONDS:
+                    return False
+                os.unlink(lock_path)
+            except FileNotFoundError:
+                pass
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                return False
+        with os.fdopen(fd, "w") as f:
+            f.write(f"{socket.gethostname()}:{os.getpid()}")
+        return True
+
+    def put(self, key: str, data: bytes):
+        if self.exists(key):
+            return
+        if not self._acquire(key):
+            logger.info(f"🔒 Node khác đang ghi {key}, bỏ qua")
+            return
+        try:
+            super().put(key, data)
+        finally:
+            try:
+                os.unlink(self._lock_path(key))
+            except FileNotFoundError:
+                pass
+
+
+class KeyValueBackend(CacheBackend):
+    """
+    Key-value server tương thích Redis (Redis, KeyDB, Valkey, hoặc fakeredis khi test)
+    Cần cài thêm: pip install redis
+    """
+
+    name = "redis"
+
+    def __init__(self, url: Optional[str] = None, client=None, prefix: str = "audio_cache:",
+                 ttl_seconds: Optional[int] = None):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise RuntimeError("Backend redis cần package 'redis' (pip install redis)")
+            client = redis.Redis.from_url(url or "redis://localhost:6379/0")
+        self.client = client
+        self.prefix = prefix
+        self.ttl_seconds = ttl_seconds
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}{key}"
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.client.get(self._key(key))
+
+    def exists(self, key: str) -> bool:
+        return bool(self.client.exists(self._key(key)))
+
+    def put(self, key: str, data: bytes):
+        # nx=True: nhiều node ghi cùng key thì giữ bản đầu tiên
+        self.client.set(self._key(key), data, ex=self.ttl_seconds, nx=True)
+
+    def delete(self, key: str):
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        for redis_key in self.client.scan_iter(match=f"{self.prefix}*"):
+            self.client.delete(redis_key)
+
+    def keys(self) -> Iterator[str]:
+        for redis_key in self.client.scan_iter(match=f"{self.prefix}*"):
+            if isinstance(redis_key, bytes):
+                redis_key = redis_key.decode()
+            yield redis_key[len(self.prefix):]
+
+
+class TieredCache:
+    """
+    Cache 2 tầng: local (luôn có, dùng để trả file) + remote dùng chung (tùy chọn)
+    - get: local trước, miss thì đọc remote rồi chép về local (read-through)
+    - put: ghi local ngay, đẩy lên remote bằng thread nền (write-behind)
+    """
+
+    def __init__(self, local: LocalFSBackend, remote: Optional[CacheBackend] = None, write_behind: bool = True):
+        self.local = local
+        self.remote = remote
+        self.write_behind = write_behind
+        self._pending: "queue.Queue" = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        self._writer_lock = threading.Lock()
+
+    @property
+    def directory(self) -> str:
+        return self.local.directory
+
+    def path(self, key: str) -> str:
+        return self.local.path(key)
+
+    def get(self, key: str) -> Optional[bytes]:
+        data = self.local.get(key)
+        if data is not None or self.remote is None:
+            return data
+
+        try:
+            data = self.remote.get(key)
+        except Exception as e:
+            logger.error(f"❌ Lỗi đọc cache {self.remote.name}: {str(e)}")
+            AUDIO_CACHE_REMOTE_REQUESTS.labels(result="error").inc()
+            return None
+
+        AUDIO_CACHE_REMOTE_REQUESTS.labels(result="hit" if data is not None else "miss").inc()
+        if data is not None:
+            self.local.put(key, data)
+            logger.info(f"🌐 Loaded from {self.remote.name} cache: {key}")
+        return data
+
+    def ensure_local(self, key: str) -> Optional[str]:
+        """Đường dẫn file local của key (tải từ remote nếu cần), None nếu không có ở đâu cả"""
+        if self.local.exists(key) or self.get(key) is not None:
+            return self.path(key)
+        return None
+
+    def exists(self, key: str) -> bool:
+        if self.local.exists(key):
+            return True
+        if self.remote is None:
+            return False
+        try:
+            return self.remote.exists(key)
+        except Exception as e:
+            logger.error(f"❌ Lỗi kiểm tra cache {self.remote.name}: {str(e)}")
+            return False
+
+    def put(self, key: str, data: bytes):
+        self.local.put(key, data)
+        if self.remote is None:
+            return
+        if self.write_behind:
+            self._ensure_writer()
+            AUDIO_CACHE_WRITE_BEHIND_PENDING.inc()
+            self._pending.put((key, data))
+        else:
+            self._put_remote(key, data)
+
+    def _put_remote(self, key: str, data: bytes):
+        try:
+            self.remote.put(key, data)
+        except Exception as e:
+            logger.error(f"❌ Lỗi ghi cache {self.remote.name}: {str(e)}")
+            AUDIO_CACHE_REMOTE_REQUESTS.labels(result="write_error").inc()
+
+    def _ensure_writer(self):
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="cache-write-behind", daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            key, data = self._pending.get()
+            try:
+                self._put_remote(key, data)
+            finally:
+                AUDIO_CACHE_WRITE_BEHIND_PENDING.dec()
+                self._pending.task_done()
+
+    def flush(self):
+        """Chờ ghi xong mọi key đang đợi đẩy lên remote"""
+        if self._writer is not None:
+            self._pending.join()
+
+    def clear(self):
+        """Chỉ xóa cache local của node này (cache dùng chung giữ nguyên cho các node khác)"""
+        self.local.clear()
+
+    def stats(self) -> Tuple[int, int]:
+        return self.local.stats()
+
+
+def create_cache(cache_dir: str) -> TieredCache:
+    """
+    Tạo cache theo biến môi trường:
+    - AUDIO_CACHE_BACKEND=local (mặc định) | shared | redis
+    - AUDIO_CACHE_SHARED_DIR: thư mục mạng dùng chung (backend shared)
+    - AUDIO_CACHE_REDIS_URL: vd redis://cache-host:6379/0 (backend redis)
+    - AUDIO_CACHE_REDIS_TTL: thời gian sống (giây) của key trên redis, bỏ trống = không hết hạn
+    - AUDIO_CACHE_WRITE_BEHIND=0 để ghi remote đồng bộ
+    """
+    local = LocalFSBackend(cache_dir)
+    backend = os.getenv("AUDIO_CACHE_BACKEND", "local").lower()
+
+    if backend == "shared":
+        shared_dir = os.getenv("AUDIO_CACHE_SHARED_DIR")
+        if not shared_dir:
+            raise RuntimeError("AUDIO_CACHE_BACKEND=shared cần đặt AUDIO_CACHE_SHARED_DIR")
+        remote = SharedDirBackend(shared_dir)
+    elif backend == "redis":
+        ttl = os.getenv("AUDIO_CACHE_REDIS_TTL")
+        remote = KeyValueBackend(
+            url=os.getenv("AUDIO_CACHE_REDIS_URL"),
+            ttl_seconds=int(ttl) if ttl else None,
+        )
+    elif backend == "local":
+        remote = None
+    else:
+        raise RuntimeError(f"AUDIO_CACHE_BACKEND không hợp lệ: {backend}")
+
+    logger.info(f"💾 Audio cache: local={cache_dir}" + (f", remote={remote.name}" if remote else ""))
+    return TieredCache(local, remote, write_behind=os.getenv("AUDIO_CACHE_WRITE_BEHIND", "1") != "0")
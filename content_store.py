@@ -0,0 +1,120 @@
+# File: content_store.py
+# URL theo nội dung cho audio: /audio/<sha256>.<ext>, nội dung không bao giờ đổi -> browser/CDN cache vĩnh viễn
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from functools import lru_cache
+from typing import Optional
+
+from instruments import sample_files
+
+logger = logging.getLogger(__name__)
+
+# 128 bit đầu của sha256 là đủ để không trùng giữa các clip
+DIGEST_LENGTH = 32
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+MEDIA_TYPES = {".wav": "audio/wav", ".mp3": "audio/mpeg"}
+
+
+def audio_media_type(path: str) -> str:
+    """Content-Type theo đuôi file (file mẫu là mp3, clip AI là wav)"""
+    return MEDIA_TYPES.get(os.path.splitext(path)[1].lower(), "application/octet-stream")
+
+
+def content_url(digest: str, ext: str) -> str:
+    return f"/audio/{digest}{ext}"
+
+
+def digest_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:DIGEST_LENGTH]
+
+
+@lru_cache(maxsize=1024)
+def _digest_file(path: str, mtime_ns: int, size: int) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()[:DIGEST_LENGTH]
+
+
+def digest_file(path: str) -> str:
+    """Digest của file, nhớ theo (mtime, size) nên mỗi file chỉ phải đọc lại khi bị thay"""
+    stat = os.stat(path)
+    return _digest_file(path, stat.st_mtime_ns, stat.st_size)
+
+
+def resolve_sample(digest: str, ext: str) -> Optional[str]:
+    """Tìm file mẫu có digest này (samples/ chỉ có vài chục file, digest đã được nhớ)"""
+    for path in sample_files():
+        if path.lower().endswith(ext) and digest_file(path) == digest:
+            return path
+    return None
+
+
+class ContentStore:
+    """
+    Thư mục <cache_dir>/by-hash: mỗi clip trong cache có thêm 1 tên <digest>.wav (hard link, không tốn thêm dung lượng)
+    Các worker cùng node dùng chung thư mục nên URL tạo ở worker này worker khác vẫn phục vụ được
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, digest: str, ext: str) -> str:
+        return os.path.join(self.directory, f"{digest}{ext}")
+
+    def publish(self, source_path: str, data: Optional[bytes] = None) -> str:
+        """Gắn địa chỉ nội dung cho file (đã có thì thôi), trả về digest"""
+        digest = digest_bytes(data) if data is not None else digest_file(source_path)
+        ext = os.path.splitext(source_path)[1].lower()
+        target = self.path(digest, ext)
+        if os.path.exists(target):
+            return digest
+
+        try:
+            os.link(source_path, target)
+        except FileExistsError:
+            pass
+        except OSError:
+            # Filesystem không hỗ trợ hard link: chép file (ghi tạm rồi rename)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=f".{digest}.", suffix=".tmp")
+            os.close(fd)
+            try:
+                shutil.copyfile(source_path, tmp_path)
+                os.replace(tmp_path, target)
+            except BaseException:
+                try:
+                    os.unlink(tmp_path)
+                except FileNotFoundError:
+                    pass
+                raise
+        return digest
+
+    def resolve(self, digest: str, ext: str) -> Optional[str]:
+        path = self.path(digest, ext)
+        return path if os.path.exists(path) else None
+
+    def prune(self) -> int:
+        """
+        Xóa tên by-hash không còn clip nào trong cache trỏ tới (st_nlink = 1: chỉ còn chính nó)
+        Gọi sau khi xóa clip khỏi cache, trả về số file đã xóa
+        Filesystem không có hard link (bản chép): mọi file đều bị xóa, clip còn trong cache được gắn lại khi publish
+        """
+        removed = 0
+        if not os.path.isdir(self.directory):
+            return removed
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") or not entry.is_file(follow_symlinks=False):
+                    continue
+                try:
+                    if entry.stat(follow_symlinks=False).st_nlink <= 1:
+                        os.unlink(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
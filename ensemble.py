@@ -0,0 +1,53 @@
+# File: ensemble.py
+# Demo hòa tấu nhiều nhạc cụ: lấy stem từ file mẫu / cache / MusicGen (1 batch), trộn stereo bằng NumPy
+import hashlib
+import logging
+from functools import lru_cache
+from io import BytesIO
+from typing import List, Sequence
+
+import numpy as np
+
+from audio_processing import decode_file, fit_length, mix_stems, postprocess, resample, to_mono, write_wav
+
+logger = logging.getLogger(__name__)
+
+# Sample rate của MusicGen (audio_encoder), file mẫu được resample về đây để trộn
+ENSEMBLE_SAMPLE_RATE = 32000
+
+SOURCE_SAMPLE = "sample"
+SOURCE_CACHE = "cache"
+SOURCE_GENERATED = "generated"
+
+
+@lru_cache(maxsize=32)
+def load_sample(path: str, sample_rate: int, duration: float) -> np.ndarray:
+    """
+    Giải mã file mẫu (mp3) -> mono float32 ở sample_rate, cắt/đệm đúng duration giây
+    Kết quả được giữ trong bộ nhớ (read-only) vì giải mã mp3 chậm hơn nhiều so với trộn
+    """
+    pcm, source_rate = decode_file(path)
+    audio = resample(to_mono(pcm), source_rate, sample_rate)
+    audio = fit_length(audio, int(duration * sample_rate))
+    audio.flags.writeable = False
+    return audio
+
+
+def ensemble_cache_key(stems: Sequence[tuple], style: str, duration: float) -> str:
+    """
+    Cache key của bản trộn
+    stems: (khóa nhạc cụ, nguồn, gain_db, pan) theo thứ tự gửi lên
+    """
+    if float(duration).is_integer():
+        duration = int(duration)
+    parts = "|".join(f"{key}:{source}:{gain_db:g}:{pan:g}" for key, source, gain_db, pan in stems)
+    return hashlib.md5(f"ensemble|{parts}|{style}|{duration}".encode()).hexdigest()
+
+
+def mix(stems: List[np.ndarray], gains_db: Sequence[float], pans: Sequence[float],
+        sample_rate: int, duration: float) -> BytesIO:
+    """Trộn các stem mono thành WAV stereo: gain + pan từng stem, rồi chuẩn hóa/soft clip/fade chung"""
+    n_samples = int(duration * sample_rate)
+    matrix = np.stack([fit_length(stem, n_samples) for stem in stems]).astype(np.float32, copy=False)
+    stereo = postprocess(mix_stems(matrix, gains_db, pans), sample_rate)
+    return write_wav(stereo, sample_rate)
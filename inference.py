@@ -0,0 +1,202 @@
+# File: inference.py
+# Hàng đợi chạy MusicGen trong thread riêng, không chặn event loop của FastAPI
+# Lập lịch: việc ngắn chạy trước (shortest-job-first theo số token ước tính), chờ lâu thì được đẩy lên (aging),
+# client vừa dùng nhiều bị xếp sau (fairness), việc nền (prefetch, warm-up) chỉ chạy khi không còn request nào
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+from itertools import count
+from typing import Callable, Dict, List, Optional, Tuple
+
+from metrics import DEMO_STAGE_SECONDS, INFERENCE_IN_PROGRESS, INFERENCE_QUEUE_DEPTH, INFERENCE_REJECTED
+
+logger = logging.getLogger(__name__)
+
+# Số nhỏ chạy trước: request người dùng đang chờ > việc nền (prefetch, warm-up)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+# Mỗi giây chờ trừ đi chừng này token khỏi chi phí (40 = 1 giây audio/giây chờ), tránh clip dài chờ mãi
+AGING_TOKENS_PER_SECOND = float(os.getenv("INFERENCE_AGING_TOKENS_PER_SECOND", "40"))
+# Số token client đã dùng gần đây được cộng vào chi phí việc tiếp theo của họ, giảm một nửa sau mỗi khoảng này
+FAIRNESS_HALF_LIFE_SECONDS = float(os.getenv("INFERENCE_FAIRNESS_HALF_LIFE", "60"))
+# Số việc tối đa 1 client được để chờ cùng lúc (0 = không giới hạn)
+MAX_PENDING_PER_CLIENT = int(os.getenv("INFERENCE_MAX_PENDING_PER_CLIENT", "3"))
+# Tổng số việc tối đa được chờ (0 = không giới hạn); đầy thì /demo/ trả clip gần nhất thay vì bắt chờ rất lâu
+MAX_QUEUE_DEPTH = int(os.getenv("INFERENCE_MAX_QUEUE", "16"))
+
+
+class QueueFullError(RuntimeError):
+    """Hàng đợi inference đã đầy"""
+
+
+class ClientQueueFullError(QueueFullError):
+    """Client đã có quá nhiều việc đang chờ trong hàng đợi"""
+
+
+class _Job:
+    __slots__ = ("future", "ctx", "fn", "args", "kwargs", "priority", "cost", "client", "enqueued_at", "seq")
+
+    def __init__(self, future, ctx, fn, args, kwargs, priority, cost, client, enqueued_at, seq):
+        self.future = future
+        self.ctx = ctx
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.cost = cost
+        self.client = client
+        self.enqueued_at = enqueued_at
+        self.seq = seq
+
+
+class InferenceExecutor:
+    def __init__(self, workers: int = 1, aging_tokens_per_second: float = AGING_TOKENS_PER_SECOND,
+                 fairness_half_life: float = FAIRNESS_HALF_LIFE_SECONDS,
+                 max_pending_per_client: int = MAX_PENDING_PER_CLIENT, max_queue: int = MAX_QUEUE_DEPTH,
+                 clock: Callable[[], float] = time.perf_counter):
+        """
+        Executor cho việc generate audio
+        :param workers: Số thread chạy model song song (1 = tuần tự, an toàn cho GPU/CPU nhỏ)
+        :param aging_tokens_per_second: mức giảm chi phí theo thời gian chờ
+        :param fairness_half_life: chu kỳ bán rã (giây) của lượng token client đã dùng
+        :param max_pending_per_client: số việc chờ tối đa mỗi client, 0 = không giới hạn
+        :param max_queue: tổng số việc chờ tối đa, 0 = không giới hạn
+        :param clock: đồng hồ (giây) cho thời gian chờ, aging và fairness; test truyền đồng hồ giả
+        """
+        self.workers = max(1, workers)
+        self.aging_tokens_per_second = aging_tokens_per_second
+        self.fairness_half_life = fairness_half_life
+        self.max_pending_per_client = max_pending_per_client
+        self.max_queue = max_queue
+        self._clock = clock
+        self._pending: List[_Job] = []
+        self._usage: Dict[str, Tuple[float, float]] = {}  # client -> (token đã dùng, thời điểm cập nhật)
+        self._seq = count()  # Điểm bằng nhau thì FIFO
+        self._cond = threading.Condition()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"inference-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            logger.info(f"🧵 Started {self.workers} inference worker(s)")
+
+    def _client_usage(self, client: Optional[str], now: float) -> float:
+        tokens, updated_at = self._usage.get(client, (0.0, now))
+        if self.fairness_half_life <= 0:
+            return 0.0
+        return tokens * 0.5 ** ((now - updated_at) / self.fairness_half_life)
+
+    def _score(self, job: _Job, now: float) -> float:
+        """Điểm càng thấp càng được chạy trước (chỉ so sánh trong cùng priority)"""
+        waited = now - job.enqueued_at
+        return job.cost - self.aging_tokens_per_second * waited + self._client_usage(job.client, now)
+
+    def _pick(self) -> _Job:
+        """Lấy việc chạy tiếp theo (gọi khi đang giữ self._cond và _pending không rỗng)"""
+        now = self._clock()
+        job = min(self._pending, key=lambda j: (j.priority, self._score(j, now), j.seq))
+        self._pending.remove(job)
+        INFERENCE_QUEUE_DEPTH.dec()
+
+        # Tính chi phí vào lượng đã dùng của client, bỏ các client đã nguội hẳn
+        self._usage[job.client] = (self._client_usage(job.client, now) + job.cost, now)
+        if len(self._usage) > 1024:
+            self._usage = {c: (t, u) for c, (t, u) in self._usage.items() if self._client_usage(c, now) >= 1.0}
+        return job
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                job = self._pick()
+
+            # Request đã bị hủy (client ngắt kết nối) trong lúc chờ
+            if not job.future.set_running_or_notify_cancel():
+                continue
+
+            DEMO_STAGE_SECONDS.labels(stage="queue_wait").observe(self._clock() - job.enqueued_at)
+            INFERENCE_IN_PROGRESS.inc()
+            try:
+                job.future.set_result(job.ctx.run(job.fn, *job.args, **job.kwargs))
+            except BaseException as e:
+                job.future.set_exception(e)
+            finally:
+                INFERENCE_IN_PROGRESS.dec()
+
+    def _discard_cancelled(self, job: _Job):
+        """Việc bị hủy khi còn chờ: bỏ khỏi hàng đợi ngay để không chiếm chỗ của client"""
+        if not job.future.cancelled():
+            return
+        with self._cond:
+            if job in self._pending:
+                self._pending.remove(job)
+                INFERENCE_QUEUE_DEPTH.dec()
+
+    def submit(self, fn: Callable, *args, priority: int = PRIORITY_INTERACTIVE, cost: float = 0,
+               client: Optional[str] = None, **kwargs) -> Future:
+        """
+        Đưa 1 việc vào hàng đợi, trả về concurrent.futures.Future
+        Context hiện tại (span tracing...) được mang theo sang thread inference
+        :param cost: chi phí ước tính (số token sẽ sinh), việc rẻ chạy trước
+        :param client: định danh client để chia đều lượt chạy, None = không giới hạn
+        """
+        self._ensure_started()
+        future = Future()
+        job = _Job(future, contextvars.copy_context(), fn, args, kwargs, priority, cost, client,
+                   self._clock(), next(self._seq))
+        with self._cond:
+            if self.max_queue > 0 and len(self._pending) >= self.max_queue:
+                INFERENCE_REJECTED.labels(reason="queue_full").inc()
+                raise QueueFullError(f"Hàng đợi generate đã đầy ({self.max_queue} việc đang chờ)")
+            if (client is not None and self.max_pending_per_client > 0
+                    and sum(1 for j in self._pending if j.client == client) >= self.max_pending_per_client):
+                INFERENCE_REJECTED.labels(reason="client_limit").inc()
+                raise ClientQueueFullError(f"Client {client} đã có {self.max_pending_per_client} việc đang chờ")
+            self._pending.append(job)
+            INFERENCE_QUEUE_DEPTH.inc()
+            self._cond.notify()
+        future.add_done_callback(lambda _: self._discard_cancelled(job))
+        return future
+
+    async def run(self, fn: Callable, *args, priority: int = PRIORITY_INTERACTIVE, cost: float = 0,
+                  client: Optional[str] = None, **kwargs):
+        """Chạy fn trong hàng đợi inference và await kết quả từ async route"""
+        future = self.submit(fn, *args, priority=priority, cost=cost, client=client, **kwargs)
+        return await asyncio.wrap_future(future)
+
+    @property
+    def depth(self) -> int:
+        """Số việc đang chờ (chưa chạy)"""
+        return len(self._pending)
+
+    def snapshot(self) -> List[dict]:
+        """Hàng đợi hiện tại theo thứ tự sẽ chạy (để debug lập lịch)"""
+        now = self._clock()
+        with self._cond:
+            ordered = sorted(self._pending, key=lambda j: (j.priority, self._score(j, now), j.seq))
+            return [
+                {
+                    "function": getattr(j.fn, "__qualname__", str(j.fn)),
+                    "client": j.client,
+                    "priority": j.priority,
+                    "cost_tokens": j.cost,
+                    "waited_s": round(now - j.enqueued_at, 3),
+                    "score": round(self._score(j, now), 1),
+                }
+                for j in ordered
+            ]
+
+
+inference_executor = InferenceExecutor(workers=int(os.getenv("INFERENCE_WORKERS", "1")))
@@ -0,0 +1,192 @@
+# File: instruments.py
+# Registry nhạc cụ dùng chung: tên chuẩn hóa, tên gọi khác, file mẫu, mô tả MusicGen, sản phẩm trên catalog
+# Chỉ chứa tên nhạc cụ; thương hiệu/model sản phẩm nằm ở routes/consultation.py (PRODUCT_KEYWORDS)
+# Được build 1 lần khi import, tra cứu O(1) theo tên đã chuẩn hóa
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+import difflib
+import os
+import re
+import unicodedata
+
+SAMPLE_DIR = "samples"
+
+# Độ giống tối thiểu để chấp nhận tên gõ sai (difflib ratio)
+FUZZY_CUTOFF = 0.8
+
+
+@lru_cache(maxsize=4096)
+def normalize_text(text: str) -> str:
+    """
+    Chuẩn hóa text: bỏ dấu, chuyển thành chữ thường
+    Ví dụ: "Đàn Tranh" -> "dan tranh"
+    """
+    if not text:
+        return ""
+
+    # Bỏ dấu tiếng Việt
+    text = unicodedata.normalize('NFD', text)
+    text = ''.join(char for char in text if unicodedata.category(char) != 'Mn')
+
+    # Chuyển đ -> d, Đ -> d
+    text = text.replace('đ', 'd').replace('Đ', 'd')
+
+    # Chuyển thành chữ thường, bỏ dấu nháy (T'rưng -> t rung) và khoảng trắng thừa
+    text = text.lower().replace("'", " ").replace("_", " ").strip()
+    text = ' '.join(text.split())
+
+    return text
+
+
+@dataclass(frozen=True)
+class Instrument:
+    key: str                       # Tên chuẩn hóa (không dấu, chữ thường) - khóa chính
+    name: str                      # Tên hiển thị có dấu
+    description: str               # Mô tả âm sắc cho prompt MusicGen
+    family: str                    # Loại nhạc cụ: hơi/dây/gõ (giống QuickConsultRequest.instrument_type)
+    aliases: Tuple[str, ...] = ()  # Tên gọi khác (có dấu hoặc không dấu)
+    samples: Tuple[str, ...] = ()  # File mẫu trong samples/, ưu tiên theo thứ tự
+    course_id: Optional[int] = None  # courseId của sản phẩm/khóa học tương ứng trên catalog
+
+    @property
+    def sample_path(self) -> Optional[str]:
+        """Đường dẫn file mẫu đầu tiên còn tồn tại, None nếu không có"""
+        for filename in self.samples:
+            path = os.path.join(SAMPLE_DIR, filename)
+            if os.path.exists(path):
+                return path
+        return None
+
+
+_INSTRUMENTS: Tuple[Instrument, ...] = (
+    Instrument("sao truc", "Sáo Trúc", "Vietnamese bamboo transverse flute Sáo Trúc, airy, soft timbre, capable of bending notes for expressive melodies", "hơi", course_id=1),
+    Instrument("sao tieu", "Sáo Tiêu", "Vietnamese vertical bamboo flute Sáo Tiêu, mellow meditative low tone, ideal for soulful and introspective music", "hơi"),
+    Instrument("ken bau", "Kèn Bầu", "Vietnamese conical oboe Kèn Bầu, reedy, buzzing, and powerful sound, used in traditional ceremonies", "hơi"),
+    # "danh tranh" là cách gõ khác của đàn tranh; danh_tranh1.mp3 là bản ghi thứ 2 (dự phòng, cũng được index cho fallback)
+    Instrument("dan tranh", "Đàn Tranh", "Vietnamese 16-string zither Đàn Tranh, bright, metallic cascading tones with glissando, versatile for classical and folk music", "dây", aliases=("danh tranh",), samples=("dan_tranh.mp3", "danh_tranh1.mp3")),
+    Instrument("dan bau", "Đàn Bầu", "Vietnamese monochord Đàn Bầu, expressive bending pitch, soulful vocal-like timbre, iconic in Vietnamese music", "dây", aliases=("độc huyền cầm",), samples=("dan_bau.mp3",)),
+    Instrument("dan nguyet", "Đàn Nguyệt", "Vietnamese moon lute Đàn Nguyệt, clear metallic tone, traditional opera instrument with a bright, resonant sound", "dây", aliases=("đàn kìm",), samples=("dan_nguyet.mp3",)),
+    Instrument("dan tinh", "Đàn Tính", "Vietnamese lute Đàn Tính, gentle storytelling tone used in spiritual folk songs of ethnic minorities", "dây"),
+    Instrument("dan ty ba", "Đàn Tỳ Bà", "Vietnamese pear-shaped lute Đàn Tỳ Bà, delicate articulate plucking tone, rooted in classical traditions", "dây", aliases=("tỳ bà",), samples=("dan_ty_ba.mp3",)),
+    Instrument("dan nhi", "Đàn Nhị", "Vietnamese two-string fiddle Đàn Nhị, nasal, emotional, expressive sound, often used in emotional ballads", "dây", samples=("dan_nhi.mp3",)),
+    Instrument("dan gao", "Đàn Gáo", "Vietnamese coconut-shell fiddle Đàn Gáo, rustic, folk tone with a warm, earthy quality", "dây"),
+    Instrument("dan co", "Đàn Cò", "Vietnamese spike fiddle Đàn Cò, high-pitched crying timbre, evoking deep emotional resonance", "dây"),
+    Instrument("trong com", "Trống Cơm", "Vietnamese barrel drum Trống Cơm, resonant deep bass sound, essential for rhythmic accompaniment", "gõ"),
+    Instrument("phach", "Phách", "Vietnamese wooden clappers Phách, dry sharp percussive click, used for rhythmic precision in ensembles", "gõ"),
+    Instrument("song lang", "Song Lang", "Vietnamese bamboo clapper Song Lang, sharp timing click, provides crisp rhythmic accents", "gõ"),
+    Instrument("chieng", "Chiêng", "Vietnamese gong Chiêng, metallic reverberant tone, central to ethnic rituals and ensembles", "gõ"),
+    Instrument("t rung", "T'rưng", "Vietnamese bamboo xylophone T'rưng, bright cascading mountain echo tones, popular in highland music", "gõ", samples=("t_rung.mp3",)),
+    Instrument("k longput", "K'longput", "Vietnamese bamboo percussion K'longput, resonant airy tones from clapped air, unique to ethnic traditions", "gõ", aliases=("klong put",)),
+    Instrument("dan kni", "Đàn K'ni", "Vietnamese mouth fiddle Đàn K'ni, haunting vocal-like resonance, played with mouth for expressive melodies", "dây"),
+    Instrument("sao", "Sáo", "Vietnamese bamboo flute Sáo, airy, soft timbre, capable of bending notes, versatile for various genres", "hơi", samples=("sao.mp3",), course_id=1),
+    Instrument("dan da", "Đàn Đá", "Vietnamese stone xylophone Đàn Đá, bright, resonant stone tones, unique to ancient traditions", "gõ", samples=("dan_da.mp3",)),
+    Instrument("dan day", "Đàn Đáy", "Vietnamese long-necked lute Đàn Đáy, deep, resonant folk instrument, used in traditional ca trù music", "dây", samples=("dan_day.mp3",)),
+    Instrument("dan sen", "Đàn Sen", "Vietnamese lotus lute Đàn Sen, delicate, floating tones, rare and poetic in sound", "dây", samples=("dan_sen.mp3",)),
+    Instrument("dan tam thap luc", "Đàn Tam Thập Lục", "Vietnamese 36-string zither Đàn Tam Thập Lục, extended range with versatile, cascading tones, ideal for complex melodies", "dây"),
+    Instrument("dan tam", "Đàn Tam", "Vietnamese three-string lute Đàn Tam, bright, rhythmic plucking tones, used in traditional ensembles", "dây"),
+    Instrument("dan senh", "Đàn Sến", "Vietnamese lute Đàn Sến, delicate, articulate plucking tones, popular in southern folk music", "dây"),
+    Instrument("senh tien", "Sênh Tiền", "Vietnamese coin clapper Sênh Tiền, metallic jingling percussion sound, adds rhythmic sparkle", "gõ"),
+    Instrument("mo", "Mõ", "Vietnamese wooden fish Mõ, hollow resonant knocking tone for ceremonial and Buddhist rituals", "gõ"),
+    Instrument("trong cai", "Trống Cái", "Vietnamese large drum Trống Cái, deep booming bass rhythm, leads traditional music ensembles", "gõ"),
+    Instrument("trong chau", "Trống Châu", "Vietnamese temple drum Trống Châu, deep ceremonial tone with resonant beats, used in sacred settings", "gõ"),
+    Instrument("trong", "Trống", "Vietnamese traditional drum Trống, deep resonant beats, the rhythmic backbone of folk ensembles", "gõ", course_id=3),
+    Instrument("cong chieng", "Cồng Chiêng", "Vietnamese gong set Cồng Chiêng, varied metallic resonances, essential for ethnic rituals and festivals", "gõ"),
+    # File mẫu khen_be.mp3 là khèn bè (khèn ghép bè); "kèn bè" là cách gọi/gõ khác, cùng 1 nhạc cụ
+    Instrument("khen", "Khèn", "Vietnamese free reed mouth organ Khèn, polyphonic buzzing reed tones, expressive melodies for ethnic music", "hơi", aliases=("khèn bè", "kèn bè"), samples=("khen_be.mp3",)),
+    Instrument("dan goong", "Đàn Goong", "Vietnamese bamboo tube zither Đàn Goong, earthy percussive tones from ethnic traditions", "dây"),
+    Instrument("litranh", "Litranh", "Vietnamese horn Litranh, natural horn sound with deep, calling timbre, used in ethnic ceremonies", "hơi"),
+    Instrument("trong paranung", "Trống Paranưng", "Vietnamese ethnic drum Trống Paranưng, rhythmic patterns with vibrant beats, unique to minority groups", "gõ"),
+    Instrument("chuong", "Chuông", "Vietnamese bell Chuông, clear ringing tone for signaling and ceremonies, adds melodic accents", "gõ"),
+    Instrument("guitar", "Guitar", "Acoustic or electric stringed instrument Guitar, versatile warm or bright tones, used in folk, pop, rock, and classical music", "dây", aliases=("đờn guitar", "ghita"), course_id=4),
+    Instrument("piano", "Piano", "Keyboard instrument Piano, rich, dynamic range with resonant tones, ideal for classical, jazz, and contemporary music", "dây", aliases=("đàn piano",), course_id=2),
+    Instrument("cajon", "Cajon", "Box-shaped percussion instrument Cajon, punchy bass and crisp snare-like slaps, popular in acoustic and folk music", "gõ", course_id=3),
+    Instrument("violin", "Violin", "Stringed instrument Violin, expressive, singing tone, used in classical, folk, and modern genres", "dây"),
+    Instrument("drum set", "Drum Set", "Percussion ensemble Drum Set, powerful rhythmic foundation with varied tones, essential for rock, jazz, and pop music", "gõ", aliases=("trống jazz",)),
+    Instrument("flute", "Flute", "Western transverse flute Flute, clear, bright, and airy tone, used in classical, jazz, and world music", "hơi"),
+    Instrument("trumpet", "Trumpet", "Brass instrument Trumpet, bold, piercing tone, versatile for jazz, classical, and marching bands", "hơi"),
+    Instrument("saxophone", "Saxophone", "Reed instrument Saxophone, smooth, soulful tone, prominent in jazz, pop, and classical music", "hơi", aliases=("sax",)),
+    Instrument("ukulele", "Ukulele", "Small stringed instrument Ukulele, bright, cheerful plucking tones, popular in Hawaiian and folk music", "dây"),
+    Instrument("harmonica", "Harmonica", "Free reed instrument Harmonica, compact, expressive sound, used in blues, folk, and country music", "hơi", aliases=("kèn harmonica",)),
+)
+
+
+def _build_lookup() -> Dict[str, Instrument]:
+    """Map mọi tên (khóa, tên hiển thị, tên gọi khác) đã chuẩn hóa -> Instrument"""
+    lookup = {}
+    for inst in _INSTRUMENTS:
+        for form in (inst.key, inst.name) + inst.aliases:
+            # Tên chính của nhạc cụ khác luôn thắng tên gọi khác trùng (vd "đàn cò")
+            lookup.setdefault(normalize_text(form), inst)
+    for inst in _INSTRUMENTS:
+        lookup[inst.key] = inst
+    return lookup
+
+
+def _build_text_pattern() -> Tuple["re.Pattern", Dict[str, Instrument]]:
+    """
+    Regex tìm nhạc cụ trong câu tự do (câu hỏi khách, câu trả lời AI)
+    Chỉ dùng dạng viết như trong registry (giữ dấu) vì dạng không dấu trùng từ thông dụng:
+    "sao" (tại sao), "trong" (bên trong), "khen" (khen ngợi)...
+    """
+    forms = {}
+    for inst in _INSTRUMENTS:
+        for form in (inst.name,) + inst.aliases:
+            forms.setdefault(unicodedata.normalize('NFC', form.lower()), inst)
+    # Dạng dài khớp trước: "sáo trúc" thắng "sáo"
+    ordered = sorted(forms, key=len, reverse=True)
+    pattern = re.compile(r"(?<!\w)(" + "|".join(re.escape(f) for f in ordered) + r")(?!\w)")
+    return pattern, forms
+
+
+INSTRUMENTS: Dict[str, Instrument] = {inst.key: inst for inst in _INSTRUMENTS}
+_LOOKUP: Dict[str, Instrument] = _build_lookup()
+_TEXT_PATTERN, _TEXT_FORMS = _build_text_pattern()
+
+
+@lru_cache(maxsize=1024)
+def _lookup_normalized(normalized: str, fuzzy: bool) -> Optional[Instrument]:
+    inst = _LOOKUP.get(normalized)
+    if inst is not None or not fuzzy:
+        return inst
+
+    # Gõ sai chính tả: "dan tranhh", "dan nguyeet"...
+    matches = difflib.get_close_matches(normalized, _LOOKUP.keys(), n=1, cutoff=FUZZY_CUTOFF)
+    return _LOOKUP[matches[0]] if matches else None
+
+
+def lookup_instrument(name: str, fuzzy: bool = True) -> Optional[Instrument]:
+    """
+    Tra cứu nhạc cụ theo tên, hỗ trợ có dấu/không dấu, tên gọi khác và gõ sai nhẹ
+    Ví dụ: "Đàn Tranh", "dan tranh", "dan tranhh" -> Đàn Tranh
+    Trả về None nếu không tìm thấy
+    """
+    normalized = normalize_text(name)
+    if not normalized:
+        return None
+    return _lookup_normalized(normalized, fuzzy)
+
+
+def find_instruments_in_text(text: str) -> List[Instrument]:
+    """
+    Tìm các nhạc cụ được nhắc đến trong câu, theo thứ tự xuất hiện
+    """
+    if not text:
+        return []
+    text = unicodedata.normalize('NFC', text.lower())
+    return [_TEXT_FORMS[m.group(1)] for m in _TEXT_PATTERN.finditer(text)]
+
+
+def instrument_samples() -> List[Tuple[Instrument, str]]:
+    """(nhạc cụ, đường dẫn) của mọi file mẫu trong registry hiện có trên đĩa"""
+    return [
+        (inst, os.path.join(SAMPLE_DIR, filename))
+        for inst in _INSTRUMENTS
+        for filename in inst.samples
+        if os.path.exists(os.path.join(SAMPLE_DIR, filename))
+    ]
+
+
+def sample_files() -> List[str]:
+    """Mọi file mẫu trong registry hiện có trên đĩa"""
+    return [path for _, path in instrument_samples()]
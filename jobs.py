@@ -0,0 +1,253 @@
+# File: jobs.py
+# Hàng đợi job generate audio lưu trong SQLite: còn nguyên sau khi restart, dùng chung giữa các worker
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Đường dẫn file SQLite (như cache_dir của AIMusicGenerator), thư mục cha được tạo khi dùng lần đầu
+JOBS_DB = os.getenv("JOBS_DB", "jobs.db")
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    instrument TEXT NOT NULL,
+    style TEXT NOT NULL,
+    duration REAL NOT NULL,
+    cache_key TEXT NOT NULL,
+    status TEXT NOT NULL,
+    progress_tokens INTEGER NOT NULL DEFAULT 0,
+    total_tokens INTEGER NOT NULL,
+    error TEXT,
+    worker_pid INTEGER,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_cache_key ON jobs (cache_key, status);
+"""
+
+
+def _pid_alive(pid: Optional[int]) -> bool:
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobStore:
+    def __init__(self, path: str = JOBS_DB):
+        """
+        Chưa mở/tạo file khi khởi tạo (import module không ghi gì ra đĩa), schema được tạo ở lần dùng đầu tiên
+        Mọi method đều chặn (SQLite timeout 30s khi tranh ghi): route async gọi qua run_in_threadpool
+        """
+        self.path = path
+        self._initialized = False
+        self._init_lock = threading.Lock()
+
+    def _ensure_schema(self):
+        with self._init_lock:
+            if self._initialized:
+                return
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(_SCHEMA)
+            finally:
+                conn.close()
+            self._initialized = True
+
+    @contextmanager
+    def _connect(self):
+        if not self._initialized:
+            self._ensure_schema()
+        # Mỗi lần dùng 1 connection riêng: an toàn khi gọi từ nhiều thread/worker
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def create(self, instrument: str, style: str, duration: float, cache_key: str, total_tokens: int) -> dict:
+        """
+        Tạo job mới, hoặc trả về job đang chờ/đang chạy cho cùng cache_key (tránh generate trùng)
+        """
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE cache_key = ? AND status IN (?, ?) ORDER BY created_at LIMIT 1",
+                    (cache_key, STATUS_QUEUED, STATUS_RUNNING),
+                ).fetchone()
+                if row is None:
+                    job_id = uuid.uuid4().hex
+                    conn.execute(
+                        "INSERT INTO jobs (id, instrument, style, duration, cache_key, status, total_tokens, created_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (job_id, instrument, style, duration, cache_key, STATUS_QUEUED, total_tokens, time.time()),
+                    )
+                    row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return dict(row)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def claim_next(self, pid: int) -> Optional[dict]:
+        """Lấy job chờ lâu nhất và đánh dấu đang chạy (atomic giữa các worker)"""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT id FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1", (STATUS_QUEUED,)
+                ).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                conn.execute(
+                    "UPDATE jobs SET status = ?, worker_pid = ?, started_at = ?, progress_tokens = 0 WHERE id = ?",
+                    (STATUS_RUNNING, pid, time.time(), row["id"]),
+                )
+                job = conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return dict(job)
+
+    def update_progress(self, job_id: str, tokens: int):
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET progress_tokens = ? WHERE id = ?", (tokens, job_id))
+
+    def finish(self, job_id: str):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, progress_tokens = total_tokens, finished_at = ? WHERE id = ?",
+                (STATUS_DONE, time.time(), job_id),
+            )
+
+    def fail(self, job_id: str, error: str):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                (STATUS_FAILED, error, time.time(), job_id),
+            )
+
+    def requeue_orphans(self) -> int:
+        """Job đang chạy dở của worker đã chết (crash/restart) -> đưa lại vào hàng đợi"""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    "SELECT id, worker_pid FROM jobs WHERE status = ?", (STATUS_RUNNING,)
+                ).fetchall()
+                orphans = [r["id"] for r in rows if not _pid_alive(r["worker_pid"])]
+                for job_id in orphans:
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, worker_pid = NULL, started_at = NULL, progress_tokens = 0 WHERE id = ?",
+                        (STATUS_QUEUED, job_id),
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        if orphans:
+            logger.info(f"♻️ Requeued {len(orphans)} orphaned job(s)")
+        return len(orphans)
+
+    def queued_count(self) -> int:
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (STATUS_QUEUED,)).fetchone()[0]
+
+
+class JobWorker:
+    def __init__(self, store: JobStore, run_job: Callable[[dict, Callable[[int, int], None]], None],
+                 poll_interval: float = 1.0):
+        """
+        Thread nền lấy job từ store và chạy lần lượt
+        :param run_job: hàm (job, progress_callback) chạy generate, raise nếu lỗi
+        """
+        self.store = store
+        self.run_job = run_job
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name="job-worker", daemon=True)
+        self._thread.start()
+        logger.info("🧵 Job worker started")
+
+    def notify(self):
+        """Đánh thức worker ngay khi có job mới (không phải chờ hết poll_interval)"""
+        self._wakeup.set()
+
+    def _loop(self):
+        pid = os.getpid()
+        # Ở thread nền: start() được gọi từ startup event, không chạy SQLite trên event loop
+        try:
+            self.store.requeue_orphans()
+        except Exception as e:
+            logger.error(f"❌ Lỗi requeue job: {str(e)}")
+        while True:
+            try:
+                job = self.store.claim_next(pid)
+            except Exception as e:
+                logger.error(f"❌ Lỗi lấy job: {str(e)}")
+                job = None
+
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            self._run(job)
+
+    def _run(self, job: dict):
+        job_id = job["id"]
+        last_write = 0.0
+
+        def on_progress(tokens: int, total: int):
+            # Ghi DB tối đa ~2 lần/giây
+            nonlocal last_write
+            now = time.monotonic()
+            if now - last_write >= 0.5 or tokens >= total:
+                last_write = now
+                self.store.update_progress(job_id, tokens)
+
+        logger.info(f"🎵 Running job {job_id}: {job['instrument']} / {job['style']} / {job['duration']}s")
+        try:
+            self.run_job(job, on_progress)
+            self.store.finish(job_id)
+            logger.info(f"✅ Job {job_id} done")
+        except Exception as e:
+            logger.error(f"❌ Job {job_id} failed: {str(e)}")
+            self.store.fail(job_id, str(e))
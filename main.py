@@ -1,24 +1,93 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
+from fastapi.concurrency import run_in_threadpool
+import os
+import time
 from routes.consultation import router as consultation_router
 from routes.demo_audio import router as demo_router
 from routes.guide import router as guide_router
 from routes.story import router as story_router
 from routes.support import router as support_router
 from routes.company_info import router as company_info_router
+from routes.batch import router as batch_router
+from routes.demo_jobs import router as demo_jobs_router
+from routes.admin import router as admin_router
+from routes.waveform import router as waveform_router
+from routes.audio_files import router as audio_files_router
+from metrics import CONTENT_TYPE_LATEST, HTTP_REQUEST_SECONDS, mark_process_dead, render_latest
+from routes.admin import admin_token_valid
+from tracing import TraceMiddleware, flush_traces
 # Initialize FastAPI with metadata
 app = FastAPI(title="Music Instrument Sales AI API")
 
 # Include routers for each functionality
 app.include_router(consultation_router, prefix="/consultation")
 app.include_router(demo_router, prefix="/demo")
+app.include_router(demo_jobs_router, prefix="/demo/jobs")
+app.include_router(waveform_router, prefix="/demo/waveform")
 app.include_router(guide_router, prefix="/guide")
 app.include_router(story_router, prefix="/story")
 app.include_router(support_router, prefix="/support")
 app.include_router(company_info_router, prefix="/company-info")
+app.include_router(batch_router, prefix="/batch")
+app.include_router(admin_router, prefix="/admin")
+app.include_router(audio_files_router, prefix="/audio")
+
+
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    """Ghi latency mỗi request theo route template (vd /demo/) để tránh label vô hạn"""
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        route_path = route.path if route is not None else "unmatched"
+        HTTP_REQUEST_SECONDS.labels(
+            method=request.method, route=route_path, status=str(status)
+        ).observe(time.perf_counter() - start)
+
+
+# Ghi span tree cho request trúng TRACE_SAMPLE_RATE, hoặc có X-Debug-Trace: 1 kèm X-Admin-Token đúng
+# Thêm sau cùng -> middleware ngoài cùng, span gốc bao cả các middleware khác
+app.add_middleware(TraceMiddleware, allow_debug=lambda headers: admin_token_valid(headers.get("x-admin-token")))
+
+
+@app.on_event("shutdown")
+async def cleanup_metrics():
+    mark_process_dead(os.getpid())
+
+
+@app.on_event("shutdown")
+async def flush_trace_export():
+    """Ghi nốt các trace đang chờ trước khi tắt"""
+    await run_in_threadpool(flush_traces)
+
+
+@app.get("/metrics")
+async def metrics():
+    """Metrics dạng Prometheus (gộp tất cả worker nếu đặt PROMETHEUS_MULTIPROC_DIR)"""
+    return Response(render_latest(), media_type=CONTENT_TYPE_LATEST)
+
 @app.get("/")
 async def root():
     return {"message": "AI Chatbot for Music Instruments Sales API"}
 
 if __name__ == "__main__":
+    import shutil
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000, workers=4)  # 4 workers for concurrency
\ No newline at end of file
+
+    # Thư mục chung để gộp metrics của 4 worker, xóa số liệu cũ mỗi lần khởi động
+    metrics_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join("/tmp", "music_ai_metrics"))
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+    # Sau load balancer: lấy IP thật từ X-Forwarded-For của các proxy tin cậy (FORWARDED_ALLOW_IPS),
+    # không thì mọi người dùng chung 1 IP (của LB) và chung giới hạn việc chờ của hàng đợi generate
+    forwarded_allow_ips = os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1")
+
+    # Dùng import string "main:app" để uvicorn thực sự spawn nhiều worker
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=4,  # 4 workers for concurrency
+                proxy_headers=True, forwarded_allow_ips=forwarded_allow_ips)
\ No newline at end of file
@@ -0,0 +1,235 @@
+# File: metrics.py
+# Metrics kiểu Prometheus cho toàn bộ pipeline (route, chat, Gemini, MusicGen, cache, catalog)
+# Chạy nhiều worker uvicorn: số liệu các worker được gộp qua PROMETHEUS_MULTIPROC_DIR (tự tạo nếu chưa đặt)
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+def _is_server_worker() -> bool:
+    """Process là 1 trong nhiều worker: uvicorn --workers (spawn từ master) hoặc WEB_CONCURRENCY > 1 (gunicorn...)"""
+    if multiprocessing.parent_process() is not None:
+        return True
+    try:
+        return int(os.getenv("WEB_CONCURRENCY") or 1) > 1
+    except ValueError:
+        return False
+
+
+def _setup_multiprocess_dir():
+    """
+    Phải chạy trước khi import prometheus_client: thư viện chọn chế độ 1 hay nhiều process lúc import
+    Worker không có PROMETHEUS_MULTIPROC_DIR thì mỗi lần scrape chỉ thấy số liệu của 1 worker:
+    tự dùng thư mục riêng của master (theo PID master, mọi worker cùng master dùng chung, lần chạy sau không lẫn)
+    """
+    directory = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if not directory:
+        if not _is_server_worker():
+            return
+        directory = os.path.join(tempfile.gettempdir(), "music_ai_metrics", str(os.getppid()))
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = directory
+        logger.warning(f"⚠️ PROMETHEUS_MULTIPROC_DIR chưa đặt, gộp metrics các worker qua {directory}")
+    os.makedirs(directory, exist_ok=True)
+
+
+_setup_multiprocess_dir()
+
+from prometheus_client import (  # noqa: E402
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client import multiprocess  # noqa: E402
+
+# Bucket (giây) cho request nhanh (chat, file mẫu) đến generate trên CPU (~60s)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Thời gian xử lý request theo route",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+
+DEMO_STAGE_SECONDS = Histogram(
+    "demo_generate_stage_seconds",
+    "Thời gian từng bước trong AIMusicGenerator.generate",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+
+CHAT_STAGE_SECONDS = Histogram(
+    "chat_stage_seconds",
+    "Thời gian từng bước trong process_chat_query",
+    ["intent", "stage"],
+    buckets=LATENCY_BUCKETS,
+)
+
+GEMINI_REQUEST_SECONDS = Histogram(
+    "gemini_request_duration_seconds",
+    "Thời gian gọi Gemini API",
+    ["outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+
+GEMINI_ERRORS = Counter(
+    "gemini_errors_total",
+    "Số lần gọi Gemini lỗi",
+    ["reason"],
+)
+
+GEMINI_TOKENS = Counter(
+    "gemini_tokens_total",
+    "Số token Gemini theo intent (input/output), reported = Gemini báo về, estimated = ước tính theo ký tự",
+    ["intent", "direction", "source"],
+)
+
+GEMINI_PROMPT_TOKENS = Histogram(
+    "gemini_prompt_tokens",
+    "Số token ước tính của prompt gửi đi (sau khi cắt theo ngân sách)",
+    ["intent"],
+    buckets=(50, 100, 200, 400, 800, 1600, 3200, 6400, 12800),
+)
+
+GEMINI_BUDGET_TRIMS = Counter(
+    "gemini_budget_trims_total",
+    "Số prompt phải cắt vì vượt ngân sách token, theo mức cắt cuối cùng (over_budget = cắt hết vẫn vượt)",
+    ["intent", "level"],
+)
+
+AUDIO_CACHE_REQUESTS = Counter(
+    "audio_cache_requests_total",
+    "Số lần tra cache audio (hit/miss)",
+    ["result"],
+)
+
+AUDIO_CACHE_FILES = Gauge(
+    "audio_cache_files",
+    "Số file trong cache audio",
+    multiprocess_mode="mostrecent",
+)
+
+AUDIO_CACHE_BYTES = Gauge(
+    "audio_cache_size_bytes",
+    "Tổng dung lượng cache audio",
+    multiprocess_mode="mostrecent",
+)
+
+AUDIO_CACHE_REMOTE_REQUESTS = Counter(
+    "audio_cache_remote_requests_total",
+    "Số lần đọc/ghi cache dùng chung (hit/miss/error/write_error)",
+    ["result"],
+)
+
+AUDIO_CACHE_WRITE_BEHIND_PENDING = Gauge(
+    "audio_cache_write_behind_pending",
+    "Số file đang chờ ghi lên cache dùng chung",
+    multiprocess_mode="livesum",
+)
+
+CATALOG_FETCH_SECONDS = Histogram(
+    "catalog_fetch_duration_seconds",
+    "Thời gian lấy danh sách sản phẩm từ catalog API",
+    ["outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+
+INFERENCE_QUEUE_DEPTH = Gauge(
+    "inference_queue_depth",
+    "Số việc generate đang chờ trong hàng đợi",
+    multiprocess_mode="livesum",
+)
+
+INFERENCE_IN_PROGRESS = Gauge(
+    "inference_in_progress",
+    "Số việc generate đang chạy",
+    multiprocess_mode="livesum",
+)
+
+INFERENCE_REJECTED = Counter(
+    "inference_rejected_total",
+    "Số việc generate bị từ chối vì hàng đợi đầy",
+    ["reason"],
+)
+
+DEMO_PREFETCH_EVENTS = Counter(
+    "demo_prefetch_events_total",
+    "Sự kiện prefetch demo: scheduled/completed/failed/cancelled/joined/already_cached/skipped_*/hit/miss",
+    ["event"],
+)
+
+DEMO_FALLBACKS = Counter(
+    "demo_fallbacks_total",
+    "Số lần /demo/ trả clip gần nhất thay cho clip được yêu cầu, theo lý do và mức khớp (none = không có clip nào)",
+    ["reason", "match"],
+)
+
+
+@contextmanager
+def time_stage(histogram: Histogram, **labels):
+    """
+    Đo thời gian 1 đoạn code và ghi vào histogram
+    Ví dụ: with time_stage(DEMO_STAGE_SECONDS, stage="generate"): ...
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(**labels).observe(time.perf_counter() - start)
+
+
+def update_audio_cache_size(cache_dir: str):
+    """
+    Cập nhật gauge số file/dung lượng cache audio thực sự nằm trên đĩa
+    Tính cả thư mục con (by-hash/), file có nhiều tên (hard link) chỉ đếm 1 lần
+    """
+    files = 0
+    size = 0
+    seen = set()
+    for directory, _, names in os.walk(cache_dir):
+        for name in names:
+            if not name.endswith(".wav") or name.startswith("."):
+                continue
+            try:
+                stat = os.stat(os.path.join(directory, name))
+            except FileNotFoundError:
+                continue
+            if (stat.st_dev, stat.st_ino) in seen:
+                continue
+            seen.add((stat.st_dev, stat.st_ino))
+            files += 1
+            size += stat.st_size
+    AUDIO_CACHE_FILES.set(files)
+    AUDIO_CACHE_BYTES.set(size)
+
+
+def is_multiprocess() -> bool:
+    return bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+
+def render_latest() -> bytes:
+    """
+    Xuất metrics dạng text Prometheus
+    Chế độ nhiều worker: gộp file số liệu của tất cả worker trong PROMETHEUS_MULTIPROC_DIR
+    """
+    if is_multiprocess():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+def mark_process_dead(pid: int):
+    """Gọi khi worker tắt để gauge livesum không còn tính worker đó"""
+    if is_multiprocess():
+        multiprocess.mark_process_dead(pid)
+
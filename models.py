@@ -1,7 +1,7 @@
 # File: models.py
 # Mở rộng với UserProfile để chat hiệu quả hơn
 from pydantic import BaseModel, Field
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Literal
 
 class ChatRequest(BaseModel):
     query: str
@@ -13,11 +13,30 @@ class EnhancedChatRequest(BaseModel):
     history: Optional[List[Dict[str, str]]] = []
     user_profile: Optional[Dict[str, str]] = None  # {"level": "mới học", "budget": "500k", ...}
 
+# Style/thời lượng demo mặc định (nút nghe demo không gửi kèm), prefetch cũng tạo sẵn đúng clip này
+DEFAULT_DEMO_STYLE = "dân gian Việt Nam"
+DEFAULT_DEMO_DURATION = 5
+
 class ProductDemoRequest(BaseModel):
     product: str
     use_ai: bool = False
-    style: str = "dân gian Việt Nam"
-    duration: int = 5
+    style: str = DEFAULT_DEMO_STYLE
+    duration: int = DEFAULT_DEMO_DURATION
+    redirect: bool = False  # True: 303 sang URL GET theo nội dung (X-Audio-Url) thay vì trả audio
+
+class EnsembleStem(BaseModel):
+    """Một nhạc cụ trong bản hòa tấu"""
+    product: str
+    gain_db: float = Field(0.0, ge=-30, le=6, description="Âm lượng tương đối (dB)")
+    pan: float = Field(0.0, ge=-1, le=1, description="Vị trí stereo: -1 trái, 0 giữa, 1 phải")
+
+class EnsembleDemoRequest(BaseModel):
+    """Demo nhiều nhạc cụ chơi cùng lúc (vd combo đàn tranh + sáo + đàn bầu)"""
+    stems: List[EnsembleStem] = Field(..., min_length=2, max_length=6)
+    use_samples: bool = Field(True, description="Dùng file mẫu thật cho nhạc cụ có sẵn thay vì AI")
+    style: str = DEFAULT_DEMO_STYLE
+    duration: int = Field(DEFAULT_DEMO_DURATION, ge=1, le=30)
+    redirect: bool = Field(False, description="303 sang URL GET theo nội dung thay vì trả audio")
 
 class QuickConsultRequest(BaseModel):
     """Request nhanh cho consultation với thông tin đầy đủ"""
@@ -26,4 +45,16 @@ class QuickConsultRequest(BaseModel):
     purpose: str = Field(..., description="Mục đích: học/biểu diễn/trang trí/sưu tầm")
     instrument_type: Optional[str] = Field(None, description="Loại nhạc cụ: hơi/dây/gõ")
     age: Optional[int] = Field(None, description="Độ tuổi người chơi")
-    additional_info: Optional[str] = Field(None, description="Thông tin bổ sung")
\ No newline at end of file
+    additional_info: Optional[str] = Field(None, description="Thông tin bổ sung")
+
+class BatchChatItem(BaseModel):
+    """Một câu hỏi trong batch chat"""
+    intent: Literal["consultation", "guide", "story", "support"]
+    query: str
+    history: Optional[List[Dict[str, str]]] = []
+
+class BatchChatRequest(BaseModel):
+    """Request chạy nhiều câu hỏi cùng lúc (đánh giá offline, job CRM ban đêm)"""
+    items: List[BatchChatItem]
+    concurrency: int = Field(8, ge=1, le=32, description="Số câu hỏi gọi Gemini song song tối đa")
+    stream: bool = Field(False, description="Trả về NDJSON theo thứ tự hoàn thành thay vì JSON theo thứ tự gửi")
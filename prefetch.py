@@ -0,0 +1,244 @@
+# File: prefetch.py
+# Tạo trước demo AI cho nhạc cụ khách đang hỏi trên /consultation/ (bật bằng DEMO_PREFETCH_ENABLED=1)
+# Khách thường bấm nghe demo ngay sau khi chat -> generate sẵn ở mức ưu tiên thấp để /demo/ trúng cache
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional
+
+from ai_music import estimate_tokens
+from inference import QueueFullError, InferenceExecutor, PRIORITY_BACKGROUND, inference_executor
+from instruments import find_instruments_in_text
+from metrics import DEMO_PREFETCH_EVENTS
+from models import DEFAULT_DEMO_DURATION, DEFAULT_DEMO_STYLE
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_ENABLED = os.getenv("DEMO_PREFETCH_ENABLED", "0") == "1"
+# Token bucket: tối đa PER_MINUTE lần prefetch/phút, dồn tối đa BURST lần
+PREFETCH_PER_MINUTE = float(os.getenv("DEMO_PREFETCH_PER_MINUTE", "6"))
+PREFETCH_BURST = int(os.getenv("DEMO_PREFETCH_BURST", "3"))
+# Chỉ prefetch khi hàng đợi inference có không quá số việc này đang chờ
+PREFETCH_MAX_QUEUE = int(os.getenv("DEMO_PREFETCH_MAX_QUEUE", "0"))
+# Cùng 1 clip không prefetch lại trong khoảng này (giây)
+PREFETCH_DEDUP_SECONDS = float(os.getenv("DEMO_PREFETCH_DEDUP_SECONDS", "600"))
+# Bỏ qua nhạc cụ có file mẫu: demo mặc định (use_ai = False) của chúng trả file mẫu, không bao giờ đọc clip prefetch
+# Đặt 0 khi frontend luôn gửi use_ai = True
+PREFETCH_SKIP_SAMPLES = os.getenv("DEMO_PREFETCH_SKIP_SAMPLES", "1") == "1"
+
+_RECENT_MAX = 1024
+# File đánh dấu clip được tạo bởi prefetch: <key>.wav.prefetched, file đi kèm clip (xóa cùng clip)
+_MARKER_SUFFIX = ".prefetched"
+
+
+class DemoPrefetcher:
+    def __init__(self, get_generator: Callable[[], object], executor: InferenceExecutor = inference_executor,
+                 enabled: bool = PREFETCH_ENABLED):
+        """
+        :param get_generator: hàm trả về AIMusicGenerator hiện tại (None nếu chưa khởi tạo)
+        :param executor: hàng đợi inference, việc prefetch chạy ở PRIORITY_BACKGROUND
+        """
+        self.get_generator = get_generator
+        self.executor = executor
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._tokens = float(PREFETCH_BURST)
+        self._refilled_at = time.monotonic()
+        self._inflight: Dict[str, Optional[Future]] = {}  # cache key -> future (None khi đang submit)
+        self._recent: "OrderedDict[str, float]" = OrderedDict()
+        self._stats: Counter = Counter()
+
+    def _record(self, event: str):
+        with self._lock:
+            self._stats[event] += 1
+        DEMO_PREFETCH_EVENTS.labels(event=event).inc()
+
+    def _take_token(self) -> bool:
+        now = time.monotonic()
+        self._tokens = min(PREFETCH_BURST, self._tokens + (now - self._refilled_at) * PREFETCH_PER_MINUTE / 60)
+        self._refilled_at = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def _is_recent(self, cache_key: str) -> bool:
+        scheduled_at = self._recent.get(cache_key)
+        if scheduled_at is None:
+            return False
+        if time.monotonic() - scheduled_at < PREFETCH_DEDUP_SECONDS:
+            return True
+        del self._recent[cache_key]
+        return False
+
+    def _marker_path(self, generator, cache_key: str) -> str:
+        return generator.cache.path(cache_key) + _MARKER_SUFFIX
+
+    def observe_chat(self, query: str, history: Optional[List[Dict[str, str]]]) -> Optional[str]:
+        """
+        Gọi sau mỗi lượt chat: tìm nhạc cụ khách đang quan tâm (câu hỏi hiện tại + lịch sử),
+        nếu demo mặc định chưa có trong cache thì xếp việc generate nền
+        Trả về cache key đã xếp hàng, None nếu bỏ qua. Không bao giờ raise.
+        """
+        if not self.enabled:
+            return None
+        try:
+            return self._observe(query, history)
+        except Exception as e:
+            logger.error(f"❌ Lỗi prefetch demo: {str(e)}")
+            return None
+
+    def _observe(self, query: str, history: Optional[List[Dict[str, str]]]) -> Optional[str]:
+        generator = self.get_generator()
+        if generator is None or not generator.use_cache:
+            return None
+
+        # Nhạc cụ được nhắc gần nhất (câu hiện tại trước, rồi lịch sử) là nhạc cụ khách sắp bấm nghe
+        turns = [item.get("user", "") for item in (history or [])] + [query]
+        mentioned = find_instruments_in_text(" ".join(turns))
+        if not mentioned:
+            return None
+        inst = mentioned[-1]
+
+        if PREFETCH_SKIP_SAMPLES and inst.sample_path:
+            self._record("skipped_sample")
+            return None
+
+        cache_key = generator._get_cache_key(inst.key, DEFAULT_DEMO_STYLE, DEFAULT_DEMO_DURATION)
+        with self._lock:
+            duplicate = cache_key in self._inflight or self._is_recent(cache_key)
+        if duplicate:
+            self._record("skipped_duplicate")
+            return None
+
+        # Chỉ kiểm tra tầng local ở đây (rẻ), cache dùng chung được kiểm tra trong việc nền
+        if generator.cache.local.exists(cache_key):
+            self._record("already_cached")
+            return None
+
+        if self.executor.depth > PREFETCH_MAX_QUEUE:
+            self._record("skipped_busy")
+            return None
+
+        with self._lock:
+            if cache_key in self._inflight or self._is_recent(cache_key):
+                return None
+            rate_limited = not self._take_token()
+            if not rate_limited:
+                self._inflight[cache_key] = None
+                self._recent[cache_key] = time.monotonic()
+                self._recent.move_to_end(cache_key)
+                while len(self._recent) > _RECENT_MAX:
+                    self._recent.popitem(last=False)
+        if rate_limited:
+            self._record("skipped_rate_limited")
+            return None
+
+        try:
+            future = self.executor.submit(
+                self._prefetch, generator, inst.key, cache_key,
+                priority=PRIORITY_BACKGROUND, cost=estimate_tokens(DEFAULT_DEMO_DURATION), client="prefetch",
+            )
+        except QueueFullError:
+            with self._lock:
+                self._inflight.pop(cache_key, None)
+                self._recent.pop(cache_key, None)
+            self._record("skipped_busy")
+            return None
+        with self._lock:
+            if cache_key in self._inflight:
+                self._inflight[cache_key] = future
+        future.add_done_callback(lambda f: self._done(cache_key, f))
+        self._record("scheduled")
+        logger.info(f"🔮 Prefetch demo {inst.key} ({cache_key})")
+        return cache_key
+
+    def _prefetch(self, generator, instrument: str, cache_key: str) -> bool:
+        """Chạy trong thread inference. True nếu đã generate mới, False nếu clip đã có sẵn"""
+        if generator.cache.exists(cache_key):
+            return False
+        generator.generate(instrument=instrument, style=DEFAULT_DEMO_STYLE, duration=DEFAULT_DEMO_DURATION)
+        # Nhạc cụ trả file mẫu (đàn bầu) thì không có gì được lưu vào cache
+        if not generator.cache.local.exists(cache_key):
+            return False
+        with open(self._marker_path(generator, cache_key), "w") as f:
+            f.write(str(time.time()))
+        return True
+
+    def _done(self, cache_key: str, future):
+        with self._lock:
+            self._inflight.pop(cache_key, None)
+        if future.cancelled():
+            # /demo/ cần clip này khi việc prefetch còn chờ: request tự generate ở mức ưu tiên cao hơn
+            self._record("cancelled")
+        elif future.exception() is not None:
+            logger.error(f"❌ Prefetch {cache_key} thất bại: {str(future.exception())}")
+            self._record("failed")
+        elif future.result():
+            self._record("completed")
+        else:
+            self._record("already_cached")
+
+    async def wait_inflight(self, instrument: str, style: str, duration: float) -> bool:
+        """
+        Gọi khi /demo/ sắp generate (cache miss): clip đang được prefetch thì dùng chung, không generate lần 2
+        - Việc prefetch đang chạy: chờ nó xong, trả về True (clip đã vào cache nếu thành công)
+        - Còn chờ trong hàng đợi (mức ưu tiên nền, có thể phải chờ lâu): hủy, trả về False để request tự generate
+        """
+        generator = self.get_generator()
+        if generator is None or not generator.use_cache:
+            return False
+        cache_key = generator._get_cache_key(instrument, style, duration)
+        with self._lock:
+            future = self._inflight.get(cache_key)
+        if future is None or future.cancel():
+            return False
+        logger.info(f"🔮 Chờ prefetch đang chạy cho {cache_key}")
+        try:
+            await asyncio.wrap_future(future)
+        except Exception:
+            # Prefetch lỗi: request tự generate lại
+            pass
+        self._record("joined")
+        return True
+
+    def record_demand(self, instrument: str, style: str, duration: float):
+        """
+        Gọi khi /demo/ cần clip AI: đếm hit nếu clip này do prefetch tạo ra (mỗi clip chỉ tính 1 lần)
+        File đánh dấu nằm trong thư mục cache nên các worker cùng node đều thấy
+        """
+        if not self.enabled:
+            return
+        generator = self.get_generator()
+        if generator is None or not generator.use_cache:
+            return
+        if style != DEFAULT_DEMO_STYLE or float(duration) != float(DEFAULT_DEMO_DURATION):
+            return
+        cache_key = generator._get_cache_key(instrument, style, duration)
+        try:
+            os.unlink(self._marker_path(generator, cache_key))
+            self._record("hit")
+        except FileNotFoundError:
+            self._record("miss")
+
+    def stats(self) -> dict:
+        """Thống kê của process hiện tại (tổng các worker: xem /metrics demo_prefetch_events_total)"""
+        with self._lock:
+            stats = dict(self._stats)
+            inflight = len(self._inflight)
+        completed = stats.get("completed", 0)
+        hits = stats.get("hit", 0)
+        demand = hits + stats.get("miss", 0)
+        return {
+            "enabled": self.enabled,
+            "events": stats,
+            "inflight": inflight,
+            # Tỉ lệ clip prefetch được khách nghe thật (thấp = tốn GPU vô ích)
+            "hit_rate": round(hits / completed, 3) if completed else None,
+            # Tỉ lệ lượt nghe demo mặc định đã có sẵn nhờ prefetch
+            "coverage": round(hits / demand, 3) if demand else None,
+        }
@@ -0,0 +1,114 @@
+# File: profiler.py
+# Sampling profiler chạy trong process: lấy stack của mọi thread định kỳ trong N giây
+# Kết quả dạng "folded stacks" (mỗi dòng: frame;frame;frame count) dùng cho flamegraph.pl / speedscope
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+MAX_PROFILE_SECONDS = 300
+
+
+class SamplingProfiler:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._stacks: Counter = Counter()
+        self.samples = 0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.seconds = 0.0
+        self.interval_ms = 0.0
+        self.output_file: Optional[str] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds: float, interval_ms: float = 10.0):
+        """Bắt đầu lấy mẫu trong `seconds` giây, mỗi `interval_ms` ms một lần"""
+        with self._lock:
+            if self.running:
+                raise RuntimeError("Profiler đang chạy")
+            self._stacks = Counter()
+            self.samples = 0
+            self.seconds = min(seconds, MAX_PROFILE_SECONDS)
+            self.interval_ms = interval_ms
+            self.started_at = time.time()
+            self.finished_at = None
+            self.output_file = None
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+        logger.info(f"🔬 Profiler started for {self.seconds}s (interval {interval_ms}ms)")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        names = {}
+        deadline = time.perf_counter() + self.seconds
+        interval = self.interval_ms / 1000
+        while not self._stop.is_set() and time.perf_counter() < deadline:
+            if len(names) != threading.active_count():
+                names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                self._stacks[self._fold(names.get(thread_id, str(thread_id)), frame)] += 1
+            self.samples += 1
+            self._stop.wait(interval)
+
+        self.finished_at = time.time()
+        self._write_output()
+        logger.info(f"🔬 Profiler finished: {self.samples} samples")
+
+    @staticmethod
+    def _fold(thread_name: str, frame) -> str:
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+            frame = frame.f_back
+        frames.append(thread_name)
+        return ";".join(reversed(frames))
+
+    def folded(self) -> str:
+        """Kết quả dạng folded stacks, stack nhiều mẫu nhất lên trước"""
+        return "\n".join(f"{stack} {count}" for stack, count in self._stacks.most_common())
+
+    def _write_output(self):
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, f"profile-{os.getpid()}-{int(self.started_at)}.folded")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(self.folded() + "\n")
+            self.output_file = path
+        except Exception as e:
+            logger.error(f"❌ Lỗi ghi profile: {str(e)}")
+
+    def status(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "running": self.running,
+            "seconds": self.seconds,
+            "interval_ms": self.interval_ms,
+            "samples": self.samples,
+            "unique_stacks": len(self._stacks),
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "output_file": self.output_file,
+        }
+
+
+profiler = SamplingProfiler()
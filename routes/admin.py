@@ -0,0 +1,72 @@
+# File: routes/admin.py
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+from profiler import profiler
+from inference import inference_executor
+from typing import Optional
+import hmac
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+
+def admin_token_valid(x_admin_token: Optional[str]) -> bool:
+    """Token khớp ADMIN_TOKEN (so sánh thời gian hằng); chưa đặt ADMIN_TOKEN thì luôn False"""
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token or not x_admin_token:
+        return False
+    return hmac.compare_digest(x_admin_token.encode(), admin_token.encode())
+
+
+def require_admin(x_admin_token: str = Header(None)):
+    """
+    Chỉ cho phép khi header X-Admin-Token khớp biến môi trường ADMIN_TOKEN
+    Không đặt ADMIN_TOKEN thì tắt toàn bộ API admin
+    """
+    if not os.getenv("ADMIN_TOKEN"):
+        raise HTTPException(status_code=404, detail="API admin chưa được bật")
+    # So sánh thời gian hằng, không lộ token qua thời gian phản hồi
+    if not admin_token_valid(x_admin_token):
+        raise HTTPException(status_code=403, detail="Sai admin token")
+
+
+@router.post("/profiler/start", dependencies=[Depends(require_admin)])
+async def start_profiler(
+    seconds: float = Query(30.0, gt=0, le=300, description="Thời gian lấy mẫu (giây)"),
+    interval_ms: float = Query(10.0, ge=1, le=1000, description="Khoảng cách giữa 2 lần lấy mẫu (ms)"),
+):
+    """
+    Bật sampling profiler trong worker nhận request này
+    (chạy nhiều worker thì mỗi lần gọi chỉ profile 1 worker, xem "pid" trong kết quả)
+    """
+    try:
+        profiler.start(seconds, interval_ms)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return profiler.status()
+
+
+@router.get("/profiler/status", dependencies=[Depends(require_admin)])
+async def profiler_status():
+    return profiler.status()
+
+
+@router.get("/profiler/flamegraph", dependencies=[Depends(require_admin)])
+async def profiler_flamegraph():
+    """
+    Kết quả dạng folded stacks: dùng với flamegraph.pl hoặc kéo thả vào speedscope.app
+    """
+    if profiler.running:
+        raise HTTPException(status_code=409, detail="Profiler đang chạy, thử lại sau")
+    if profiler.samples == 0:
+        raise HTTPException(status_code=404, detail="Chưa có dữ liệu profile")
+    return PlainTextResponse(profiler.folded())
+
+
+@router.get("/inference/queue", dependencies=[Depends(require_admin)])
+async def inference_queue():
+    """Các việc generate đang chờ trong worker này, theo thứ tự sẽ chạy"""
+    return {"pid": os.getpid(), "max_queue": inference_executor.max_queue, "pending": inference_executor.snapshot()}
@@ -0,0 +1,58 @@
+# File: routes/audio_files.py
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse
+from content_store import IMMUTABLE_CACHE_CONTROL, MEDIA_TYPES, DIGEST_LENGTH, audio_media_type, resolve_sample
+import routes.demo_audio as demo_audio
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+_FILENAME_PATTERN = re.compile(rf"^([0-9a-f]{{{DIGEST_LENGTH}}})(\.wav|\.mp3)$")
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """So khớp If-None-Match kiểu weak (bỏ tiền tố W/), hỗ trợ danh sách và *"""
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any((tag[2:] if tag.startswith("W/") else tag) == etag for tag in candidates)
+
+
+def _resolve(digest: str, ext: str):
+    ai_generator = demo_audio.ai_generator
+    if ai_generator is not None and ai_generator.content is not None:
+        path = ai_generator.content.resolve(digest, ext)
+        if path:
+            return path
+    return resolve_sample(digest, ext)
+
+
+@router.api_route("/{filename}", methods=["GET", "HEAD"])
+async def get_audio(filename: str, request: Request):
+    """
+    Audio theo địa chỉ nội dung (file mẫu hoặc clip AI đã cache), URL lấy từ header X-Audio-Url của /demo/
+    - Nội dung không bao giờ đổi: Cache-Control immutable 1 năm, ETag = digest
+    - Digest không tồn tại -> 404 (kể cả khi có If-None-Match); If-None-Match khớp -> 304; Range -> 206 (tua trong player)
+    """
+    match = _FILENAME_PATTERN.match(filename)
+    if not match:
+        raise HTTPException(status_code=404, detail="Không tìm thấy audio")
+    digest, ext = match.groups()
+
+    # Tìm file trước: digest không còn (đã xoá cache) phải trả 404, không được 304 theo ETag cũ của client
+    path = await run_in_threadpool(_resolve, digest, ext)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy audio")
+
+    etag = f'"{digest}"'
+    headers = {"ETag": etag, "Cache-Control": IMMUTABLE_CACHE_CONTROL}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    # FileResponse tự xử lý Range / If-Range theo ETag ở trên
+    return FileResponse(path, media_type=audio_media_type(path), headers=headers)
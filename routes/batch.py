@@ -0,0 +1,90 @@
+# File: routes/batch.py
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+from models import BatchChatRequest, BatchChatItem
+from utils import process_chat_query
+import asyncio
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+MAX_BATCH_ITEMS = 500
+
+
+async def _run_item(index: int, item: BatchChatItem, semaphore: asyncio.Semaphore) -> dict:
+    """
+    Chạy 1 câu hỏi qua process_chat_query, giới hạn bởi semaphore
+    Lỗi của từng câu được ghi vào kết quả, không làm hỏng cả batch
+    """
+    history = item.history or []
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            # raise_errors: lỗi Gemini vào "error" của câu này, không thành câu trả lời trong lịch sử
+            response = await process_chat_query(item.query, history, intent=item.intent, raise_errors=True)
+            error = None
+        except Exception as e:
+            logger.error(f"❌ Lỗi batch item {index}: {str(e)}")
+            response = None
+            error = str(e)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+    result = {
+        "index": index,
+        "intent": item.intent,
+        "response": response,
+        "elapsed_ms": round(elapsed_ms, 2),
+        "error": error,
+    }
+    if error is None:
+        result["updated_history"] = history + [{"user": item.query, "ai": response}]
+    return result
+
+
+@router.post("/chat")
+async def batch_chat(request: BatchChatRequest):
+    """
+    Endpoint chạy nhiều câu hỏi (nhiều intent) trong 1 request
+    - Gọi song song với số lượng tối đa = concurrency
+    - stream = False: trả JSON, kết quả đúng thứ tự gửi
+    - stream = True: trả NDJSON, mỗi dòng là 1 kết quả ngay khi xong (có "index" để ghép lại)
+    """
+    if not request.items:
+        raise HTTPException(status_code=400, detail="Danh sách câu hỏi trống")
+    if len(request.items) > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Tối đa {MAX_BATCH_ITEMS} câu hỏi mỗi batch")
+
+    logger.info(f"📦 Batch chat: {len(request.items)} câu hỏi, concurrency={request.concurrency}")
+
+    if request.stream:
+        async def ndjson_stream():
+            semaphore = asyncio.Semaphore(request.concurrency)
+            tasks = [asyncio.create_task(_run_item(i, item, semaphore)) for i, item in enumerate(request.items)]
+            try:
+                for next_done in asyncio.as_completed(tasks):
+                    result = await next_done
+                    yield json.dumps(result, ensure_ascii=False) + "\n"
+            finally:
+                # Client ngắt kết nối giữa chừng thì hủy các câu chưa chạy
+                for task in tasks:
+                    task.cancel()
+
+        return StreamingResponse(ndjson_stream(), media_type="application/x-ndjson")
+
+    semaphore = asyncio.Semaphore(request.concurrency)
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *(_run_item(i, item, semaphore) for i, item in enumerate(request.items))
+    )
+    total_ms = (time.perf_counter() - start) * 1000
+
+    return {
+        "results": results,
+        "count": len(results),
+        "errors": sum(1 for r in results if r["error"] is not None),
+        "total_ms": round(total_ms, 2),
+    }
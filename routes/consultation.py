@@ -2,20 +2,30 @@
 from fastapi import APIRouter, HTTPException
 from models import ChatRequest, QuickConsultRequest
 from utils import process_chat_query, gemini_generate_text
+from instruments import INSTRUMENTS, find_instruments_in_text
+from token_budget import TrimLevel, fit_prompt
 import httpx
 import json
+import time
+from metrics import CATALOG_FETCH_SECONDS
+from tracing import span
+from routes.demo_audio import demo_prefetcher
 
 router = APIRouter()
 
 async def fetch_courses():
     """Lấy danh sách sản phẩm từ API"""
+    start = time.perf_counter()
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.get("https://api.music.3docorp.vn/api/Course###")
+        with span("catalog.fetch"):
+            async with httpx.AsyncClient(timeout=10.0) as client:
+                response = await client.get("https://api.music.3docorp.vn/api/Course###")
             response.raise_for_status()
             data = response.json()
+            CATALOG_FETCH_SECONDS.labels(outcome="ok").observe(time.perf_counter() - start)
             return data.get("data", [])
     except Exception as e:
+        CATALOG_FETCH_SECONDS.labels(outcome="error").observe(time.perf_counter() - start)
         print(f"Error fetching courses: {e}")
         return []
 
@@ -44,27 +54,52 @@ Tồn kho: {course.get('stock', 0)}
 """
     return formatted
 
+def rank_courses(courses: list, instrument_type: str = None, text: str = None) -> list:
+    """
+    Sắp xếp catalog để phần đầu danh sách là sản phẩm nên gợi ý: còn hàng trước,
+    sản phẩm của nhạc cụ khách nhắc tới trong text trước, đúng loại nhạc cụ khách chọn (hơi/dây/gõ) trước;
+    còn lại giữ thứ tự của API. Sản phẩm <-> nhạc cụ theo course_id trong registry
+    """
+    wanted = (instrument_type or "").strip().lower()
+    mentioned = {inst.course_id for inst in find_instruments_in_text(text or "") if inst.course_id}
+    family_courses = {inst.course_id for inst in INSTRUMENTS.values() if inst.course_id and inst.family == wanted}
+
+    def matches_type(course) -> bool:
+        if course.get('courseId') in family_courses:
+            return True
+        category = course.get('category')
+        name = category.get('name', '') if category and isinstance(category, dict) else ''
+        return bool(wanted) and wanted in (name or '').lower()
+
+    return sorted(courses, key=lambda c: (
+        (c.get('stock') or 0) <= 0, c.get('courseId') not in mentioned, not matches_type(c)
+    ))
+
+# Thương hiệu/model/chất liệu -> courseId, bổ sung cho tên nhạc cụ (registry, course_id) khi nhận diện sản phẩm
+# Không nằm trong registry: "donner" hay "tone d" không phải tên nhạc cụ để tạo demo
+PRODUCT_KEYWORDS = {
+    1: ["trúc", "tone d"],
+    2: ["donner", "ddp-200"],
+    3: ["meinl", "mcaj100"],
+}
+
+
 async def extract_product_id_from_response(ai_response: str, courses: list) -> int:
     """
     Trích xuất product ID phù hợp nhất từ response của AI
-    Sử dụng keyword matching với tên sản phẩm
+    Mỗi nhạc cụ có course_id được nhắc tới (registry) + mỗi từ khóa sản phẩm (PRODUCT_KEYWORDS) được 1 điểm
     """
     ai_lower = ai_response.lower()
-    
-    # Danh sách từ khóa để mapping
-    keywords_map = {
-        1: ["sáo trúc", "sáo", "trúc", "tone d"],
-        2: ["piano", "đàn piano", "donner", "ddp-200"],
-        3: ["cajon", "trống", "meinl", "mcaj100"],
-        4: ["guitar", "đờn guitar"]
-    }
-    
+
     # Tính điểm match cho mỗi sản phẩm
     scores = {}
-    for course_id, keywords in keywords_map.items():
+    for inst in find_instruments_in_text(ai_response):
+        if inst.course_id:
+            scores[inst.course_id] = scores.get(inst.course_id, 0) + 1
+    for course_id, keywords in PRODUCT_KEYWORDS.items():
         score = sum(1 for kw in keywords if kw in ai_lower)
         if score > 0:
-            scores[course_id] = score
+            scores[course_id] = scores.get(course_id, 0) + score
     
     # Trả về ID có điểm cao nhất
     if scores:
@@ -76,6 +111,8 @@ async def extract_product_id_from_response(ai_response: str, courses: list) -> i
 @router.post("/")
 async def consult_instrument(request: ChatRequest):
     """Endpoint chat thông thường với history"""
+    # Xếp hàng tạo sẵn demo cho nhạc cụ đang được hỏi (chạy nền, không chờ)
+    demo_prefetcher.observe_chat(request.query, request.history)
     response = await process_chat_query(request.query, request.history, intent="consultation")
     
     new_entry = {"user": request.query, "ai": response}
@@ -99,10 +136,18 @@ async def quick_consult(request: QuickConsultRequest):
     if not courses:
         raise HTTPException(status_code=503, detail="Không thể lấy thông tin sản phẩm")
     
-    # Format thông tin sản phẩm
-    courses_info = format_courses_for_prompt(courses)
-    
-    prompt = f"""
+    # Sản phẩm phù hợp nhất đứng đầu: cắt catalog theo ngân sách token thì giữ lại những sản phẩm này
+    ranked_courses = rank_courses(courses, request.instrument_type, request.additional_info)
+
+    def build_prompt(level: TrimLevel) -> str:
+        # Format thông tin sản phẩm
+        courses_info = format_courses_for_prompt(ranked_courses[:level.catalog_limit])
+        example = """
+Ví dụ tốt:
+"Với người mới học và mục đích tự học tại nhà, nên chọn Sáo trúc cho người mới bắt đầu giá 299k, dễ thổi, âm ấm, kèm giáo trình PDF + túi vải + dây treo."
+""" if level.optional_context else ""
+
+        return f"""
 🎯 QUY TẮC: Trả lời TỐI ĐA 3-4 câu (60-80 từ)
 
 {courses_info}
@@ -122,19 +167,18 @@ Nhiệm vụ:
 2. Gợi ý NGẮN GỌN theo format:
 
 "Với [trình độ] và [mục đích], nên chọn [TÊN CHÍNH XÁC SẢN PHẨM] giá [X]k, [đặc điểm nổi bật], kèm [combo phụ kiện nếu có]."
-
-Ví dụ tốt:
-"Với người mới học và mục đích tự học tại nhà, nên chọn Sáo trúc cho người mới bắt đầu giá 299k, dễ thổi, âm ấm, kèm giáo trình PDF + túi vải + dây treo."
-
+{example}
 LƯU Ý: 
 - Phải GHI RÕ TÊN SẢN PHẨM từ danh sách
 - CHỈ gợi ý 1 sản phẩm duy nhất
 - Ưu tiên sản phẩm còn hàng (stock > 0)
 - Phù hợp với ngân sách
 """
+
+    prompt = fit_prompt("quick", build_prompt, has_catalog=True)
     
     # Gọi Gemini để sinh gợi ý
-    ai_suggestion = await gemini_generate_text(prompt)
+    ai_suggestion = await gemini_generate_text(prompt, intent="quick")
     
     # Trích xuất product ID từ response
     suggested_product_id = await extract_product_id_from_response(ai_suggestion, courses)
@@ -1,85 +1,99 @@
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import StreamingResponse, FileResponse
-from models import ProductDemoRequest
-from ai_music import AIMusicGenerator
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, FileResponse, RedirectResponse
+from io import BytesIO
+from models import ProductDemoRequest, EnsembleDemoRequest
+from ai_music import AIMusicGenerator, estimate_tokens
+from ensemble import (
+    ENSEMBLE_SAMPLE_RATE, SOURCE_CACHE, SOURCE_GENERATED, SOURCE_SAMPLE,
+    ensemble_cache_key, load_sample, mix,
+)
+from metrics import AUDIO_CACHE_REQUESTS, DEMO_FALLBACKS
+from waveform import clip_waveform_url, sample_waveform_url
+from content_store import audio_media_type, content_url, digest_file
+from instruments import normalize_text, lookup_instrument
+from inference import inference_executor, ClientQueueFullError, QueueFullError, PRIORITY_BACKGROUND
+from audio_index import ClipIndex
+from prefetch import DemoPrefetcher
+from typing import Optional
 import os
+import threading
 import logging
-import unicodedata
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
-SAMPLE_DIR = "samples"
-INSTRUMENT_SAMPLES = {
-    "sao": "sao.mp3",
-    "dan tranh": "dan_tranh.mp3",
-    "dan bau": "dan_bau.mp3",
-    "dan nguyet": "dan_nguyet.mp3",
-    "dan nhi": "dan_nhi.mp3",
-    "dan da": "dan_da.mp3",
-    "dan day": "dan_day.mp3",
-    "dan sen": "dan_sen.mp3",
-    "dan ty ba": "dan_ty_ba.mp3",
-    "danh tranh": "danh_tranh1.mp3",
-    "ken be": "khen_be.mp3",
-    "t rung": "t_rung.mp3",
-}
-
-
-def normalize_text(text: str) -> str:
-    """
-    Chuẩn hóa text: bỏ dấu, chuyển thành chữ thường
-    Ví dụ: "Đàn Tranh" -> "dan tranh"
-    """
-    if not text:
-        return ""
-    
-    # Bỏ dấu tiếng Việt
-    text = unicodedata.normalize('NFD', text)
-    text = ''.join(char for char in text if unicodedata.category(char) != 'Mn')
-    
-    # Chuyển đ -> d, Đ -> d
-    text = text.replace('đ', 'd').replace('Đ', 'd')
-    
-    # Chuyển thành chữ thường và bỏ khoảng trắng thừa
-    text = text.lower().strip()
-    
-    # Chuẩn hóa nhiều khoảng trắng thành 1
-    text = ' '.join(text.split())
-    
-    return text
+def client_key(http_request: Request) -> str:
+    """
+    Định danh client cho lập lịch công bằng và giới hạn số việc chờ: địa chỉ peer của kết nối
+    Không dùng header do client tự gửi (X-Client-Id...): đổi header mỗi request là lách được giới hạn
+    Sau reverse proxy: chạy uvicorn --proxy-headers --forwarded-allow-ips=<IP proxy> để peer là IP thật
+    """
+    return f"ip:{http_request.client.host if http_request.client else 'unknown'}"
 
 
 def find_instrument_sample(instrument_name: str) -> str:
     """
-    Tìm file sample cho nhạc cụ, hỗ trợ cả có dấu và không dấu
+    Tìm file sample cho nhạc cụ qua registry, hỗ trợ có dấu/không dấu, tên gọi khác và gõ sai nhẹ
     Trả về đường dẫn file nếu tìm thấy, None nếu không
     """
-    normalized_input = normalize_text(instrument_name)
-    
-    # Tìm trong dictionary
-    for key, filename in INSTRUMENT_SAMPLES.items():
-        if normalize_text(key) == normalized_input:
-            file_path = os.path.join(SAMPLE_DIR, filename)
-            if os.path.exists(file_path):
-                return file_path
-    
-    return None
+    inst = lookup_instrument(instrument_name)
+    return inst.sample_path if inst else None
 
 
 # Khởi tạo AI Generator với auto-detect device
-try:
-    logger.info("🚀 Initializing AI Music Generator...")
-    ai_generator = AIMusicGenerator()  # Tự động detect device tốt nhất
-    
-    # In ra thông tin device
-    device_info = ai_generator.get_device_info()
-    logger.info(f"📊 Device Info: {device_info}")
-    
-except Exception as e:
-    logger.error(f"❌ Lỗi khởi tạo AIMusicGenerator: {str(e)}")
+# AI_MUSIC_ENABLED=0 để bỏ qua load MusicGen (vd: benchmark tự gắn generator giả)
+if os.getenv("AI_MUSIC_ENABLED", "1") == "0":
+    logger.info("⏭️ AI Music Generator bị tắt (AI_MUSIC_ENABLED=0)")
     ai_generator = None
+else:
+    try:
+        logger.info("🚀 Initializing AI Music Generator...")
+        ai_generator = AIMusicGenerator()  # Tự động detect device tốt nhất
+        
+        # In ra thông tin device
+        device_info = ai_generator.get_device_info()
+        logger.info(f"📊 Device Info: {device_info}")
+        
+    except Exception as e:
+        logger.error(f"❌ Lỗi khởi tạo AIMusicGenerator: {str(e)}")
+        ai_generator = None
+
+# Không có generator (model lỗi, AI_MUSIC_ENABLED=0) vẫn fallback bằng file mẫu + audio_cache/ mặc định
+_default_clip_index = ClipIndex()
+
+
+def current_clip_index() -> ClipIndex:
+    """Index fallback trên thư mục cache của generator đang dùng (đọc lúc chạy, benchmark gắn generator khác)"""
+    return ai_generator.index if ai_generator is not None else _default_clip_index
+
+
+# Tạo trước demo cho nhạc cụ khách đang chat (DEMO_PREFETCH_ENABLED=1), đọc ai_generator lúc chạy
+demo_prefetcher = DemoPrefetcher(lambda: ai_generator)
+
+
+@router.on_event("startup")
+async def warmup_model():
+    """INFERENCE_WARMUP=1: chạy thử model ở mức ưu tiên thấp nhất, nhường mọi request thật"""
+    if ai_generator is not None and os.getenv("INFERENCE_WARMUP", "0") == "1":
+        inference_executor.submit(ai_generator.warmup, priority=PRIORITY_BACKGROUND, cost=8, client="warmup")
+
+
+@router.on_event("startup")
+async def build_clip_index():
+    """
+    Index embedding file mẫu + cache cho fallback ở thread nền (giải mã mp3 chậm, không chặn khởi động)
+    Thread này cũng quét lại thư mục cache định kỳ để nhận clip do worker khác lưu
+    """
+    threading.Thread(target=current_clip_index().maintain, name="clip-index", daemon=True).start()
+
+
+@router.on_event("shutdown")
+async def flush_audio_cache():
+    """Đẩy nốt các file đang chờ ghi lên cache dùng chung trước khi tắt"""
+    if ai_generator is not None and ai_generator.cache is not None:
+        ai_generator.cache.flush()
 
 
 @router.get("/device-info")
@@ -106,12 +120,82 @@ async def get_device_info():
     return info
 
 
+def _audio_link_headers(url: str) -> dict:
+    """Trỏ tới bản GET theo nội dung (browser/CDN cache được) của audio đang trả"""
+    return {"X-Audio-Url": url, "Link": f'<{url}>; rel="alternate"'}
+
+
+async def sample_response(instrument: str, sample_path: str, redirect: bool = False):
+    """Trả file mẫu, hoặc 303 sang URL theo nội dung nếu redirect = True"""
+    ext = os.path.splitext(sample_path)[1].lower()
+    url = content_url(await run_in_threadpool(digest_file, sample_path), ext)
+    if redirect:
+        return RedirectResponse(url, status_code=303, headers=_audio_link_headers(url))
+    return FileResponse(
+        sample_path,
+        media_type=audio_media_type(sample_path),
+        headers={
+            "Content-Disposition": f"attachment; filename={normalize_text(instrument)}_demo{ext}",
+            "X-Waveform-Url": sample_waveform_url(normalize_text(instrument)),
+            **_audio_link_headers(url),
+        },
+    )
+
+
+async def clip_response(audio_io, cache_key: Optional[str], headers: dict, redirect: bool = False):
+    """
+    Trả clip WAV (vừa tạo hoặc từ cache); clip nằm trong cache thì kèm URL theo nội dung + waveform
+    redirect = True: 303 sang URL theo nội dung thay vì trả bytes (không có URL thì vẫn trả bytes)
+    """
+    digest = None
+    if ai_generator is not None and cache_key:
+        digest = await run_in_threadpool(ai_generator.publish_clip, cache_key)
+    # Không có clip trong cache (vd: file mẫu đàn bầu cắt sẵn) -> không có URL
+    if digest:
+        url = content_url(digest, ".wav")
+        if redirect:
+            return RedirectResponse(url, status_code=303, headers=_audio_link_headers(url))
+        headers = {**headers, "X-Waveform-Url": clip_waveform_url(cache_key), **_audio_link_headers(url)}
+    # Clip đã nằm trọn trong bộ nhớ: trả 1 lần, không stream từng dòng qua threadpool
+    return Response(content=audio_io.getvalue(), media_type="audio/wav", headers=headers)
+
+
+async def fallback_response(instrument: str, style: str, duration: float, reason: str):
+    """
+    Clip gần nhất trong index thay cho clip không generate được, None nếu index chưa có clip nào
+    Header X-Demo-Fallback (lý do) + X-Fallback-Match (mức khớp) để frontend báo đây là bản gần đúng
+    """
+    found = await run_in_threadpool(current_clip_index().nearest, instrument, style, duration)
+    if found is None:
+        DEMO_FALLBACKS.labels(reason=reason, match="none").inc()
+        return None
+    entry, match = found
+    DEMO_FALLBACKS.labels(reason=reason, match=match).inc()
+    logger.warning(f"🔁 Fallback ({reason}) cho {instrument}: {entry.path} [{match}]")
+    ext = os.path.splitext(entry.path)[1].lower()
+    return FileResponse(
+        entry.path,
+        media_type=audio_media_type(entry.path),
+        headers={
+            "Content-Disposition": f"attachment; filename={instrument}_fallback{ext}",
+            "X-Demo-Fallback": reason,
+            "X-Fallback-Match": match,
+            "X-Fallback-Instrument": entry.instrument or "",
+            "X-Fallback-Style": entry.style or "",
+            # Bản gần đúng: không để browser/proxy giữ lại thay cho clip thật
+            "Cache-Control": "no-store",
+        },
+    )
+
+
 @router.post("/")
-async def demo_audio(request: ProductDemoRequest):
+async def demo_audio(request: ProductDemoRequest, http_request: Request):
     """
     API trả về demo âm thanh nhạc cụ
     - Nếu use_ai = False và có sample thật thì trả về file sample
     - Nếu use_ai = True hoặc không có sample thì dùng AI generator
+    - Clip đã có trong cache trả ngay, không xếp hàng; clip mới xếp hàng theo độ dài (ngắn chạy trước)
+    - Hàng đợi đầy / model chưa nạp / generate lỗi: trả clip gần nhất trong index (header X-Demo-Fallback)
     Hỗ trợ cả tên có dấu và không dấu (vd: "đàn tranh" hoặc "dan tranh")
     """
     instrument = request.product
@@ -121,42 +205,175 @@ async def demo_audio(request: ProductDemoRequest):
         sample_path = find_instrument_sample(instrument)
         if sample_path:
             logger.info(f"✅ Trả file mẫu cho {instrument}")
-            return FileResponse(
-                sample_path,
-                media_type="audio/wav",
-                headers={"Content-Disposition": f"attachment; filename={normalize_text(instrument)}_demo.wav"},
-            )
+            return await sample_response(instrument, sample_path, request.redirect)
         else:
             logger.warning(f"⚠️ Không tìm thấy file mẫu cho {instrument}, chuyển sang AI")
 
+    # Chuẩn hóa tên nhạc cụ cho AI (tên chuẩn trong registry nếu có)
+    inst = lookup_instrument(instrument)
+    normalized_instrument = inst.key if inst else normalize_text(instrument)
+
     # Sử dụng AI Generator
     if ai_generator is None:
+        response = await fallback_response(normalized_instrument, request.style, request.duration, "model_unavailable")
+        if response is not None:
+            return response
         raise HTTPException(status_code=500, detail="Trình tạo âm thanh AI chưa được khởi tạo")
 
     try:
         logger.info(f"🎵 Đang tạo âm thanh AI cho {instrument} trên {ai_generator.device}...")
         
-        # Chuẩn hóa tên nhạc cụ cho AI (bỏ dấu để mapping với instrument_map)
-        normalized_instrument = normalize_text(instrument)
-        
-        audio_io = ai_generator.generate(
-            instrument=normalized_instrument,
-            style=request.style,
-            duration=request.duration,
+        # Cache hit / file mẫu: trả ngay, không chờ sau các việc generate trong hàng đợi
+        # cache_key chỉ có khi bytes trả về đúng là clip trong cache (file mẫu đàn bầu -> None)
+        audio_io, cache_key = await run_in_threadpool(
+            ai_generator.lookup_cached, normalized_instrument, request.style, request.duration
         )
+        # Clip đang được prefetch: chờ chung rồi đọc lại cache thay vì generate lần 2
+        if audio_io is None and await demo_prefetcher.wait_inflight(
+                normalized_instrument, request.style, request.duration):
+            audio_io, cache_key = await run_in_threadpool(
+                ai_generator.lookup_cached, normalized_instrument, request.style, request.duration
+            )
+        # Sau khi chờ prefetch: clip prefetch vừa xong cũng được tính là hit
+        demo_prefetcher.record_demand(normalized_instrument, request.style, request.duration)
+        if audio_io is None:
+            # Chạy trong hàng đợi inference, không chặn event loop
+            audio_io = await inference_executor.run(
+                ai_generator.generate,
+                instrument=normalized_instrument,
+                style=request.style,
+                duration=request.duration,
+                check_cache=False,
+                cost=estimate_tokens(request.duration),
+                client=client_key(http_request),
+            )
+            cache_key = ai_generator._get_cache_key(normalized_instrument, request.style, request.duration)
+            logger.info(f"✅ Đã tạo xong âm thanh AI cho {instrument}")
         
-        logger.info(f"✅ Đã tạo xong âm thanh AI cho {instrument}")
-        
-        return StreamingResponse(
+        return await clip_response(
             audio_io,
-            media_type="audio/wav",
-            headers={"Content-Disposition": f"attachment; filename={normalized_instrument}_ai_demo.wav"},
+            cache_key,
+            {"Content-Disposition": f"attachment; filename={normalized_instrument}_ai_demo.wav"},
+            request.redirect,
         )
+    except QueueFullError as e:
+        client_limit = isinstance(e, ClientQueueFullError)
+        response = await fallback_response(normalized_instrument, request.style, request.duration,
+                                           "client_limit" if client_limit else "queue_full")
+        if response is not None:
+            return response
+        raise HTTPException(status_code=429 if client_limit else 503, detail=str(e), headers={"Retry-After": "10"})
     except Exception as e:
         logger.error(f"❌ Lỗi tạo âm thanh AI: {str(e)}")
+        response = await fallback_response(normalized_instrument, request.style, request.duration, "generation_failed")
+        if response is not None:
+            return response
         raise HTTPException(status_code=500, detail=f"Tạo âm thanh thất bại: {str(e)}")
 
 
+@router.post("/ensemble")
+async def ensemble_demo(request: EnsembleDemoRequest, http_request: Request):
+    """
+    Demo nhiều nhạc cụ chơi cùng lúc, trộn sẵn thành 1 file WAV stereo
+    - Nhạc cụ có file mẫu (use_samples = True): dùng file mẫu
+    - Còn lại: lấy clip AI trong cache, thiếu thì generate tất cả trong 1 lần gọi MusicGen
+    - Bản trộn và từng clip AI được cache riêng (clip lẻ dùng chung với /demo/)
+    Header X-Ensemble-Stems cho biết nguồn của từng stem
+    """
+    style, duration = request.style, request.duration
+    sample_rate = ai_generator.sampling_rate if ai_generator is not None else ENSEMBLE_SAMPLE_RATE
+
+    plan = []
+    for stem in request.stems:
+        inst = lookup_instrument(stem.product)
+        key = inst.key if inst else normalize_text(stem.product)
+        sample_path = inst.sample_path if inst and request.use_samples else None
+        plan.append((key, sample_path))
+
+    gains = [stem.gain_db for stem in request.stems]
+    pans = [stem.pan for stem in request.stems]
+    filename = "_".join(key.replace(" ", "-") for key, _ in plan)
+    headers = {"Content-Disposition": f"attachment; filename={filename}_ensemble.wav"}
+
+    cache = ai_generator.cache if ai_generator is not None and ai_generator.use_cache else None
+    mix_key = ensemble_cache_key(
+        [(key, SOURCE_SAMPLE if path else "ai", gain, pan) for (key, path), gain, pan in zip(plan, gains, pans)],
+        style, duration,
+    )
+    if cache is not None:
+        data = await run_in_threadpool(cache.get, mix_key)
+        AUDIO_CACHE_REQUESTS.labels(result="hit" if data is not None else "miss").inc()
+        if data is not None:
+            logger.info(f"💾 Ensemble từ cache: {mix_key}")
+            return await clip_response(BytesIO(data), mix_key, {**headers, "X-Ensemble-Stems": "mix=cache"},
+                                       request.redirect)
+
+    def load_available():
+        stems, sources = [], []
+        for key, sample_path in plan:
+            if sample_path:
+                stems.append(load_sample(sample_path, sample_rate, duration))
+                sources.append(SOURCE_SAMPLE)
+            elif ai_generator is not None:
+                stem = ai_generator.load_stem(key, style, duration)
+                stems.append(stem)
+                sources.append(SOURCE_CACHE if stem is not None else None)
+            else:
+                stems.append(None)
+                sources.append(None)
+        return stems, sources
+
+    try:
+        stems, sources = await run_in_threadpool(load_available)
+
+        missing = [i for i, stem in enumerate(stems) if stem is None]
+        if missing:
+            if ai_generator is None:
+                raise HTTPException(status_code=500, detail="Trình tạo âm thanh AI chưa được khởi tạo")
+            # Nhạc cụ lặp lại trong bản trộn chỉ generate 1 lần
+            to_generate = list(dict.fromkeys(plan[i][0] for i in missing))
+            logger.info(f"🎵 Ensemble: generate {to_generate} trong 1 batch trên {ai_generator.device}...")
+            generated = await inference_executor.run(
+                ai_generator.generate_batch, to_generate, style, duration,
+                cost=estimate_tokens(duration) * len(to_generate), client=client_key(http_request),
+            )
+            by_key = dict(zip(to_generate, generated))
+            for i in missing:
+                stems[i] = by_key[plan[i][0]]
+                sources[i] = SOURCE_GENERATED
+
+        audio_io = await run_in_threadpool(mix, stems, gains, pans, sample_rate, duration)
+        if cache is not None:
+            await run_in_threadpool(ai_generator._save_to_cache, mix_key, audio_io, None, style)
+            audio_io.seek(0)
+    except HTTPException:
+        raise
+    except QueueFullError as e:
+        status_code = 429 if isinstance(e, ClientQueueFullError) else 503
+        raise HTTPException(status_code=status_code, detail=str(e), headers={"Retry-After": "10"})
+    except Exception as e:
+        logger.error(f"❌ Lỗi tạo ensemble: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Tạo bản hòa tấu thất bại: {str(e)}")
+
+    stems_header = ",".join(f"{key}={source}" for (key, _), source in zip(plan, sources))
+    return await clip_response(audio_io, mix_key if cache is not None else None,
+                               {**headers, "X-Ensemble-Stems": stems_header}, request.redirect)
+
+
+@router.get("/prefetch/stats")
+async def get_prefetch_stats():
+    """
+    Thống kê prefetch demo của worker này: hit_rate = clip prefetch được nghe / clip prefetch đã tạo
+    """
+    return demo_prefetcher.stats()
+
+
+@router.get("/fallback/stats")
+async def get_fallback_stats():
+    """Số clip trong index fallback của worker này (file mẫu, clip có gắn nhạc cụ/style)"""
+    return current_clip_index().stats()
+
+
 @router.post("/clear-cache")
 async def clear_cache():
     """
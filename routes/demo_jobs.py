@@ -0,0 +1,166 @@
+# File: routes/demo_jobs.py
+from fastapi import APIRouter, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse
+from models import ProductDemoRequest
+from ai_music import estimate_tokens
+from instruments import normalize_text, lookup_instrument
+from inference import inference_executor, QueueFullError
+from jobs import JobStore, JobWorker, STATUS_DONE
+from waveform import clip_waveform_url
+from content_store import content_url
+import routes.demo_audio as demo_audio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+job_store = JobStore()
+
+JOB_RETRY_SECONDS = 1.0
+
+
+def _run_job(job: dict, on_progress):
+    """Chạy job trong hàng đợi inference, kết quả được generate lưu vào cache"""
+    while True:
+        try:
+            future = inference_executor.submit(
+                demo_audio.ai_generator.generate,
+                instrument=job["instrument"],
+                style=job["style"],
+                duration=job["duration"],
+                progress_callback=on_progress,
+                cost=job["total_tokens"],
+                # Job worker chạy lần lượt từng job, cả hàng job chia lượt với request /demo/ như 1 client
+                client="jobs",
+            )
+            break
+        except QueueFullError:
+            # Job đã nằm an toàn trong SQLite: hàng đợi đầy thì chờ rồi thử lại, không đánh lỗi job
+            time.sleep(JOB_RETRY_SECONDS)
+    future.result()
+
+
+job_worker = JobWorker(job_store, _run_job)
+
+
+@router.on_event("startup")
+async def start_job_worker():
+    if demo_audio.ai_generator is None or not demo_audio.ai_generator.use_cache:
+        logger.warning("⚠️ Job worker không chạy: AI Generator chưa khởi tạo hoặc tắt cache")
+        return
+    job_worker.start()
+
+
+def _job_view(job: dict) -> dict:
+    total = job["total_tokens"]
+    view = {
+        "job_id": job["id"],
+        "status": job["status"],
+        "instrument": job["instrument"],
+        "style": job["style"],
+        "duration": job["duration"],
+        "progress": {
+            "tokens": job["progress_tokens"],
+            "total_tokens": total,
+            "percent": round(job["progress_tokens"] / total * 100, 1) if total else 100.0,
+        },
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+        "status_url": f"/demo/jobs/{job['id']}",
+    }
+    if job["status"] == STATUS_DONE:
+        view["result_url"] = f"/demo/jobs/{job['id']}/result"
+        view["waveform_url"] = clip_waveform_url(job["cache_key"])
+    return view
+
+
+@router.post("/")
+async def submit_demo_job(request: ProductDemoRequest):
+    """
+    Tạo job generate audio AI, trả về job_id ngay (202) thay vì giữ kết nối ~1 phút
+    - Có file mẫu (use_ai = False) hoặc đã có trong cache: trả audio luôn (200) như /demo/
+    - Chưa có: tạo job (hoặc dùng lại job đang chạy cho cùng nhạc cụ/style/duration)
+    """
+    instrument = request.product
+    ai_generator = demo_audio.ai_generator
+
+    if not request.use_ai:
+        sample_path = demo_audio.find_instrument_sample(instrument)
+        if sample_path:
+            logger.info(f"✅ Trả file mẫu cho {instrument}")
+            return await demo_audio.sample_response(instrument, sample_path, request.redirect)
+
+    if ai_generator is None:
+        raise HTTPException(status_code=500, detail="Trình tạo âm thanh AI chưa được khởi tạo")
+    if not ai_generator.use_cache:
+        raise HTTPException(status_code=503, detail="Job API cần bật cache audio")
+
+    inst = lookup_instrument(instrument)
+    normalized_instrument = inst.key if inst else normalize_text(instrument)
+
+    cached_audio, cached_key = await run_in_threadpool(
+        ai_generator.lookup_cached, normalized_instrument, request.style, request.duration
+    )
+    if cached_audio:
+        return await demo_audio.clip_response(
+            cached_audio,
+            cached_key,
+            {"Content-Disposition": f"attachment; filename={normalized_instrument}_ai_demo.wav"},
+            request.redirect,
+        )
+
+    # SQLite có thể chờ khóa ghi tới 30s: không chạy trên event loop
+    job = await run_in_threadpool(
+        job_store.create,
+        instrument=normalized_instrument,
+        style=request.style,
+        duration=request.duration,
+        cache_key=ai_generator._get_cache_key(normalized_instrument, request.style, request.duration),
+        total_tokens=estimate_tokens(request.duration),
+    )
+    job_worker.notify()
+    logger.info(f"📥 Job {job['id']} ({job['status']}) cho {normalized_instrument}")
+
+    return JSONResponse(status_code=202, content=_job_view(job), headers={"Location": f"/demo/jobs/{job['id']}"})
+
+
+@router.get("/{job_id}")
+async def get_demo_job(job_id: str):
+    """Trạng thái và tiến độ (số token đã sinh / max_new_tokens) của job"""
+    job = await run_in_threadpool(job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy job")
+    view = _job_view(job)
+    ai_generator = demo_audio.ai_generator
+    if job["status"] == STATUS_DONE and ai_generator is not None:
+        # URL theo nội dung: frontend đặt thẳng vào <audio src>, browser/CDN cache được
+        digest = await run_in_threadpool(ai_generator.publish_clip, job["cache_key"])
+        if digest:
+            view["audio_url"] = content_url(digest, ".wav")
+    return view
+
+
+@router.get("/{job_id}/result")
+async def get_demo_job_result(job_id: str):
+    """Audio của job đã xong, đọc từ cache"""
+    job = await run_in_threadpool(job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy job")
+    if job["status"] != STATUS_DONE:
+        raise HTTPException(status_code=409, detail=f"Job chưa xong (trạng thái: {job['status']})")
+
+    ai_generator = demo_audio.ai_generator
+    cache_path = await run_in_threadpool(ai_generator.cached_file, job["cache_key"]) if ai_generator else None
+    if cache_path is None:
+        raise HTTPException(status_code=410, detail="Audio của job đã bị xóa khỏi cache, hãy tạo job mới")
+
+    return FileResponse(
+        cache_path,
+        media_type="audio/wav",
+        headers={"Content-Disposition": f"attachment; filename={normalize_text(job['instrument'])}_ai_demo.wav"},
+    )
@@ -0,0 +1,71 @@
+# File: routes/waveform.py
+from fastapi import APIRouter, HTTPException, Query, Response
+from fastapi.concurrency import run_in_threadpool
+from instruments import lookup_instrument, sample_files
+from waveform import WAVEFORM_BINS, load_or_compute, precompute_samples, rebin
+import routes.demo_audio as demo_audio
+import re
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+_CACHE_KEY_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+def _precompute_all():
+    """File mẫu trước, rồi các clip đã có trong cache local (clip cũ, clip tải từ cache dùng chung)"""
+    precompute_samples(sample_files())
+    ai_generator = demo_audio.ai_generator
+    if ai_generator is not None and ai_generator.cache is not None:
+        local = ai_generator.cache.local
+        precompute_samples(local.path(key) for key in local.keys())
+
+
+@router.on_event("startup")
+async def precompute_sample_waveforms():
+    """Tính trước peaks cho samples/ + audio_cache/ ở thread nền (giải mã mp3 chậm, không chặn khởi động)"""
+    threading.Thread(target=_precompute_all, name="waveform-precompute", daemon=True).start()
+
+
+def _respond(meta: dict, bins: int, response: Response) -> dict:
+    response.headers["Cache-Control"] = "public, max-age=86400"
+    return rebin(meta, bins)
+
+
+@router.get("/sample/{instrument}")
+async def get_sample_waveform(
+    instrument: str,
+    response: Response,
+    bins: int = Query(WAVEFORM_BINS, ge=16, le=WAVEFORM_BINS, description="Số đoạn min/max trả về"),
+):
+    """Peaks + thời lượng + độ to của file mẫu (tên nhạc cụ có dấu/không dấu đều được)"""
+    inst = lookup_instrument(instrument)
+    sample_path = inst.sample_path if inst else None
+    if sample_path is None:
+        raise HTTPException(status_code=404, detail=f"Không có file mẫu cho {instrument}")
+    try:
+        meta = await run_in_threadpool(load_or_compute, sample_path)
+    except Exception as e:
+        logger.error(f"❌ Lỗi đọc waveform {sample_path}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Không đọc được file mẫu: {str(e)}")
+    return _respond(meta, bins, response)
+
+
+@router.get("/clip/{cache_key}")
+async def get_clip_waveform(
+    cache_key: str,
+    response: Response,
+    bins: int = Query(WAVEFORM_BINS, ge=16, le=WAVEFORM_BINS, description="Số đoạn min/max trả về"),
+):
+    """Peaks + thời lượng + độ to của clip AI / bản hòa tấu trong cache"""
+    ai_generator = demo_audio.ai_generator
+    if not _CACHE_KEY_PATTERN.match(cache_key) or ai_generator is None or not ai_generator.use_cache:
+        raise HTTPException(status_code=404, detail="Không tìm thấy clip")
+    cache_path = await run_in_threadpool(ai_generator.cached_file, cache_key)
+    if cache_path is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy clip")
+    meta = await run_in_threadpool(load_or_compute, cache_path)
+    return _respond(meta, bins, response)
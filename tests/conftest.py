@@ -0,0 +1,5 @@
+# Chạy test từ thư mục gốc repo: python -m pytest -q
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
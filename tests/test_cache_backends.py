@@ -0,0 +1,194 @@
+import os
+import threading
+import time
+
+import fakeredis
+import pytest
+
+from cache_backends import CacheBackend, KeyValueBackend, LocalFSBackend, SharedDirBackend, TieredCache
+
+
+class FailingBackend(LocalFSBackend):
+    """Remote lỗi mạng: mọi thao tác đều raise"""
+
+    name = "failing"
+
+    def get(self, key):
+        raise ConnectionError("down")
+
+    def put(self, key, data):
+        raise ConnectionError("down")
+
+
+class GatedBackend(LocalFSBackend):
+    """Remote chỉ ghi được khi gate mở: kiểm tra write-behind không chặn put"""
+
+    name = "gated"
+
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.gate = threading.Event()
+
+    def put(self, key, data):
+        self.gate.wait(5)
+        super().put(key, data)
+
+
+def test_backend_interface_is_abstract():
+    with pytest.raises(TypeError):
+        CacheBackend()
+
+
+def test_local_roundtrip(tmp_path):
+    cache = LocalFSBackend(str(tmp_path))
+    assert cache.get("a") is None
+    cache.put("a", b"123")
+    assert cache.get("a") == b"123"
+    assert cache.exists("a")
+    assert list(cache.keys()) == ["a"]
+    assert cache.stats() == (1, 3)
+    # Không để lại file tạm
+    assert sorted(os.listdir(tmp_path)) == ["a.wav"]
+
+
+def test_local_delete_removes_sidecars(tmp_path):
+    cache = LocalFSBackend(str(tmp_path))
+    cache.put("a", b"1")
+    cache.put("ab", b"2")
+    (tmp_path / "a.wav.peaks.json").write_text("{}")
+    (tmp_path / "a.wav.prefetched").write_text("")
+    cache.delete("a")
+    assert sorted(os.listdir(tmp_path)) == ["ab.wav"]
+
+
+def test_local_clear_keeps_subdirectories(tmp_path):
+    cache = LocalFSBackend(str(tmp_path))
+    cache.put("a", b"1")
+    (tmp_path / "a.wav.embed.json").write_text("{}")
+    (tmp_path / "by-hash").mkdir()
+    (tmp_path / "by-hash" / "0123.wav").write_bytes(b"1")
+    cache.clear()
+    assert sorted(os.listdir(tmp_path)) == ["by-hash"]
+    assert os.listdir(tmp_path / "by-hash") == ["0123.wav"]
+    assert cache.get("a") is None
+
+
+def test_shared_skips_key_locked_by_other_node(tmp_path):
+    shared = SharedDirBackend(str(tmp_path))
+    (tmp_path / ".a.lock").write_text("other-node:1")
+    shared.put("a", b"1")
+    assert shared.get("a") is None
+    assert (tmp_path / ".a.lock").exists()
+
+
+def test_shared_takes_over_stale_lock(tmp_path):
+    shared = SharedDirBackend(str(tmp_path))
+    lock = tmp_path / ".a.lock"
+    lock.write_text("dead-node:1")
+    old = time.time() - SharedDirBackend.LOCK_STALE_SECONDS - 1
+    os.utime(lock, (old, old))
+    shared.put("a", b"1")
+    assert shared.get("a") == b"1"
+    assert not lock.exists()
+
+
+def test_shared_keeps_first_write(tmp_path):
+    shared = SharedDirBackend(str(tmp_path))
+    shared.put("a", b"first")
+    shared.put("a", b"second")
+    assert shared.get("a") == b"first"
+    assert sorted(os.listdir(tmp_path)) == ["a.wav"]
+
+
+def test_shared_lock_is_exclusive_across_threads(tmp_path):
+    shared = SharedDirBackend(str(tmp_path))
+    acquired = []
+    barrier = threading.Barrier(8)
+
+    def worker():
+        barrier.wait()
+        acquired.append(shared._acquire("a"))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert acquired.count(True) == 1
+
+
+def test_key_value_set_nx_keeps_first_value():
+    backend = KeyValueBackend(client=fakeredis.FakeRedis())
+    backend.put("a", b"first")
+    backend.put("a", b"second")
+    assert backend.get("a") == b"first"
+    assert backend.exists("a")
+    assert not backend.exists("b")
+
+
+def test_key_value_ttl_and_prefix():
+    client = fakeredis.FakeRedis()
+    client.set("other:x", b"keep")
+    backend = KeyValueBackend(client=client, prefix="audio_cache:", ttl_seconds=60)
+    backend.put("a", b"1")
+    assert 0 < client.ttl("audio_cache:a") <= 60
+    assert list(backend.keys()) == ["a"]
+    backend.clear()
+    assert backend.get("a") is None
+    assert client.get("other:x") == b"keep"
+
+
+def test_tiered_read_through_copies_to_local(tmp_path):
+    local = LocalFSBackend(str(tmp_path / "local"))
+    remote = KeyValueBackend(client=fakeredis.FakeRedis())
+    remote.put("a", b"1")
+    cache = TieredCache(local, remote)
+    assert not local.exists("a")
+    assert cache.get("a") == b"1"
+    assert local.get("a") == b"1"
+    assert cache.ensure_local("a") == local.path("a")
+    assert cache.ensure_local("missing") is None
+
+
+def test_tiered_write_behind_and_flush(tmp_path):
+    local = LocalFSBackend(str(tmp_path / "local"))
+    remote = GatedBackend(str(tmp_path / "remote"))
+    cache = TieredCache(local, remote, write_behind=True)
+
+    cache.put("a", b"1")
+    # Local có ngay, remote chưa ghi vì gate đóng: put không chờ remote
+    assert local.get("a") == b"1"
+    assert not os.path.exists(remote.path("a"))
+
+    remote.gate.set()
+    cache.flush()
+    assert remote.get("a") == b"1"
+
+
+def test_tiered_write_through(tmp_path):
+    local = LocalFSBackend(str(tmp_path / "local"))
+    remote = KeyValueBackend(client=fakeredis.FakeRedis())
+    cache = TieredCache(local, remote, write_behind=False)
+    cache.put("a", b"1")
+    assert remote.get("a") == b"1"
+
+
+def test_tiered_remote_errors_degrade_to_local(tmp_path):
+    local = LocalFSBackend(str(tmp_path / "local"))
+    cache = TieredCache(local, FailingBackend(str(tmp_path / "remote")), write_behind=True)
+    assert cache.get("a") is None
+    cache.put("a", b"1")
+    cache.flush()
+    assert cache.get("a") == b"1"
+
+
+def test_tiered_clear_leaves_remote(tmp_path):
+    local = LocalFSBackend(str(tmp_path / "local"))
+    remote = KeyValueBackend(client=fakeredis.FakeRedis())
+    cache = TieredCache(local, remote, write_behind=False)
+    cache.put("a", b"1")
+    cache.clear()
+    assert not local.exists("a")
+    assert remote.get("a") == b"1"
+    # Đọc lại được từ remote
+    assert cache.get("a") == b"1"
@@ -0,0 +1,53 @@
+import os
+
+from cache_backends import LocalFSBackend
+from content_store import ContentStore, digest_bytes
+from metrics import AUDIO_CACHE_BYTES, AUDIO_CACHE_FILES, update_audio_cache_size
+
+
+def test_publish_links_and_resolves(tmp_path):
+    cache = LocalFSBackend(str(tmp_path))
+    store = ContentStore(str(tmp_path / "by-hash"))
+    cache.put("a", b"clip-a")
+    digest = store.publish(cache.path("a"), b"clip-a")
+    assert digest == digest_bytes(b"clip-a")
+    assert store.resolve(digest, ".wav") is not None
+    assert os.stat(cache.path("a")).st_nlink == 2
+
+
+def test_prune_after_clear_frees_by_hash(tmp_path):
+    cache = LocalFSBackend(str(tmp_path))
+    store = ContentStore(str(tmp_path / "by-hash"))
+    for key in ("a", "b"):
+        cache.put(key, key.encode())
+        store.publish(cache.path(key), key.encode())
+
+    cache.delete("a")
+    assert store.prune() == 1
+    assert store.resolve(digest_bytes(b"a"), ".wav") is None
+    # Clip còn trong cache giữ nguyên tên by-hash
+    assert store.resolve(digest_bytes(b"b"), ".wav") is not None
+
+    cache.clear()
+    assert store.prune() == 1
+    assert os.listdir(tmp_path / "by-hash") == []
+
+
+def test_cache_size_counts_hard_links_once(tmp_path):
+    cache = LocalFSBackend(str(tmp_path))
+    store = ContentStore(str(tmp_path / "by-hash"))
+    cache.put("a", b"12345")
+    store.publish(cache.path("a"), b"12345")
+    update_audio_cache_size(str(tmp_path))
+    assert AUDIO_CACHE_FILES._value.get() == 1
+    assert AUDIO_CACHE_BYTES._value.get() == 5
+
+    # Clip gốc bị xóa nhưng by-hash còn: vẫn chiếm đĩa
+    os.unlink(cache.path("a"))
+    update_audio_cache_size(str(tmp_path))
+    assert AUDIO_CACHE_FILES._value.get() == 1
+
+    store.prune()
+    update_audio_cache_size(str(tmp_path))
+    assert AUDIO_CACHE_FILES._value.get() == 0
+    assert AUDIO_CACHE_BYTES._value.get() == 0
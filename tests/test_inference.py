@@ -0,0 +1,151 @@
+import pytest
+
+from inference import (
+    PRIORITY_BACKGROUND, ClientQueueFullError, InferenceExecutor, QueueFullError,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def make_executor(clock):
+    def make(**kwargs) -> InferenceExecutor:
+        """Executor không có worker thread: test tự gọi _pick() để xem thứ tự chạy"""
+        options = dict(aging_tokens_per_second=0, fairness_half_life=0, max_pending_per_client=0, max_queue=0,
+                       clock=clock)
+        options.update(kwargs)
+        executor = InferenceExecutor(**options)
+        executor._ensure_started = lambda: None
+        return executor
+    return make
+
+
+def submit(executor: InferenceExecutor, name: str, **kwargs):
+    return executor.submit(lambda: name, **kwargs)
+
+
+def drain(executor: InferenceExecutor) -> list:
+    order = []
+    while executor._pending:
+        job = executor._pick()
+        order.append(job.fn())
+    return order
+
+
+def test_shortest_job_first(make_executor):
+    executor = make_executor()
+    submit(executor, "long", cost=1200)
+    submit(executor, "short", cost=120)
+    submit(executor, "medium", cost=400)
+    assert drain(executor) == ["short", "medium", "long"]
+
+
+def test_equal_cost_is_fifo(make_executor):
+    executor = make_executor()
+    for name in ("a", "b", "c"):
+        submit(executor, name, cost=100)
+    assert drain(executor) == ["a", "b", "c"]
+
+
+def test_background_runs_after_interactive(make_executor):
+    executor = make_executor()
+    submit(executor, "prefetch", cost=1, priority=PRIORITY_BACKGROUND)
+    submit(executor, "request", cost=1200)
+    assert drain(executor) == ["request", "prefetch"]
+
+
+def test_aging_lets_long_job_overtake(clock, make_executor):
+    executor = make_executor(aging_tokens_per_second=40)
+    submit(executor, "long", cost=1200)
+    clock.now += 30  # 30 giây chờ = 1200 token
+    submit(executor, "short", cost=120)
+    # long: 1200 - 40*30 = 0 < short: 120
+    assert drain(executor) == ["long", "short"]
+
+
+def test_aging_not_enough_keeps_sjf(clock, make_executor):
+    executor = make_executor(aging_tokens_per_second=40)
+    submit(executor, "long", cost=1200)
+    clock.now += 10  # long: 1200 - 400 = 800 > short: 120
+    submit(executor, "short", cost=120)
+    assert drain(executor) == ["short", "long"]
+
+
+def test_recent_usage_pushes_client_back(clock, make_executor):
+    executor = make_executor(fairness_half_life=60)
+    submit(executor, "heavy-1", cost=400, client="heavy")
+    assert drain(executor) == ["heavy-1"]
+
+    submit(executor, "heavy-2", cost=200, client="heavy")
+    submit(executor, "light-1", cost=400, client="light")
+    # heavy-2: 200 + 400 đã dùng = 600 > light-1: 400
+    assert drain(executor) == ["light-1", "heavy-2"]
+
+
+def test_client_usage_decays_by_half_life(clock, make_executor):
+    executor = make_executor(fairness_half_life=60)
+    submit(executor, "heavy-1", cost=400, client="heavy")
+    drain(executor)
+    assert executor._client_usage("heavy", clock.now) == pytest.approx(400)
+
+    clock.now += 60
+    assert executor._client_usage("heavy", clock.now) == pytest.approx(200)
+    clock.now += 60
+    # heavy-2: 100 + 100 đã dùng (sau 2 chu kỳ) = 200 < light-1: 250
+    submit(executor, "heavy-2", cost=100, client="heavy")
+    submit(executor, "light-1", cost=250, client="light")
+    assert drain(executor) == ["heavy-2", "light-1"]
+
+
+def test_max_pending_per_client(make_executor):
+    executor = make_executor(max_pending_per_client=2)
+    submit(executor, "a1", client="a")
+    submit(executor, "a2", client="a")
+    with pytest.raises(ClientQueueFullError):
+        submit(executor, "a3", client="a")
+    # Client khác và việc không có client vẫn vào được
+    submit(executor, "b1", client="b")
+    submit(executor, "anon")
+    assert executor.depth == 4
+
+    executor._pick()
+    submit(executor, "a3", client="a")
+    assert executor.depth == 4
+
+
+def test_max_queue(make_executor):
+    executor = make_executor(max_queue=2)
+    submit(executor, "a", client="a")
+    submit(executor, "b", client="b")
+    with pytest.raises(QueueFullError) as excinfo:
+        submit(executor, "c", client="c")
+    assert not isinstance(excinfo.value, ClientQueueFullError)
+
+
+def test_cancelled_job_frees_its_slot(make_executor):
+    executor = make_executor(max_pending_per_client=1)
+    future = submit(executor, "a1", client="a")
+    assert future.cancel()
+    assert executor.depth == 0
+    submit(executor, "a2", client="a")
+    assert drain(executor) == ["a2"]
+
+
+def test_snapshot_matches_pick_order(clock, make_executor):
+    executor = make_executor(aging_tokens_per_second=40)
+    submit(executor, "long", cost=1200, client="x")
+    clock.now += 5
+    submit(executor, "short", cost=120, client="y")
+    assert [j["client"] for j in executor.snapshot()] == ["y", "x"]
+    assert drain(executor) == ["short", "long"]
@@ -0,0 +1,36 @@
+from instruments import INSTRUMENTS, find_instruments_in_text, lookup_instrument, normalize_text
+
+
+def test_normalize_text():
+    assert normalize_text("Đàn Tranh") == "dan tranh"
+    assert normalize_text("T'rưng") == "t rung"
+
+
+def test_alias_pairs_share_one_instrument():
+    tranh = lookup_instrument("danh tranh")
+    assert tranh is lookup_instrument("Đàn Tranh")
+    assert tranh.samples == ("dan_tranh.mp3", "danh_tranh1.mp3")
+
+    khen = lookup_instrument("khen")
+    assert lookup_instrument("ken be") is khen
+    assert lookup_instrument("khèn bè") is khen
+    assert khen.samples == ("khen_be.mp3",)
+    assert "danh tranh" not in INSTRUMENTS and "ken be" not in INSTRUMENTS
+
+
+def test_fuzzy_lookup():
+    assert lookup_instrument("dan tranhh").key == "dan tranh"
+    assert lookup_instrument("dan tranhh", fuzzy=False) is None
+    assert lookup_instrument("") is None
+
+
+def test_find_in_text_prefers_longest_form():
+    found = find_instruments_in_text("Tôi thích sáo trúc hơn đàn bầu, tại sao vậy?")
+    assert [inst.key for inst in found] == ["sao truc", "dan bau"]
+
+
+def test_catalog_links():
+    assert lookup_instrument("sáo").course_id == 1
+    assert lookup_instrument("đàn piano").course_id == 2
+    assert lookup_instrument("cajon").course_id == lookup_instrument("trống").course_id == 3
+    assert lookup_instrument("đàn bầu").course_id is None
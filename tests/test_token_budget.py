@@ -0,0 +1,47 @@
+import pytest
+
+import token_budget
+from metrics import GEMINI_BUDGET_TRIMS
+from token_budget import TrimLevel, estimate_text_tokens, fit_prompt
+
+
+def trims(intent: str, level: str) -> float:
+    return GEMINI_BUDGET_TRIMS.labels(intent=intent, level=level)._value.get()
+
+
+@pytest.fixture
+def budget(monkeypatch):
+    def set_budget(intent: str, tokens: int):
+        monkeypatch.setitem(token_budget.TOKEN_BUDGETS, intent, tokens)
+    return set_budget
+
+
+def test_estimate_text_tokens():
+    assert estimate_text_tokens("") == 0
+    assert estimate_text_tokens("x" * 7) == 3
+
+
+def test_prompt_without_catalog_skips_catalog_levels(budget):
+    budget("test_no_catalog", 1)
+    tried = []
+
+    def build(level: TrimLevel) -> str:
+        tried.append(level.name)
+        return "x" * 30
+
+    fit_prompt("test_no_catalog", build)
+    assert tried == ["full", "history_1", "no_optional", "minimal"]
+    assert trims("test_no_catalog", "over_budget") == 1
+
+
+def test_prompt_with_catalog_tries_every_level(budget):
+    budget("test_catalog", 4)
+    tried = []
+
+    def build(level: TrimLevel) -> str:
+        tried.append(level.name)
+        return "x" * (level.catalog_limit or 100)
+
+    assert fit_prompt("test_catalog", build, has_catalog=True) == "x" * 10
+    assert tried == ["full", "history_1", "catalog_20", "catalog_10"]
+    assert trims("test_catalog", "catalog_10") == 1
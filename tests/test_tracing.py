@@ -0,0 +1,80 @@
+import asyncio
+import json
+
+import httpx
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+
+import tracing
+from tracing import TraceMiddleware, flush_traces
+
+
+def make_app() -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/stream")
+    async def stream():
+        async def body():
+            for _ in range(3):
+                await asyncio.sleep(0.05)
+                yield b"x"
+        return StreamingResponse(body())
+
+    app.add_middleware(TraceMiddleware, allow_debug=lambda headers: headers.get("x-admin-token") == "secret")
+    return app
+
+
+def get(app, headers):
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.get("/stream", headers=headers)
+    return asyncio.run(run())
+
+
+def read_traces(path):
+    flush_traces()
+    if not path.exists():
+        return []
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_debug_header_requires_admin(tmp_path, monkeypatch):
+    export = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(tracing, "TRACE_EXPORT_FILE", str(export))
+    app = make_app()
+
+    response = get(app, {"X-Debug-Trace": "1"})
+    assert "x-trace-id" not in response.headers
+    assert read_traces(export) == []
+
+    response = get(app, {"X-Debug-Trace": "1", "X-Admin-Token": "secret"})
+    assert response.content == b"xxx"
+    assert len(read_traces(export)) == 1
+
+
+def test_root_span_covers_streamed_body(tmp_path, monkeypatch):
+    export = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(tracing, "TRACE_EXPORT_FILE", str(export))
+    response = get(make_app(), {"X-Debug-Trace": "1", "X-Admin-Token": "secret"})
+
+    [document] = read_traces(export)
+    [root] = document["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    assert root["traceId"] == response.headers["x-trace-id"]
+    duration_s = (int(root["endTimeUnixNano"]) - int(root["startTimeUnixNano"])) / 1e9
+    assert duration_s >= 0.15
+    attributes = {a["key"]: a["value"] for a in root["attributes"]}
+    assert attributes["http.status_code"] == {"intValue": "200"}
+    assert attributes["http.route"] == {"stringValue": "/stream"}
+
+
+def test_export_file_rotates(tmp_path, monkeypatch):
+    export = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(tracing, "TRACE_EXPORT_FILE", str(export))
+    monkeypatch.setattr(tracing, "TRACE_EXPORT_MAX_BYTES", 10)
+    app = make_app()
+    for _ in range(3):
+        get(app, {"X-Debug-Trace": "1", "X-Admin-Token": "secret"})
+    flush_traces()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["traces.jsonl", "traces.jsonl.1"]
+    assert len(export.read_text().splitlines()) == 1
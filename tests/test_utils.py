@@ -0,0 +1,22 @@
+from utils import extract_user_context
+
+
+def _context(*queries):
+    return extract_user_context([{"user": q, "ai": "OK"} for q in queries])
+
+
+def test_instrument_follows_fixed_priority_not_mention_order():
+    # Như bản trước registry: "sáo" đứng trước "đàn bầu" trong danh sách ưu tiên
+    assert _context("Tôi thích đàn bầu", "còn sáo thì sao?")["instrument"] == "sáo"
+    assert _context("đàn nhị hay đàn tranh?")["instrument"] == "đàn tranh"
+
+
+def test_priority_covers_variants_of_priority_instrument():
+    assert _context("trống cơm với đàn nhị")["instrument"] == "đàn nhị"
+    assert _context("sáo trúc với trống")["instrument"] == "sáo trúc"
+
+
+def test_instrument_outside_priority_list():
+    # Bản trước registry trả None; giờ lấy nhạc cụ được nhắc đầu tiên
+    assert _context("Tôi muốn mua đàn đá và khèn")["instrument"] == "đàn đá"
+    assert _context("Tôi mới học")["instrument"] is None
@@ -0,0 +1,104 @@
+# File: token_budget.py
+# Ước tính số token prompt Gemini và giữ prompt trong ngân sách từng intent bằng cách cắt dần
+# (ít lượt lịch sử hơn -> ít sản phẩm catalog hơn -> bỏ phần ngữ cảnh không bắt buộc)
+import logging
+import math
+import os
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional, Tuple
+
+from metrics import GEMINI_BUDGET_TRIMS, GEMINI_PROMPT_TOKENS
+
+logger = logging.getLogger(__name__)
+
+# Tiếng Việt có dấu: tokenizer Gemini trung bình ~3 ký tự/token (ước tính dè dặt, tốn hơn tiếng Anh)
+CHARS_PER_TOKEN = float(os.getenv("GEMINI_CHARS_PER_TOKEN", "3.0"))
+
+# Ngân sách token đầu vào mặc định mỗi intent, 0 = không giới hạn
+DEFAULT_BUDGETS: Dict[str, int] = {
+    "consultation": 600,
+    "guide": 500,
+    "story": 400,
+    "support": 800,
+    "quick": 2000,
+    "other": 400,
+}
+
+
+def _load_budgets() -> Dict[str, int]:
+    """
+    GEMINI_TOKEN_BUDGETS="consultation=500,quick=1500" ghi đè từng intent
+    """
+    budgets = dict(DEFAULT_BUDGETS)
+    for part in os.getenv("GEMINI_TOKEN_BUDGETS", "").split(","):
+        if "=" not in part:
+            continue
+        intent, value = part.split("=", 1)
+        try:
+            budgets[intent.strip()] = int(value)
+        except ValueError:
+            logger.warning(f"⚠️ GEMINI_TOKEN_BUDGETS không hợp lệ: {part}")
+    return budgets
+
+
+TOKEN_BUDGETS = _load_budgets()
+
+
+def estimate_text_tokens(text: str) -> int:
+    """Số token Gemini ước tính của 1 đoạn text (không gọi API đếm token; khác ai_music.estimate_tokens là token audio)"""
+    return math.ceil(len(text) / CHARS_PER_TOKEN) if text else 0
+
+
+@dataclass(frozen=True)
+class TrimLevel:
+    """Mức cắt prompt: builder đọc các trường này để quyết định đưa gì vào prompt"""
+    name: str
+    history_turns: int = 3
+    catalog_limit: Optional[int] = None  # None = toàn bộ catalog
+    optional_context: bool = True        # Ví dụ mẫu, mô tả công ty, thông tin phụ
+
+    def effective(self, has_catalog: bool) -> Tuple:
+        """Những gì mức này thực sự thay đổi trong prompt (prompt không có catalog thì catalog_limit không tác dụng)"""
+        return self.history_turns, self.catalog_limit if has_catalog else None, self.optional_context
+
+
+# Thứ tự cắt: mỗi bước giữ nguyên những gì bước trước đã cắt
+TRIM_LEVELS: Tuple[TrimLevel, ...] = (
+    TrimLevel("full"),
+    TrimLevel("history_1", history_turns=1),
+    TrimLevel("catalog_20", history_turns=1, catalog_limit=20),
+    TrimLevel("catalog_10", history_turns=1, catalog_limit=10),
+    TrimLevel("no_optional", history_turns=1, catalog_limit=10, optional_context=False),
+    TrimLevel("minimal", history_turns=0, catalog_limit=5, optional_context=False),
+)
+
+
+def fit_prompt(intent: str, build: Callable[[TrimLevel], str], has_catalog: bool = False) -> str:
+    """
+    Dựng prompt ở mức đầy đủ, vượt ngân sách của intent thì dựng lại với mức cắt tiếp theo
+    Hết mức cắt mà vẫn vượt thì gửi bản ngắn nhất (không bao giờ chặn câu hỏi của khách)
+    :param has_catalog: prompt có danh sách sản phẩm; False thì bỏ qua các mức chỉ cắt catalog (catalog_20, catalog_10)
+    """
+    budget = TOKEN_BUDGETS.get(intent, TOKEN_BUDGETS["other"])
+    prompt = build(TRIM_LEVELS[0])
+    tokens = estimate_text_tokens(prompt)
+
+    if budget > 0 and tokens > budget:
+        tried = TRIM_LEVELS[0].effective(has_catalog)
+        for level in TRIM_LEVELS[1:]:
+            # Mức không đổi gì so với mức vừa thử: không dựng lại, không tính là 1 bước cắt
+            if level.effective(has_catalog) == tried:
+                continue
+            tried = level.effective(has_catalog)
+            prompt = build(level)
+            tokens = estimate_text_tokens(prompt)
+            if tokens <= budget:
+                # Mỗi request chỉ đếm 1 lần, theo mức cắt cuối cùng phải dùng
+                GEMINI_BUDGET_TRIMS.labels(intent=intent, level=level.name).inc()
+                break
+        else:
+            GEMINI_BUDGET_TRIMS.labels(intent=intent, level="over_budget").inc()
+            logger.warning(f"⚠️ Prompt {intent} vẫn vượt ngân sách sau khi cắt: ~{tokens}/{budget} token")
+
+    GEMINI_PROMPT_TOKENS.labels(intent=intent).observe(tokens)
+    return prompt
@@ -0,0 +1,266 @@
+# File: tracing.py
+# Tracing theo từng request (bật bằng header X-Debug-Trace kèm admin token, hoặc lấy mẫu TRACE_SAMPLE_RATE)
+# Span được ghi ra file JSON Lines theo định dạng OTLP/JSON của OpenTelemetry
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+
+logger = logging.getLogger(__name__)
+
+TRACE_HEADER = "x-debug-trace"
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE", os.path.join("traces", "traces.jsonl"))
+SERVICE_NAME = "music-instrument-ai-api"
+# Số trace chờ ghi tối đa; đĩa chậm quá thì bỏ bớt trace chứ không giữ request
+TRACE_EXPORT_QUEUE_SIZE = int(os.getenv("TRACE_EXPORT_QUEUE_SIZE", "1000"))
+# File trace lớn hơn chừng này (bytes) thì đổi tên thành <file>.1 (đè bản cũ) và ghi file mới, 0 = không giới hạn
+TRACE_EXPORT_MAX_BYTES = int(os.getenv("TRACE_EXPORT_MAX_BYTES", str(50 * 1024 * 1024)))
+
+# Mã trạng thái span theo OTLP
+STATUS_UNSET = 0
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+class Span:
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], attributes: Dict):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = dict(attributes)
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.status = STATUS_UNSET
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 2 if self.parent_id is None else 1,  # SERVER cho span gốc, INTERNAL cho span con
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": [_otlp_attribute(k, v) for k, v in self.attributes.items()],
+            "status": {"code": self.status},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.error:
+            span["status"]["message"] = self.error
+        return span
+
+
+class Trace:
+    def __init__(self):
+        self.trace_id = os.urandom(16).hex()
+        self.spans: List[Span] = []
+        # Span con có thể được tạo từ thread inference
+        self._lock = threading.Lock()
+
+    def add(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+
+def _otlp_attribute(key: str, value) -> dict:
+    if isinstance(value, bool):
+        typed = {"boolValue": value}
+    elif isinstance(value, int):
+        typed = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+_export_queue: "queue.Queue" = queue.Queue(maxsize=TRACE_EXPORT_QUEUE_SIZE)
+_exporter_thread: Optional[threading.Thread] = None
+_exporter_lock = threading.Lock()
+
+
+def should_sample(headers, allow_debug: bool = False) -> bool:
+    """
+    Trace request nếu trúng tỉ lệ lấy mẫu, hoặc có header X-Debug-Trace: 1 và allow_debug
+    (nơi gọi kiểm tra admin token: client lạ không tự bật trace để ghi đầy đĩa được)
+    """
+    if allow_debug and headers.get(TRACE_HEADER, "").lower() in ("1", "true", "yes"):
+        return True
+    return TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE
+
+
+class TraceMiddleware:
+    """
+    Middleware ASGI thuần: span gốc kết thúc khi app trả xong cả body
+    (StreamingResponse của /batch/chat, audio... được tính đủ thời gian, không dừng lúc trả header)
+    :param allow_debug: nhận Headers của request, True nếu được bật trace bằng X-Debug-Trace
+    """
+
+    def __init__(self, app, allow_debug: Callable[[Headers], bool] = lambda headers: False):
+        self.app = app
+        self.allow_debug = allow_debug
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        if not should_sample(headers, allow_debug=self.allow_debug(headers)):
+            await self.app(scope, receive, send)
+            return
+
+        with start_trace(f"{scope['method']} {scope['path']}", **{
+            "http.method": scope["method"],
+            "http.target": scope["path"],
+        }) as root:
+            async def send_with_trace_id(message):
+                if message["type"] == "http.response.start":
+                    root.set_attribute("http.status_code", message["status"])
+                    MutableHeaders(scope=message)["X-Trace-Id"] = root.trace.trace_id
+                await send(message)
+
+            await self.app(scope, receive, send_with_trace_id)
+            route = scope.get("route")
+            if route is not None:
+                root.set_attribute("http.route", route.path)
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Tạo span con của span hiện tại
+    Không có trace đang chạy (request không được lấy mẫu) thì không làm gì, chi phí gần như bằng 0
+    """
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+
+    child = Span(parent.trace, name, parent.span_id, attributes)
+    parent.trace.add(child)
+    token = _current_span.set(child)
+    try:
+        yield child
+        child.status = STATUS_OK
+    except BaseException as e:
+        child.status = STATUS_ERROR
+        child.error = str(e)
+        raise
+    finally:
+        child.end_ns = time.time_ns()
+        _current_span.reset(token)
+
+
+@contextmanager
+def start_trace(name: str, **attributes):
+    """Bắt đầu trace mới với span gốc, ghi toàn bộ span ra file khi kết thúc"""
+    trace = Trace()
+    root = Span(trace, name, None, attributes)
+    trace.add(root)
+    token = _current_span.set(root)
+    try:
+        yield root
+        if root.status == STATUS_UNSET:
+            root.status = STATUS_OK
+    except BaseException as e:
+        root.status = STATUS_ERROR
+        root.error = str(e)
+        raise
+    finally:
+        root.end_ns = time.time_ns()
+        _current_span.reset(token)
+        export_trace(trace)
+
+
+def _ensure_exporter():
+    global _exporter_thread
+    with _exporter_lock:
+        if _exporter_thread is None:
+            _exporter_thread = threading.Thread(target=_export_loop, name="trace-exporter", daemon=True)
+            _exporter_thread.start()
+
+
+def export_trace(trace: Trace):
+    """Đưa trace cho thread nền ghi ra file (không ghi file trên event loop)"""
+    _ensure_exporter()
+    try:
+        _export_queue.put_nowait(trace)
+    except queue.Full:
+        logger.warning(f"⚠️ Hàng đợi ghi trace đầy, bỏ trace {trace.trace_id}")
+
+
+def flush_traces(timeout: float = 5.0):
+    """Chờ thread nền ghi hết các trace đang chờ (gọi khi tắt server)"""
+    if _exporter_thread is None:
+        return
+    done = threading.Event()
+    try:
+        _export_queue.put(done, timeout=timeout)
+    except queue.Full:
+        return
+    done.wait(timeout)
+
+
+def _export_loop():
+    while True:
+        item = _export_queue.get()
+        if isinstance(item, threading.Event):
+            item.set()
+            continue
+        _write_trace(item)
+
+
+def _rotate_if_full():
+    """Giữ tối đa 2 file (hiện tại + .1), mỗi file ~TRACE_EXPORT_MAX_BYTES"""
+    if TRACE_EXPORT_MAX_BYTES <= 0:
+        return
+    try:
+        if os.path.getsize(TRACE_EXPORT_FILE) >= TRACE_EXPORT_MAX_BYTES:
+            os.replace(TRACE_EXPORT_FILE, TRACE_EXPORT_FILE + ".1")
+    except FileNotFoundError:
+        pass
+
+
+def _write_trace(trace: Trace):
+    """Ghi trace ra file, mỗi dòng là 1 document OTLP/JSON (ExportTraceServiceRequest)"""
+    document = {
+        "resourceSpans": [{
+            "resource": {"attributes": [
+                _otlp_attribute("service.name", SERVICE_NAME),
+                _otlp_attribute("process.pid", os.getpid()),
+            ]},
+            "scopeSpans": [{
+                "scope": {"name": "tracing"},
+                "spans": [s.to_otlp() for s in trace.spans],
+            }],
+        }]
+    }
+    line = json.dumps(document, ensure_ascii=False)
+    try:
+        directory = os.path.dirname(TRACE_EXPORT_FILE)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        _rotate_if_full()
+        with open(TRACE_EXPORT_FILE, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    except Exception as e:
+        logger.error(f"❌ Lỗi ghi trace: {str(e)}")
@@ -7,6 +7,11 @@ from functools import lru_cache
 import logging
 from typing import List, Dict, Optional
 import json
+import time
+from instruments import Instrument, find_instruments_in_text
+from metrics import CHAT_STAGE_SECONDS, GEMINI_ERRORS, GEMINI_REQUEST_SECONDS, GEMINI_TOKENS, time_stage
+from tracing import span
+from token_budget import TrimLevel, estimate_text_tokens, fit_prompt
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -20,14 +25,51 @@ except Exception as e:
     logger.error(f"❌ Lỗi khởi tạo Gemini API: {str(e)}")
     gemini_model = None
 
-async def gemini_generate_text(prompt: str) -> str:
+def _record_token_usage(intent: str, prompt: str, response, text: str):
+    """
+    Đếm token vào/ra theo intent: dùng số Gemini báo về (usage_metadata) nếu có, không thì ước tính
+    """
+    usage = getattr(response, "usage_metadata", None)
+    input_tokens = getattr(usage, "prompt_token_count", None)
+    output_tokens = getattr(usage, "candidates_token_count", None)
+    if input_tokens:
+        GEMINI_TOKENS.labels(intent=intent, direction="input", source="reported").inc(input_tokens)
+    else:
+        GEMINI_TOKENS.labels(intent=intent, direction="input", source="estimated").inc(estimate_text_tokens(prompt))
+    if output_tokens:
+        GEMINI_TOKENS.labels(intent=intent, direction="output", source="reported").inc(output_tokens)
+    else:
+        GEMINI_TOKENS.labels(intent=intent, direction="output", source="estimated").inc(estimate_text_tokens(text))
+
+class GeminiError(RuntimeError):
+    """Gemini không trả lời được (chưa cấu hình hoặc gọi API lỗi)"""
+
+
+async def gemini_generate_text(prompt: str, intent: str = "other", raise_errors: bool = False) -> str:
+    """
+    Gọi Gemini, trả về text
+    raise_errors = False: lỗi được trả thành câu thông báo (như chat thường)
+    raise_errors = True: raise GeminiError để nơi gọi (batch) tự ghi lỗi, không coi thông báo lỗi là câu trả lời
+    """
     if gemini_model is None:
+        GEMINI_ERRORS.labels(reason="not_configured").inc()
+        if raise_errors:
+            raise GeminiError("Gemini API chưa được cấu hình")
         return "Gemini API chưa được cấu hình"
+    start = time.perf_counter()
     try:
-        response = await gemini_model.generate_content_async(prompt)
-        return response.text.strip()
+        with span("gemini.generate_content", prompt_chars=len(prompt), intent=intent):
+            response = await gemini_model.generate_content_async(prompt)
+        text = response.text.strip()
+        GEMINI_REQUEST_SECONDS.labels(outcome="ok").observe(time.perf_counter() - start)
+        _record_token_usage(intent, prompt, response, text)
+        return text
     except Exception as e:
+        GEMINI_REQUEST_SECONDS.labels(outcome="error").observe(time.perf_counter() - start)
+        GEMINI_ERRORS.labels(reason=type(e).__name__).inc()
         logger.error(f"❌ Lỗi tạo văn bản Gemini: {str(e)}")
+        if raise_errors:
+            raise GeminiError(f"Lỗi tạo văn bản: {str(e)}") from e
         return f"Lỗi tạo văn bản: {str(e)}"
 
 def read_company_info() -> Dict[str, str]:
@@ -60,6 +102,20 @@ def read_company_info() -> Dict[str, str]:
         logger.error(f"❌ Lỗi đọc file company_info: {str(e)}")
         return default_info
 
+# Nhiều nhạc cụ trong lịch sử: chọn theo thứ tự ưu tiên cố định (khóa registry), không theo thứ tự nhắc tới
+# Khóa ưu tiên khớp cả nhạc cụ con cùng tên gốc: "sao" khớp "sao truc", "trong" khớp "trong com"
+CONTEXT_INSTRUMENT_PRIORITY = ("sao", "dan tranh", "dan bau", "dan nguyet", "dan nhi", "trong")
+
+
+def _pick_context_instrument(mentioned: List[Instrument]) -> Optional[Instrument]:
+    for key in CONTEXT_INSTRUMENT_PRIORITY:
+        for inst in mentioned:
+            if inst.key == key or inst.key.startswith(key + " "):
+                return inst
+    # Nhạc cụ ngoài danh sách ưu tiên: lấy cái được nhắc đầu tiên
+    return mentioned[0] if mentioned else None
+
+
 def extract_user_context(history: List[Dict[str, str]]) -> Dict[str, Optional[str]]:
     """
     Phân tích lịch sử để trích xuất thông tin người dùng đã cung cấp
@@ -104,12 +160,10 @@ def extract_user_context(history: List[Dict[str, str]]) -> Dict[str, Optional[st
     elif any(k in all_queries for k in ["sưu tầm", "sưu tập", "collection"]):
         context["purpose"] = "sưu tầm"
     
-    # Nhạc cụ
-    instruments = ["sáo", "đàn tranh", "đàn bầu", "đàn nguyệt", "đàn nhị", "trống"]
-    for inst in instruments:
-        if inst in all_queries:
-            context["instrument"] = inst
-            break
+    # Nhạc cụ - theo CONTEXT_INSTRUMENT_PRIORITY
+    inst = _pick_context_instrument(find_instruments_in_text(all_queries))
+    if inst is not None:
+        context["instrument"] = inst.name.lower()
     
     # Độ tuổi
     import re
@@ -123,7 +177,7 @@ def build_concise_history(history: List[Dict[str, str]], max_turns: int = 3) ->
     """
     Chỉ lấy thông tin quan trọng từ lịch sử, bỏ qua chi tiết dư thừa
     """
-    if not history:
+    if not history or max_turns <= 0:
         return ""
     
     recent = history[-max_turns:] if len(history) > max_turns else history
@@ -136,32 +190,35 @@ def build_concise_history(history: List[Dict[str, str]], max_turns: int = 3) ->
     
     return "\n".join(summary)
 
-async def process_chat_query(query: str, history: List[Dict[str, str]], intent: str) -> str:
+async def process_chat_query(query: str, history: List[Dict[str, str]], intent: str,
+                             raise_errors: bool = False) -> str:
     """
     Xử lý câu hỏi với prompt ngắn gọn, đúng trọng tâm
+    raise_errors = True: Gemini lỗi thì raise GeminiError thay vì trả câu thông báo lỗi
     """
-    # Trích xuất context từ history
-    user_context = extract_user_context(history)
-    history_summary = build_concise_history(history, max_turns=3)
-    
-    # Context string
-    context_str = ""
-    if any(user_context.values()):
-        ctx_parts = []
-        if user_context["level"]:
-            ctx_parts.append(f"Trình độ: {user_context['level']}")
-        if user_context["budget"]:
-            ctx_parts.append(f"Ngân sách: {user_context['budget']}")
-        if user_context["purpose"]:
-            ctx_parts.append(f"Mục đích: {user_context['purpose']}")
-        if user_context["instrument"]:
-            ctx_parts.append(f"Nhạc cụ: {user_context['instrument']}")
-        if user_context["age"]:
-            ctx_parts.append(f"Độ tuổi: {user_context['age']}")
-        context_str = " | ".join(ctx_parts)
+    with time_stage(CHAT_STAGE_SECONDS, intent=intent, stage="context"):
+        # Trích xuất context từ history
+        with span("extract_user_context", history_turns=len(history or [])):
+            user_context = extract_user_context(history)
+        # Context string
+        context_str = ""
+        if any(user_context.values()):
+            ctx_parts = []
+            if user_context["level"]:
+                ctx_parts.append(f"Trình độ: {user_context['level']}")
+            if user_context["budget"]:
+                ctx_parts.append(f"Ngân sách: {user_context['budget']}")
+            if user_context["purpose"]:
+                ctx_parts.append(f"Mục đích: {user_context['purpose']}")
+            if user_context["instrument"]:
+                ctx_parts.append(f"Nhạc cụ: {user_context['instrument']}")
+            if user_context["age"]:
+                ctx_parts.append(f"Độ tuổi: {user_context['age']}")
+            context_str = " | ".join(ctx_parts)
     
     # Đọc thông tin công ty từ file
-    company_info = read_company_info()
+    with time_stage(CHAT_STAGE_SECONDS, intent=intent, stage="company_info"), span("read_company_info"):
+        company_info = read_company_info()
     
     # Base instruction - QUAN TRỌNG: Bắt buộc trả lời ngắn gọn
     base_rules = """
@@ -172,8 +229,20 @@ async def process_chat_query(query: str, history: List[Dict[str, str]], intent:
 - Format rõ ràng, dễ đọc
 """
 
-    if intent == "consultation":
-        prompt = f"""{base_rules}
+    if intent == "support" and any(k in query.lower() for k in ["bạn là ai", "who are you", "tên bạn"]):
+        # Câu hỏi "Bạn là ai?" trả lời luôn, không cần gọi Gemini
+        return f"Tôi là {company_info['chatbot_name']}, trợ lý AI hỗ trợ bạn về nhạc cụ dân tộc Việt Nam. Hỏi tôi về sản phẩm hoặc chính sách nhé!"
+
+    def build_prompt(level: TrimLevel) -> str:
+        """Prompt theo intent; level quyết định số lượt lịch sử và có giữ ví dụ mẫu/thông tin phụ không"""
+        history_summary = build_concise_history(history, max_turns=level.history_turns)
+
+        if intent == "consultation":
+            example = """
+Ví dụ tốt:
+"Bạn mới học sáo trúc? Nên chọn sáo tone D, tre già giá 350k, dễ thổi, âm ấm, kèm giáo trình cơ bản + túi đựng."
+""" if level.optional_context else ""
+            return f"""{base_rules}
 
 Thông tin người dùng: {context_str if context_str else "Chưa có"}
 Lịch sử: {history_summary if history_summary else "Không có"}
@@ -183,20 +252,17 @@ Vai trò: Chuyên gia tư vấn nhạc cụ dân tộc Việt Nam
 
 Hãy trả lời NGẮN GỌN theo format:
 "[Tình huống]? Nên chọn [nhạc cụ cụ thể - tone/size] giá [X]k, [1-2 đặc điểm nổi bật], kèm [phụ kiện cần thiết]."
-
-Ví dụ tốt:
-"Bạn mới học sáo trúc? Nên chọn sáo tone D, tre già giá 350k, dễ thổi, âm ấm, kèm giáo trình cơ bản + túi đựng."
-
+{example}
 KHÔNG viết dài dòng, KHÔNG liệt kê nhiều lựa chọn trừ khi được hỏi."""
 
-    elif intent == "guide":
-        # Kiểm tra nếu là follow-up question
-        is_followup = any(k in query.lower() for k in ["chi tiết", "cụ thể", "rõ hơn", "thế nào", "như nào"])
-        
-        if is_followup and history:
-            prompt = f"""{base_rules}
+        elif intent == "guide":
+            # Kiểm tra nếu là follow-up question
+            is_followup = any(k in query.lower() for k in ["chi tiết", "cụ thể", "rõ hơn", "thế nào", "như nào"])
+            
+            if is_followup and history:
+                return f"""{base_rules}
 
-Lịch sử: {history_summary}
+Lịch sử: {history_summary if history_summary else "Không có"}
 Câu hỏi follow-up: {query}
 
 Người dùng muốn biết CHI TIẾT HƠN về câu trước. 
@@ -209,8 +275,11 @@ Hãy đi sâu vào KỸ THUẬT CỤ THỂ trong 4-5 bước ngắn gọn:
 Tips quan trọng: [1 tips ngắn]
 
 KHÔNG giải thích lý thuyết dài, CHỈ hướng dẫn hành động."""
-        else:
-            prompt = f"""{base_rules}
+            else:
+                video = """
+Video gợi ý: [Tên video ngắn] - [link]
+""" if level.optional_context else ""
+                return f"""{base_rules}
 
 Câu hỏi: {query}
 Thông tin: {context_str if context_str else "Không có"}
@@ -221,13 +290,15 @@ Trả lời ngắn gọn 3-4 bước cơ bản:
 1. [Bước 1]
 2. [Bước 2]
 3. [Bước 3]
-
-Video gợi ý: [Tên video ngắn] - [link]
-
+{video}
 KHÔNG mô tả chi tiết từng bước, CHỈ liệt kê hành động chính."""
 
-    elif intent == "story":
-        prompt = f"""{base_rules}
+        elif intent == "story":
+            example = """
+Ví dụ tốt:
+"Đàn bầu là nhạc cụ độc tấu một dây của Việt Nam. Xuất hiện từ thế kỷ 10, gắn liền với ca trù. Âm thanh uốn lượn như giọng hát, thể hiện tâm hồn người Việt."
+""" if level.optional_context else ""
+            return f"""{base_rules}
 
 Câu hỏi: {query}
 
@@ -237,24 +308,21 @@ Kể nguồn gốc trong 3-4 câu:
 - Câu 1: Nhạc cụ là gì
 - Câu 2: Xuất xứ/lịch sử
 - Câu 3: Ý nghĩa văn hóa
-
-Ví dụ tốt:
-"Đàn bầu là nhạc cụ độc tấu một dây của Việt Nam. Xuất hiện từ thế kỷ 10, gắn liền với ca trù. Âm thanh uốn lượn như giọng hát, thể hiện tâm hồn người Việt."
-
+{example}
 KHÔNG kể quá chi tiết lịch sử."""
 
-    elif intent == "support":
-        # Kiểm tra câu hỏi "Bạn là ai?"
-        if any(k in query.lower() for k in ["bạn là ai", "who are you", "tên bạn"]):
-            return f"Tôi là {company_info['chatbot_name']}, trợ lý AI hỗ trợ bạn về nhạc cụ dân tộc Việt Nam. Hỏi tôi về sản phẩm hoặc chính sách nhé!"
-        
-        prompt = f"""{base_rules}
+        elif intent == "support":
+            description = f"\n- Mô tả: {company_info['description']}" if level.optional_context else ""
+            example = """
+Ví dụ tốt:
+"Bảo quản sáo khi trời ẩm: cất nơi khô ráo, dùng túi hút ẩm silica gel. Tránh để gần cửa sổ hoặc nơi có nước."
+""" if level.optional_context else ""
+            return f"""{base_rules}
 
 Câu hỏi: {query}
 Thông tin: {context_str if context_str else "Không có"}
 Thông tin công ty & chính sách:
-- Tên công ty: {company_info['company_name']}
-- Mô tả: {company_info['description']}
+- Tên công ty: {company_info['company_name']}{description}
 - Chính sách mua hàng: {company_info['purchase_policy']}
 - Chính sách đổi trả: {company_info['return_policy']}
 - Liên hệ: {company_info['contact']}
@@ -264,17 +332,18 @@ Vai trò: Nhân viên CSKH
 Trả lời 2-3 câu ngắn gọn, thân thiện:
 - Câu 1: Trả lời trực tiếp câu hỏi
 - Câu 2: Gợi ý/lời khuyên cụ thể, dựa trên chính sách công ty
-
-Ví dụ tốt:
-"Bảo quản sáo khi trời ẩm: cất nơi khô ráo, dùng túi hút ẩm silica gel. Tránh để gần cửa sổ hoặc nơi có nước."
-
+{example}
 KHÔNG giải thích dài lý do."""
 
-    else:
-        prompt = f"""{base_rules}
+        else:
+            return f"""{base_rules}
 
 Câu hỏi: {query}
 
 Trả lời ngắn gọn 2-3 câu về nhạc cụ dân tộc Việt Nam."""
 
-    return await gemini_generate_text(prompt)
\ No newline at end of file
+    # Vượt ngân sách token của intent thì cắt dần lịch sử / phần phụ
+    prompt = fit_prompt(intent, build_prompt)
+
+    with time_stage(CHAT_STAGE_SECONDS, intent=intent, stage="gemini"):
+        return await gemini_generate_text(prompt, intent=intent, raise_errors=raise_errors)
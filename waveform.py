@@ -0,0 +1,141 @@
+# File: waveform.py
+# Dữ liệu vẽ waveform cho player: mảng min/max theo từng đoạn, thời lượng, độ to
+# Lưu thành file <audio>.peaks.json cạnh file audio, chỉ tính 1 lần (khi clip được tạo hoặc lần đầu được hỏi)
+import json
+import logging
+import os
+import tempfile
+from typing import Optional
+from urllib.parse import quote
+
+import numpy as np
+
+from audio_processing import decode_file, read_wav
+
+logger = logging.getLogger(__name__)
+
+# Số đoạn lưu sẵn; client xin ít hơn thì gộp lại từ mảng này, không phải đọc lại audio
+WAVEFORM_BINS = int(os.getenv("WAVEFORM_BINS", "1000"))
+SIDECAR_SUFFIX = ".peaks.json"
+
+
+def sample_waveform_url(instrument_key: str) -> str:
+    return f"/demo/waveform/sample/{quote(instrument_key)}"
+
+
+def clip_waveform_url(cache_key: str) -> str:
+    return f"/demo/waveform/clip/{cache_key}"
+
+
+def _to_db(value: float) -> Optional[float]:
+    return round(20.0 * float(np.log10(value)), 2) if value > 1e-9 else None
+
+
+def _round_list(values: np.ndarray) -> list:
+    # float64 trước khi làm tròn để JSON ra 0.0061 chứ không phải 0.006099999882
+    return np.round(values.astype(np.float64), 4).tolist()
+
+
+def _bin_edges(n: int, bins: int) -> np.ndarray:
+    """Chỉ số bắt đầu của từng đoạn, chia n phần tử thành bins đoạn gần bằng nhau"""
+    return np.linspace(0, n, bins + 1).astype(np.int64)[:-1]
+
+
+def compute_peaks(audio: np.ndarray, bins: int = WAVEFORM_BINS):
+    """
+    (min, max) của từng đoạn, tính bằng reduceat (không vòng lặp Python)
+    audio: (samples,) hoặc (channels, samples); nhiều kênh thì lấy min/max trên mọi kênh
+    """
+    if audio.ndim == 1:
+        audio = audio[np.newaxis, :]
+    n = audio.shape[-1]
+    if n == 0:
+        return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.float32)
+    edges = _bin_edges(n, min(bins, n))
+    return np.minimum.reduceat(audio.min(axis=0), edges), np.maximum.reduceat(audio.max(axis=0), edges)
+
+
+def analyze(audio: np.ndarray, sample_rate: int, bins: int = WAVEFORM_BINS) -> dict:
+    """Metadata + peaks cho 1 clip, dạng dict ghi thẳng ra JSON"""
+    if audio.ndim == 1:
+        audio = audio[np.newaxis, :]
+    mins, maxs = compute_peaks(audio, bins)
+    peak = float(np.max(np.abs(audio))) if audio.size else 0.0
+    rms = float(np.sqrt(np.mean(np.square(audio, dtype=np.float64)))) if audio.size else 0.0
+    return {
+        "duration_s": round(audio.shape[-1] / sample_rate, 3),
+        "sample_rate": sample_rate,
+        "channels": int(audio.shape[0]),
+        "peak_db": _to_db(peak),
+        "rms_db": _to_db(rms),
+        "bins": int(mins.size),
+        "min": _round_list(mins),
+        "max": _round_list(maxs),
+    }
+
+
+def rebin(meta: dict, bins: int) -> dict:
+    """Gộp peaks đã lưu xuống còn `bins` đoạn (min của min, max của max)"""
+    if bins >= meta["bins"]:
+        return meta
+    edges = _bin_edges(meta["bins"], bins)
+    mins = np.minimum.reduceat(np.asarray(meta["min"]), edges)
+    maxs = np.maximum.reduceat(np.asarray(meta["max"]), edges)
+    return {**meta, "bins": bins, "min": _round_list(mins), "max": _round_list(maxs)}
+
+
+def sidecar_path(audio_path: str) -> str:
+    return audio_path + SIDECAR_SUFFIX
+
+
+def _write_sidecar(audio_path: str, meta: dict):
+    # Ghi file tạm rồi rename như cache audio: không ai đọc phải JSON ghi dở
+    directory = os.path.dirname(audio_path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".peaks.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(meta, f, separators=(",", ":"))
+        os.replace(tmp_path, sidecar_path(audio_path))
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def store_for_wav(audio_path: str, data: bytes) -> dict:
+    """Tính và lưu peaks cho clip WAV vừa ghi (đã có sẵn bytes, không đọc lại file)"""
+    audio, sample_rate = read_wav(data)
+    meta = analyze(audio, sample_rate)
+    _write_sidecar(audio_path, meta)
+    return meta
+
+
+def load_or_compute(audio_path: str) -> dict:
+    """Đọc peaks đã lưu; chưa có hoặc cũ hơn file audio thì tính lại và lưu"""
+    path = sidecar_path(audio_path)
+    try:
+        if os.path.getmtime(path) >= os.path.getmtime(audio_path):
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+    except (FileNotFoundError, ValueError):
+        pass
+
+    audio, sample_rate = decode_file(audio_path)
+    meta = analyze(audio, sample_rate)
+    _write_sidecar(audio_path, meta)
+    logger.info(f"📈 Computed waveform peaks: {audio_path}")
+    return meta
+
+
+def precompute_samples(sample_paths) -> int:
+    """Tính trước peaks cho các file audio chưa có (gọi ở nền khi khởi động), trả về số file đã xử lý"""
+    done = 0
+    for path in sample_paths:
+        try:
+            load_or_compute(path)
+            done += 1
+        except Exception as e:
+            logger.warning(f"⚠️ Không tính được waveform cho {path}: {str(e)}")
+    return done